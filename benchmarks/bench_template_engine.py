@@ -0,0 +1,251 @@
+"""
+Offline benchmarks for template generation. Run from the repository root:
+
+    python -m benchmarks.bench_template_engine [--quick] [--output results.json]
+
+The wildcard libraries are synthetic and built in memory, so no wildcard files, models or
+servers are needed. Results are printed as a table, and written as JSON with --output so
+regressions can be tracked across releases.
+"""
+
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tracemalloc
+from typing import Dict, List, Any, Callable, Tuple
+
+from core.template_engine import TemplateEngine, ResolvedContext
+
+# A scenario builds (wildcards, template) from a seeded rng.
+Library = Tuple[Dict[str, Dict], str]
+
+def _flat_library(num_wildcards: int, choices_per_wildcard: int) -> Callable[[random.Random], Library]:
+    """Independent wildcards of plain, weighted choices."""
+    def build(rng: random.Random) -> Library:
+        wildcards = {}
+        for w in range(num_wildcards):
+            wildcards[f"flat_{w}"] = {"choices": [
+                {"value": f"flat {w} choice {c}", "weight": rng.randint(1, 5)} if c % 3 == 0 else f"flat {w} choice {c}"
+                for c in range(choices_per_wildcard)
+            ]}
+        template = ", ".join(f"__flat_{w}__" for w in range(min(num_wildcards, 10)))
+        return wildcards, template
+    return build
+
+def _include_library(depth: int, width: int, choices_per_wildcard: int) -> Callable[[random.Random], Library]:
+    """`width` chains of wildcards, each choice pulling in the next level through its value or its includes."""
+    def build(rng: random.Random) -> Library:
+        wildcards = {}
+        for chain in range(width):
+            for level in range(depth + 1):
+                name = f"inc_{chain}_{level}"
+                choices: List[Any] = []
+                for c in range(choices_per_wildcard):
+                    if level == depth:
+                        choices.append(f"leaf {chain} {c}")
+                    elif c % 2 == 0:
+                        choices.append(f"level {level} choice {c} with __inc_{chain}_{level + 1}__")
+                    else:
+                        choices.append({"value": f"level {level} choice {c}", "includes": [f"inc_{chain}_{level + 1}"]})
+                wildcards[name] = {"choices": choices}
+        template = " | ".join(f"__inc_{chain}_0__" for chain in range(width))
+        return wildcards, template
+    return build
+
+def _rule_library(num_wildcards: int, choices_per_wildcard: int) -> Callable[[random.Random], Library]:
+    """
+    Wildcards in which most choices have a 'requires' clause on earlier wildcards' values and tags,
+    with a few unconditional choices so every draw can succeed.
+    """
+    tags = [f"tag{t}" for t in range(16)]
+
+    def build(rng: random.Random) -> Library:
+        wildcards = {}
+        for w in range(num_wildcards):
+            choices: List[Any] = []
+            for c in range(choices_per_wildcard):
+                choice: Dict[str, Any] = {"value": f"rule {w} choice {c}", "tags": rng.sample(tags, 2)}
+                if w > 0 and c % 8 != 0:
+                    previous = f"rule_{rng.randrange(w)}"
+                    kind = c % 4
+                    if kind == 0:
+                        choice["requires"] = {previous: [f"rule {previous[5:]} choice {rng.randrange(choices_per_wildcard)}" for _ in range(4)]}
+                    elif kind == 1:
+                        choice["requires"] = {"tags": {"any": rng.sample(tags, 4)}}
+                    elif kind == 2:
+                        choice["requires"] = {"tags": {"not": rng.sample(tags, 2)}, previous: {"not": f"rule {previous[5:]} choice 0"}}
+                    else:
+                        choice["requires"] = {"or": [{"tags": {"all": rng.sample(tags, 2)}}, {previous: {"any": [f"rule {previous[5:]} choice {c}"]}}]}
+                choices.append(choice)
+            wildcards[f"rule_{w}"] = {"choices": choices}
+        template = " ".join(f"__rule_{w}__" for w in range(num_wildcards))
+        return wildcards, template
+    return build
+
+SCENARIOS: Dict[str, Callable[[random.Random], Library]] = {
+    "flat_10": _flat_library(2, 5),
+    "flat_1k": _flat_library(20, 50),
+    "flat_50k": _flat_library(100, 500),
+    "includes_shallow": _include_library(1, 8, 60),
+    "includes_deep": _include_library(12, 2, 40),
+    "rules_dense_1k": _rule_library(10, 100),
+    "rules_dense_50k": _rule_library(25, 2000),
+}
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    position = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[position]
+
+def _make_engine(wildcards: Dict[str, Dict]) -> TemplateEngine:
+    engine = TemplateEngine()
+    engine.wildcards = wildcards
+    return engine
+
+def _generate_for(engine: TemplateEngine, template: str, seed: int, count: int, max_seconds: float) -> int:
+    """Generates up to `count` untimed prompts, stopping after `max_seconds`. Returns how many were generated."""
+    deadline = time.perf_counter() + max_seconds
+    for i in range(count):
+        engine.generate_structured_prompt(template, seed=seed + i)
+        if time.perf_counter() > deadline:
+            return i + 1
+    return count
+
+def _summarize(name: str, operation: str, total_choices: int, latencies_ns: List[int], peak_bytes: int) -> Dict[str, Any]:
+    latencies_ns.sort()
+    total_seconds = sum(latencies_ns) / 1e9
+    return {
+        "scenario": name,
+        "operation": operation,
+        "choices": total_choices,
+        "iterations": len(latencies_ns),
+        "ops_per_sec": round(len(latencies_ns) / total_seconds, 1) if total_seconds else None,
+        "p50_us": round(_percentile(latencies_ns, 0.50) / 1000, 2),
+        "p99_us": round(_percentile(latencies_ns, 0.99) / 1000, 2),
+        "peak_memory_bytes": peak_bytes,
+    }
+
+def bench_generation(name: str, build: Callable[[random.Random], Library], iterations: int, warmup: int,
+                     seed: int, max_seconds: float) -> Dict[str, Any]:
+    """
+    Times generate_structured_prompt on a scenario, then measures its peak memory in a separate traced run.
+    Every phase stops early after `max_seconds`, so slow scenarios report fewer iterations.
+    """
+    wildcards, template = build(random.Random(seed))
+    total_choices = sum(len(data["choices"]) for data in wildcards.values())
+
+    engine = _make_engine(wildcards)
+    _generate_for(engine, template, seed, warmup, max_seconds)
+    latencies_ns: List[int] = []
+    clock = time.perf_counter_ns
+    budget_ns = max_seconds * 1e9
+    elapsed_ns = 0
+    for i in range(iterations):
+        start = clock()
+        engine.generate_structured_prompt(template, seed=seed + i)
+        latency = clock() - start
+        latencies_ns.append(latency)
+        elapsed_ns += latency
+        if elapsed_ns > budget_ns:
+            break
+
+    # Tracing slows everything down, so memory is measured apart from the timings.
+    # The peak covers the library, its indexes and the generation itself.
+    tracemalloc.start()
+    try:
+        wildcards, template = build(random.Random(seed))
+        engine = _make_engine(wildcards)
+        _generate_for(engine, template, seed, 100, max_seconds)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return _summarize(name, "generate_structured_prompt", total_choices, latencies_ns, peak_bytes)
+
+def bench_rule_checks(name: str, build: Callable[[random.Random], Library], iterations: int, seed: int) -> Dict[str, Any]:
+    """Times _check_requirements over every choice with a 'requires' clause, against generated contexts."""
+    wildcards, template = build(random.Random(seed))
+    total_choices = sum(len(data["choices"]) for data in wildcards.values())
+    engine = _make_engine(wildcards)
+
+    contexts: List[ResolvedContext] = [engine.generate_structured_prompt(template, seed=seed + i)[1] for i in range(32)]
+    conditional = [(key, choice) for key, data in wildcards.items() for choice in data["choices"]
+                   if isinstance(choice, dict) and choice.get("requires")]
+    rng = random.Random(seed)
+    work = [(conditional[rng.randrange(len(conditional))], contexts[rng.randrange(len(contexts))]) for _ in range(min(iterations, 4096))]
+
+    latencies_ns: List[int] = []
+    clock = time.perf_counter_ns
+    check = engine._check_requirements
+    for i in range(iterations):
+        (key, choice), context = work[i % len(work)]
+        start = clock()
+        check(key, choice, context)
+        latencies_ns.append(clock() - start)
+    return _summarize(name, "check_requirements", total_choices, latencies_ns, 0)
+
+def run(scenarios: List[str], iterations: int, warmup: int, seed: int, max_seconds: float) -> Dict[str, Any]:
+    """Runs the selected scenarios and returns the results with details about the environment."""
+    results = []
+    for name in scenarios:
+        build = SCENARIOS[name]
+        results.append(bench_generation(name, build, iterations, warmup, seed, max_seconds))
+        if name.startswith("rules_"):
+            results.append(bench_rule_checks(name, build, iterations * 10, seed))
+    try:
+        with open("version.txt", "r", encoding="utf-8") as f:
+            version = f.read().strip()
+    except OSError:
+        version = None
+    return {
+        "version": version,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "seed": seed,
+        "max_seconds": max_seconds,
+        "results": results,
+    }
+
+def _print_table(report: Dict[str, Any]) -> None:
+    print(f"Python {report['python']} ({report['implementation']}) on {report['platform']}")
+    print(f"{'scenario':<18} {'operation':<27} {'choices':>8} {'ops/s':>12} {'p50 us':>9} {'p99 us':>9} {'peak KiB':>10}")
+    for r in report["results"]:
+        peak = f"{r['peak_memory_bytes'] / 1024:.0f}" if r["peak_memory_bytes"] else "-"
+        print(f"{r['scenario']:<18} {r['operation']:<27} {r['choices']:>8} {r['ops_per_sec']:>12,.0f} {r['p50_us']:>9.2f} {r['p99_us']:>9.2f} {peak:>10}")
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark template generation throughput, latency and memory.")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run. Can be repeated. Defaults to all of them.")
+    parser.add_argument("-n", "--iterations", type=int, default=5000, help="Timed prompts per scenario.")
+    parser.add_argument("--warmup", type=int, default=200, help="Untimed prompts per scenario, to build the indexes.")
+    parser.add_argument("--seed", type=int, default=1234, help="Seed for the synthetic libraries and the prompts.")
+    parser.add_argument("--max-seconds", type=float, default=10.0, help="Time budget for the timed prompts of each scenario.")
+    parser.add_argument("--quick", action="store_true", help="Run at most 500 iterations or 2 seconds per scenario, for a fast smoke test.")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file ('-' for stdout instead of the table).")
+    args = parser.parse_args(argv)
+
+    iterations = 500 if args.quick else max(1, args.iterations)
+    max_seconds = 2.0 if args.quick else args.max_seconds
+    report = run(args.scenario or list(SCENARIOS), iterations, max(0, args.warmup), args.seed, max_seconds)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return 0
+    _print_table(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -181,15 +181,15 @@ class CLIApp:
         
         enhancement_queue = []
         skipped_count = 0
+        # Never offer a prompt twice, nor one that is already in the history.
+        unique_prompts = self.processor.iter_unique_prompts(template_content)
         
         while len(enhancement_queue) < num_prompts:
             # Generate a new prompt
-            raw_prompts = self.processor.generate_raw_prompts(template_content, 1)
-            if not raw_prompts:
+            prompt = next(unique_prompts, None)
+            if prompt is None:
                 print("Could not generate more unique prompts.")
                 break
-                
-            prompt = raw_prompts[0]
             
             print(f"\n{'='*80}")
             print(f"[Preview #{len(enhancement_queue) + skipped_count + 1}] (Queue: {len(enhancement_queue)}/{num_prompts}):")
@@ -0,0 +1,84 @@
+"""Multiprocess prompt generation for very large batches."""
+
+import os
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Any, Iterator
+
+from .template_engine import TemplateEngine
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# The engine owned by each worker process, created once by _init_worker.
+_worker_engine: Optional[TemplateEngine] = None
+
+def _init_worker(wildcards: Dict[str, Dict]) -> None:
+    """Builds the worker's engine from the wildcard data shipped by the parent process."""
+    global _worker_engine
+    _worker_engine = TemplateEngine()
+    _worker_engine.wildcards = wildcards
+
+def _generate_chunk(template: str, base_seed: int, start_index: int, count: int) -> List[str]:
+    """Generates one contiguous range of a batch inside a worker process."""
+    return list(_worker_engine.generate_batch(template, count, base_seed=base_seed, start_index=start_index))
+
+def _get_mp_context() -> multiprocessing.context.BaseContext:
+    """
+    Prefers 'fork' so workers inherit the loaded wildcards instead of unpickling a copy.
+    Forking is only safe while this is the sole thread: in the GUI, Tk, the file watcher or a preload
+    thread may hold a lock the children would then wait on forever, so those get a fresh interpreter.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    if 'fork' in methods and threading.active_count() == 1:
+        return multiprocessing.get_context('fork')
+    if 'forkserver' in methods:
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+def generate_batch_parallel(engine: TemplateEngine, template: str, count: int, base_seed: int,
+                            processes: Optional[int] = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+    """
+    Generates `count` prompts across a pool of worker processes and yields them in order.
+    Each worker receives the engine's wildcards once and generates disjoint index ranges of the
+    batch, so the output is identical to `engine.generate_batch(template, count, base_seed)`.
+    At most two chunks per worker are in flight, which keeps memory bounded for huge batches.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    chunk_size = max(1, chunk_size)
+
+    # Not worth the process start-up cost; generate in-process with identical results.
+    if processes <= 1 or count <= chunk_size:
+        yield from engine.generate_batch(template, count, base_seed=base_seed)
+        return
+
+    # A plain dict snapshot is inherited for free under 'fork' and pickled once per worker otherwise.
+    # Workers may need any wildcard, so lazily loaded ones are all parsed here.
+    wildcards: Dict[str, Any] = dict(engine.wildcards.items())
+    chunk_starts = iter(range(0, count, chunk_size))
+
+    executor = ProcessPoolExecutor(max_workers=processes, mp_context=_get_mp_context(),
+                                   initializer=_init_worker, initargs=(wildcards,))
+    in_flight = deque()
+
+    def submit_next() -> bool:
+        start = next(chunk_starts, None)
+        if start is None:
+            return False
+        in_flight.append(executor.submit(_generate_chunk, template, base_seed, start, min(chunk_size, count - start)))
+        return True
+
+    try:
+        for _ in range(processes * 2):
+            if not submit_next():
+                break
+
+        while in_flight:
+            chunk = in_flight.popleft().result()
+            submit_next()
+            yield from chunk
+    finally:
+        # Also runs if the consumer stops early; don't keep generating chunks nobody will read.
+        executor.shutdown(wait=True, cancel_futures=True)
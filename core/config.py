@@ -15,7 +15,8 @@ CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".prompt_tool_v2")
 SETTINGS_FILE = os.path.join(CONFIG_DIR, "settings.json")
 MODEL_PREFIXES_FILE = os.path.join(CONFIG_DIR, "model_prefixes.json")
 LORA_PREFIXES_FILE = os.path.join(CONFIG_DIR, "lora_prefixes.json")
-WILDCARD_CACHE_FILE = os.path.join(CONFIG_DIR, "wildcards.cache.json")
+WILDCARD_CACHE_FILE = os.path.join(CONFIG_DIR, "wildcards.cache.json") # Legacy, only removed when clearing the cache.
+WILDCARD_CACHE_DIR = os.path.join(CONFIG_DIR, "wildcard_cache")
 CACHE_DIR = os.path.join(CONFIG_DIR, "cache")
 
 def load_settings() -> dict:
@@ -78,6 +79,9 @@ class Config:
     DEFAULT_NEGATIVE_PROMPT: str = _user_settings.get("default_negative_prompt", "ugly, deformed, bad quality, cartoon, 3d, disfigured, bad anatomy")
     INVOKEAI_TIMEOUT: int = _user_settings.get("invokeai_timeout", DEFAULT_INVOKEAI_TIMEOUT)
     
+    # Pick up wildcard and template files edited outside the app
+    WATCH_FILES: bool = _user_settings.get("watch_files", True)
+
     # Workflow setting
     workflow: str = _user_settings.get("workflow", "sfw")
 
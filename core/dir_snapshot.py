@@ -0,0 +1,104 @@
+"""
+Directory listings with file stats, taken with one os.scandir pass and shared by everything that
+lists the wildcard and template directories.
+"""
+
+import os
+import time
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# The coarsest modification time resolution of the filesystems in use (FAT's is two seconds).
+# A directory changed this recently may change again without its modification time moving.
+MTIME_GRANULARITY_NS = 2 * 10**9
+
+class FileStat:
+    """A file in a directory snapshot."""
+    __slots__ = ('name', 'path', 'mtime', 'mtime_ns', 'size')
+
+    def __init__(self, name: str, path: str, mtime: float, mtime_ns: int, size: int):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.mtime_ns = mtime_ns
+        self.size = size
+
+class DirectorySnapshot:
+    """The files of one directory (not its subdirectories) at the time it was scanned."""
+    __slots__ = ('directory', 'exists', 'dir_mtime_ns', 'files', 'scanned_ns')
+
+    def __init__(self, directory: str, exists: bool, dir_mtime_ns: Optional[int], files: Dict[str, FileStat],
+                 scanned_ns: int = 0):
+        self.directory = directory
+        self.exists = exists
+        self.dir_mtime_ns = dir_mtime_ns
+        self.files = files
+        self.scanned_ns = scanned_ns # When the scan started, in time.time_ns() units.
+
+    def names(self, extensions: Tuple[str, ...] = ()) -> List[str]:
+        """The file names, optionally only those with one of `extensions`, in directory order."""
+        if not extensions:
+            return list(self.files)
+        return [name for name in self.files if name.endswith(extensions)]
+
+def _dir_mtime_ns(directory: str) -> Optional[int]:
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+
+def scan_directory(directory: str) -> DirectorySnapshot:
+    """Lists a directory with the stat of every file. A missing directory gives an empty snapshot."""
+    scanned_ns = time.time_ns()
+    dir_mtime_ns = _dir_mtime_ns(directory)
+    files: Dict[str, FileStat] = {}
+    if dir_mtime_ns is None:
+        return DirectorySnapshot(directory, False, None, files)
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    # DirEntry caches its stat; on Windows it comes with the listing itself.
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = FileStat(entry.name, entry.path, stat.st_mtime, stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    continue # Deleted during the scan
+    except OSError:
+        return DirectorySnapshot(directory, False, None, files)
+    return DirectorySnapshot(directory, True, dir_mtime_ns, files, scanned_ns)
+
+class DirectorySnapshotCache:
+    """
+    The latest snapshot of each directory. get() reuses a snapshot for as long as the directory's own
+    modification time, which changes when files are added, removed or renamed, stays the same, unless
+    the snapshot was taken within MTIME_GRANULARITY_NS of that time; refresh() always rescans, for
+    callers that need up-to-date file stats.
+    """
+
+    def __init__(self):
+        self._snapshots: Dict[str, DirectorySnapshot] = {}
+        self._lock = threading.Lock()
+
+    def get(self, directory: str) -> DirectorySnapshot:
+        """Returns a snapshot with the directory's current file names. File stats may be older."""
+        snapshot = self._snapshots.get(directory)
+        if (snapshot is not None and snapshot.exists and snapshot.dir_mtime_ns == _dir_mtime_ns(directory)
+                and snapshot.scanned_ns - snapshot.dir_mtime_ns > MTIME_GRANULARITY_NS):
+            return snapshot
+        return self.refresh(directory)
+
+    def refresh(self, directory: str) -> DirectorySnapshot:
+        """Rescans a directory and returns its new snapshot."""
+        snapshot = scan_directory(directory)
+        with self._lock:
+            self._snapshots[directory] = snapshot
+        return snapshot
+
+    def invalidate(self, directory: Optional[str] = None) -> None:
+        """Forgets the snapshot of one directory, or of all directories."""
+        with self._lock:
+            if directory is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(directory, None)
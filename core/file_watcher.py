@@ -0,0 +1,241 @@
+"""
+Watches the wildcard and template directories for changes made outside the app.
+Uses inotify on Linux, and polls the directories everywhere else.
+"""
+
+import os
+import sys
+import select
+import time
+import struct
+import ctypes
+import ctypes.util
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .dir_snapshot import scan_directory
+
+# inotify event flags, from <sys/inotify.h>.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Files being written only count as changed once closed; moves cover editors that save atomically.
+_FILE_EVENTS = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+# IN_CREATE is only used to notice watched directories being created inside another one.
+_WATCH_MASK = _FILE_EVENTS | IN_CREATE
+# The parent of a watched directory that doesn't exist yet is watched for that directory appearing.
+_PARENT_MASK = IN_CREATE | IN_MOVED_TO
+_EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, name length
+
+# Changes arriving within this many seconds of each other are reported together,
+# so a burst (a checkout, a sync) triggers one update.
+SETTLE_SECONDS = 0.2
+# Changes are reported at the latest this long after the first of them, even if more keep arriving
+# (a sync tool, an editor autosaving), so a steady stream of events can't hold them back forever.
+MAX_SETTLE_SECONDS = 2.0
+
+class FileChange:
+    """A file in a watched directory that was created, modified or deleted."""
+    __slots__ = ('directory', 'filename', 'deleted')
+
+    def __init__(self, directory: str, filename: str, deleted: bool):
+        self.directory = directory
+        self.filename = filename
+        self.deleted = deleted
+
+    def __repr__(self) -> str:
+        return f"FileChange({self.directory!r}, {self.filename!r}, deleted={self.deleted})"
+
+def _file_stamps(directory: str) -> Dict[str, Tuple[int, int]]:
+    """Returns {filename: (mtime_ns, size)} for the files in a directory, or {} if it doesn't exist."""
+    return {name: (file_stat.mtime_ns, file_stat.size) for name, file_stat in scan_directory(directory).files.items()}
+
+def _load_inotify() -> Optional[ctypes.CDLL]:
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class FileWatcher:
+    """
+    Reports changed files in a set of directories to a callback, on a background thread.
+    The callback gets a list of FileChange, with each file at most once per call. Directories that
+    don't exist yet are watched from when they are created.
+    """
+
+    def __init__(self, directories: List[str], callback: Callable[[List[FileChange]], None],
+                 poll_interval: float = 1.0, use_inotify: bool = True):
+        self.directories = list(dict.fromkeys(directories))
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.backend: Optional[str] = None # 'inotify' or 'polling' once started.
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> str:
+        """Starts watching and returns the backend in use."""
+        if self._thread is not None:
+            return self.backend
+        self._stop_event.clear()
+        inotify_fd = self._open_inotify() if self.use_inotify else None
+        if inotify_fd is not None:
+            self.backend = 'inotify'
+            target, args = self._run_inotify, inotify_fd
+        else:
+            self.backend = 'polling'
+            # Taken before returning, so changes made right after start() are seen.
+            target, args = self._run_polling, {d: _file_stamps(d) for d in self.directories}
+        self._thread = threading.Thread(target=target, args=(args,), name="FileWatcher", daemon=True)
+        self._thread.start()
+        return self.backend
+
+    def stop(self) -> None:
+        """Stops watching and waits for the background thread to finish."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _dispatch(self, changes: Dict[Tuple[str, str], bool]) -> None:
+        if not changes or self._stop_event.is_set():
+            return
+        try:
+            self.callback([FileChange(directory, filename, deleted) for (directory, filename), deleted in changes.items()])
+        except Exception as e:
+            print(f"Warning: Error while handling file changes: {e}")
+
+    # --- inotify ---
+
+    def _open_inotify(self) -> Optional[int]:
+        """Returns an inotify descriptor watching every directory, or None if inotify can't be used."""
+        libc = _load_inotify()
+        if libc is None:
+            return None
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        self._libc = libc
+        self._watch_dirs: Dict[int, str] = {} # The watched directories.
+        self._parent_watches: Dict[int, str] = {} # Parents watched for missing directories.
+        # {(parent, name): directory} for the watched directories that don't exist yet.
+        self._missing_dirs: Dict[Tuple[str, str], str] = {}
+        missing = [directory for directory in self.directories if not self._add_directory_watch(fd, directory)]
+        for directory in missing:
+            if os.path.isdir(directory) or not self._watch_for_directory(fd, directory):
+                # An exhausted watch limit, or a directory whose parent is missing too; polling handles both.
+                os.close(fd)
+                return None
+        return fd
+
+    def _add_directory_watch(self, fd: int, directory: str) -> bool:
+        wd = self._libc.inotify_add_watch(fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            return False
+        self._watch_dirs[wd] = directory
+        return True
+
+    def _watch_for_directory(self, fd: int, directory: str) -> bool:
+        """Watches the parent of a missing directory, so the directory is watched once it is created."""
+        parent, name = os.path.split(directory.rstrip(os.sep))
+        self._missing_dirs[(parent, name)] = directory
+        if parent in self._watch_dirs.values() or parent in self._parent_watches.values():
+            return True # A watched directory's events include IN_CREATE already.
+        wd = self._libc.inotify_add_watch(fd, os.fsencode(parent), _PARENT_MASK)
+        if wd < 0:
+            return False
+        self._parent_watches[wd] = parent
+        return True
+
+    def _directory_created(self, fd: int, parent: str, name: str, changes: Dict[Tuple[str, str], bool]) -> None:
+        directory = self._missing_dirs.get((parent, name))
+        if directory is None or not self._add_directory_watch(fd, directory):
+            return
+        del self._missing_dirs[(parent, name)]
+        # Files written before the watch was added raised no events of their own.
+        changes.update({(directory, filename): False for filename in _file_stamps(directory)})
+
+    def _read_inotify_events(self, fd: int, changes: Dict[Tuple[str, str], bool]) -> bool:
+        """Adds the pending events to `changes`. Returns False if events were lost."""
+        try:
+            buffer = os.read(fd, 65536)
+        except BlockingIOError:
+            return True
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, name_length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                return False
+            directory = self._watch_dirs.get(wd)
+            if mask & IN_IGNORED:
+                # The directory itself was deleted; watch for it being created again.
+                self._parent_watches.pop(wd, None)
+                if self._watch_dirs.pop(wd, None) is not None and not self._watch_for_directory(fd, directory):
+                    print(f"Warning: Stopped watching {directory}, which was deleted.")
+                continue
+            if not name:
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    parent = directory if directory is not None else self._parent_watches.get(wd)
+                    if parent is not None:
+                        self._directory_created(fd, parent, os.fsdecode(name), changes)
+                continue
+            if directory is not None and mask & _FILE_EVENTS:
+                changes[(directory, os.fsdecode(name))] = bool(mask & (IN_DELETE | IN_MOVED_FROM))
+        return True
+
+    def _run_inotify(self, fd: int) -> None:
+        try:
+            changes: Dict[Tuple[str, str], bool] = {}
+            first_change_time = 0.0
+            while not self._stop_event.is_set():
+                # Wake up regularly to notice stop(); once changes arrive, wait for them to settle.
+                timeout = SETTLE_SECONDS if changes else 0.5
+                readable, _, _ = select.select([fd], [], [], timeout)
+                if readable:
+                    if not changes:
+                        first_change_time = time.monotonic()
+                    if not self._read_inotify_events(fd, changes):
+                        # The kernel queue overflowed; report every file so nothing is missed.
+                        for parent, name in list(self._missing_dirs):
+                            self._directory_created(fd, parent, name, changes)
+                        changes.update({(d, name): False for d in self.directories for name in _file_stamps(d)})
+                    if not changes or time.monotonic() - first_change_time < MAX_SETTLE_SECONDS:
+                        continue
+                self._dispatch(changes)
+                changes = {}
+        finally:
+            os.close(fd)
+
+    # --- polling ---
+
+    def _run_polling(self, snapshots: Dict[str, Dict[str, Tuple[int, int]]]) -> None:
+        while not self._stop_event.wait(self.poll_interval):
+            changes: Dict[Tuple[str, str], bool] = {}
+            for directory in self.directories:
+                old, new = snapshots[directory], _file_stamps(directory)
+                for filename, stamp in new.items():
+                    if old.get(filename) != stamp:
+                        changes[(directory, filename)] = False
+                for filename in old.keys() - new.keys():
+                    changes[(directory, filename)] = True
+                snapshots[directory] = new
+            self._dispatch(changes)
@@ -6,7 +6,7 @@ import tempfile
 import uuid
 import copy
 from datetime import datetime
-from typing import Set, Optional, Dict, Any, List
+from typing import Set, Optional, Dict, Any, List, Iterator
 from .config import config
 
 class HistoryManager:
@@ -349,6 +349,25 @@ class HistoryManager:
                 os.remove(temp_filepath)
             return False
 
+    def iter_original_prompts(self) -> Iterator[str]:
+        """Streams the original prompt of every history entry, without loading the whole history."""
+        jsonl_path = config.get_history_file()
+        if not os.path.isfile(jsonl_path):
+            return
+        try:
+            with open(jsonl_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        original_prompt = json.loads(line).get('original_prompt')
+                    except json.JSONDecodeError:
+                        continue
+                    if original_prompt:
+                        yield original_prompt
+        except Exception as e:
+            print(f"Error reading history file: {e}")
+
     def save_result(self, **result_data: Any) -> Dict[str, Any]:
         """Save a single result to the JSONL history file."""
         filepath = config.get_history_file()
@@ -0,0 +1,142 @@
+"""Deduplication of generated prompts with compact seen-sets."""
+
+import math
+import hashlib
+from array import array
+from typing import Iterable, Iterator, Optional, Union
+
+# How many draws in a row may be duplicates before the template is considered exhausted.
+DEFAULT_MAX_ATTEMPTS_PER_PROMPT = 100
+
+def prompt_hash(prompt: str) -> int:
+    """Returns a 64-bit hash of a prompt that is stable across runs (unlike the built-in hash)."""
+    return int.from_bytes(hashlib.blake2b(prompt.encode('utf-8'), digest_size=8).digest(), 'little')
+
+class SeenPromptSet:
+    """
+    An exact seen-set that stores the 64-bit hashes of prompts instead of the prompts themselves,
+    in an open-addressing table over array('Q'). Each slot takes 8 bytes and the table is kept at
+    most 3/4 full, so memory grows by 11 to 21 bytes per prompt rather than the ~60 of a set of ints.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        size = 8
+        while size * 3 < capacity * 4:
+            size *= 2
+        self._slots = array('Q', bytes(8 * size)) # 0 marks an empty slot.
+        self._count = 0
+
+    @staticmethod
+    def _key(prompt: str) -> int:
+        return prompt_hash(prompt) or 1 # Keeps 0 free for empty slots.
+
+    def _find(self, key: int) -> int:
+        """Returns the slot holding `key`, or the empty slot where it would go (linear probing)."""
+        slots = self._slots
+        mask = len(slots) - 1
+        index = key & mask
+        while True:
+            value = slots[index]
+            if value == key or not value:
+                return index
+            index = (index + 1) & mask
+
+    def _grow(self) -> None:
+        old_slots = self._slots
+        self._slots = array('Q', bytes(16 * len(old_slots)))
+        for key in old_slots:
+            if key:
+                self._slots[self._find(key)] = key
+
+    def add(self, prompt: str) -> bool:
+        """Marks a prompt as seen. Returns False if it had been seen before."""
+        key = self._key(prompt)
+        index = self._find(key)
+        if self._slots[index] == key:
+            return False
+        self._slots[index] = key
+        self._count += 1
+        if self._count * 4 > len(self._slots) * 3:
+            self._grow()
+        return True
+
+    def __contains__(self, prompt: str) -> bool:
+        key = self._key(prompt)
+        return self._slots[self._find(key)] == key
+
+    def __len__(self) -> int:
+        return self._count
+
+class BloomFilterSeenSet:
+    """
+    A fixed-size seen-set for multi-million-prompt runs. Memory doesn't grow with the number of prompts,
+    at the cost of occasionally treating a new prompt as seen (about `error_rate` once `capacity` is reached).
+    """
+
+    def __init__(self, capacity: int = 1_000_000, error_rate: float = 0.001):
+        capacity = max(1, capacity)
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._count = 0
+
+    def _positions(self, prompt: str) -> Iterator[int]:
+        # Double hashing over the two halves of a 128-bit digest.
+        digest = hashlib.blake2b(prompt.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, prompt: str) -> bool:
+        """Marks a prompt as seen. Returns False if it had (probably) been seen before."""
+        is_new = False
+        for position in self._positions(prompt):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not self._bits[byte] & mask:
+                self._bits[byte] |= mask
+                is_new = True
+        if is_new:
+            self._count += 1
+        return is_new
+
+    def __contains__(self, prompt: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(prompt))
+
+    def __len__(self) -> int:
+        return self._count
+
+class PromptDeduplicator:
+    """
+    Filters a stream of generated prompts down to the ones not seen before.
+    The seen-set can be pre-filled, e.g. with the prompts already in the history, so those are never emitted.
+    """
+
+    def __init__(self, seen: Optional[Union[SeenPromptSet, BloomFilterSeenSet]] = None,
+                 max_attempts_per_prompt: int = DEFAULT_MAX_ATTEMPTS_PER_PROMPT):
+        self.seen = seen if seen is not None else SeenPromptSet()
+        self.max_attempts_per_prompt = max(1, max_attempts_per_prompt)
+        self.duplicates_skipped = 0
+
+    def add_seen(self, prompts: Iterable[str]) -> None:
+        """Marks prompts as already seen without emitting them."""
+        for prompt in prompts:
+            if prompt:
+                self.seen.add(prompt)
+
+    def unique(self, prompts: Iterable[str]) -> Iterator[str]:
+        """
+        Yields the prompts that haven't been seen yet, marking them as seen.
+        Stops once `max_attempts_per_prompt` prompts in a row were duplicates, as the template
+        has then (very likely) run out of new combinations.
+        """
+        attempts = 0
+        for prompt in prompts:
+            if self.seen.add(prompt):
+                attempts = 0
+                yield prompt
+                continue
+            self.duplicates_skipped += 1
+            attempts += 1
+            if attempts >= self.max_attempts_per_prompt:
+                return
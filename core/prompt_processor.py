@@ -6,8 +6,9 @@ import os
 import random
 import re
 import uuid
+import queue
 import threading
-from typing import List, Dict, Any, Optional, Callable, Tuple, Set, TYPE_CHECKING
+from typing import List, Dict, Any, Optional, Callable, Tuple, Set, Iterator, TYPE_CHECKING
 from .thumbnail_manager import ThumbnailManager
 from .config import config
 from .default_content import (DEFAULT_SFW_ENHANCEMENT_INSTRUCTION, DEFAULT_SFW_VARIATIONS, DEFAULT_NSFW_ENHANCEMENT_INSTRUCTION, DEFAULT_NSFW_VARIATIONS, DEFAULT_SFW_NEGATIVE_PROMPTS, DEFAULT_NSFW_NEGATIVE_PROMPTS, DEFAULT_AI_TASK_PROMPTS,
@@ -18,8 +19,12 @@ from .ollama_client import OllamaClient
 from .invokeai_client import InvokeAIClient
 from .utils import sanitize_wildcard_choices
 from datetime import datetime
-from .template_engine import TemplateEngine, PromptSegment
+from .template_engine import TemplateEngine, PromptSegment, IncrementalGenerationState, compile_template, TOKEN_LITERAL
 from .history_manager import HistoryManager
+from .batch_generation import generate_batch_parallel
+from .template_enumerator import TemplateEnumerator
+from .prompt_dedup import PromptDeduplicator, SeenPromptSet, BloomFilterSeenSet, DEFAULT_MAX_ATTEMPTS_PER_PROMPT
+from .file_watcher import FileWatcher, FileChange
 
 class PromptProcessor:
     """Coordinates prompt generation and enhancement workflow."""
@@ -39,6 +44,12 @@ class PromptProcessor:
         self._avg_gen_times_cache: Optional[Dict[str, float]] = None
         self._default_negative_prompt_cache: Optional[str] = None
         self._used_wildcards_cache: Optional[Set[str]] = None
+        # {wildcard_name: (wildcard_data, wildcards_it_uses)}, checked against the identity of the data.
+        self._wildcard_dependencies: Dict[str, Tuple[Dict, Set[str]]] = {}
+        self.file_watcher: Optional[FileWatcher] = None
+        # Batches of file changes reported by the watcher, waiting for apply_file_changes().
+        self._pending_file_changes: "queue.Queue[List[FileChange]]" = queue.Queue()
+        self._live_preview_state = IncrementalGenerationState()
         self.available_variations_map: Dict[str, str] = {}
         
         # Callback functions for UI updates (optional)
@@ -58,8 +69,8 @@ class PromptProcessor:
     def initialize(self) -> None:
         """Initialize all components."""
         self._update_status("Loading wildcards...")
-        self.template_engine.load_wildcards(self._get_wildcard_load_order())
         self._load_all_wildcards_into_cache()
+        self.template_engine.use_wildcard_dirs(self._get_wildcard_load_order())
         
         self._update_status("Initializing directories...")
         self._initialize_directories()
@@ -74,7 +85,10 @@ class PromptProcessor:
         self._update_status("Ready")
     
     def _load_all_wildcards_into_cache(self):
-        """Loads all wildcards from all directories into an internal, mode-agnostic cache."""
+        """
+        (Re)scans all wildcard directories into the engine's shared store, and keeps a mode-agnostic
+        view of it. The workflow-specific view used for generation reads the same parsed data.
+        """
         all_dirs = [config.WILDCARD_DIR, config.WILDCARD_NSFW_DIR]
         self.all_wildcards_cache = self.template_engine.get_all_wildcards_data_from_dirs(all_dirs)
     
@@ -186,16 +200,31 @@ class PromptProcessor:
     def reload_wildcards(self) -> None:
         """Reloads wildcards based on the current workflow."""
         self._update_status("Reloading wildcards...")
-        self.template_engine.load_wildcards(self._get_wildcard_load_order())
+        # Only files that changed on disk are parsed again.
+        self._load_all_wildcards_into_cache()
+        self.template_engine.use_wildcard_dirs(self._get_wildcard_load_order())
         # --- FIX: Also reload templates to reflect the new workflow ---
         self._update_status("Reloading templates...")
+        self.template_engine.dir_snapshots.invalidate(config.get_template_dir()) # Rescan, whatever its mtime says.
         self.template_engine.list_templates(config.get_template_dir())
         # --- End of fix ---
         self._used_wildcards_cache = None
-        self._load_all_wildcards_into_cache()
         self.available_variations_map = {v['key']: v['name'] for v in self.get_available_variations()}
         self._update_status("Ready")
 
+    def switch_workflow(self) -> None:
+        """
+        Applies a change of config.workflow. The wildcards of both workflows are already in the
+        shared store, so this only swaps the engine's view and reloads the workflow's templates.
+        Without a file watcher to keep the store current, the directories are rescanned instead.
+        """
+        if self.file_watcher is None:
+            self.reload_wildcards() # Only files that changed on disk are parsed again.
+            return
+        self.template_engine.use_wildcard_dirs(self._get_wildcard_load_order())
+        self.template_engine.list_templates(config.get_template_dir())
+        self.available_variations_map = {v['key']: v['name'] for v in self.get_available_variations()}
+
     def clear_wildcard_cache_and_reload(self) -> bool:
         """Clears the wildcard cache file and reloads all wildcards from disk."""
         if self.template_engine.clear_wildcard_cache_file():
@@ -203,6 +232,72 @@ class PromptProcessor:
             return True
         return False
 
+    def _get_watched_template_dirs(self) -> List[str]:
+        return [os.path.join(config.TEMPLATE_BASE_DIR, 'sfw'), os.path.join(config.TEMPLATE_BASE_DIR, 'nsfw')]
+
+    def start_file_watcher(self, on_pending: Optional[Callable[[], None]] = None,
+                           use_inotify: bool = True, poll_interval: float = 1.0) -> str:
+        """
+        Starts watching the wildcard and template directories, so files edited outside the app are
+        picked up without a reload. The watcher's thread only queues the changes, and calls
+        `on_pending` when it has; they take effect when apply_file_changes() is called, on the thread
+        that uses the wildcards and templates (e.g. the GUI's main loop).
+        Returns the watcher backend in use ('inotify' or 'polling').
+        """
+        self.stop_file_watcher()
+        directories = [config.WILDCARD_DIR, config.WILDCARD_NSFW_DIR] + self._get_watched_template_dirs()
+        self.file_watcher = FileWatcher(directories, lambda changes: self._queue_file_changes(changes, on_pending),
+                                        poll_interval=poll_interval, use_inotify=use_inotify)
+        backend = self.file_watcher.start()
+        if self.verbose:
+            print(f"INFO: Watching wildcard and template files for changes ({backend}).")
+        return backend
+
+    def stop_file_watcher(self) -> None:
+        if self.file_watcher is not None:
+            self.file_watcher.stop()
+            self.file_watcher = None
+
+    def _queue_file_changes(self, changes: List[FileChange], on_pending: Optional[Callable[[], None]]) -> None:
+        """Called on the watcher's thread with a batch of changed files."""
+        self._pending_file_changes.put(changes)
+        if on_pending:
+            on_pending()
+
+    def apply_file_changes(self) -> Tuple[List[str], List[str]]:
+        """
+        Applies the file changes queued by the watcher; only the changed files are read again.
+        Returns the changed wildcard names and template files.
+        """
+        # Later reports of the same file replace earlier ones.
+        pending: Dict[Tuple[str, str], FileChange] = {}
+        while True:
+            try:
+                batch = self._pending_file_changes.get_nowait()
+            except queue.Empty:
+                break
+            for change in batch:
+                pending[(change.directory, change.filename)] = change
+        changes = list(pending.values())
+
+        wildcard_dirs = {config.WILDCARD_DIR, config.WILDCARD_NSFW_DIR}
+        changed_wildcards = self.template_engine.apply_wildcard_file_changes(
+            (change.directory, change.filename) for change in changes if change.directory in wildcard_dirs)
+
+        template_changes: Dict[str, List[str]] = {}
+        for change in changes:
+            if change.directory not in wildcard_dirs and change.filename.endswith('.txt'):
+                template_changes.setdefault(change.directory, []).append(change.filename)
+        changed_templates: List[str] = []
+        for template_dir, filenames in template_changes.items():
+            changed_templates.extend(self.template_engine.apply_template_file_changes(template_dir, filenames))
+
+        # The dependency lists of changed wildcards are rebuilt lazily, as their data was replaced.
+        # Templates of either workflow can make a wildcard used.
+        if changed_wildcards or template_changes:
+            self._used_wildcards_cache = None
+        return changed_wildcards, changed_templates
+
     def get_available_models(self) -> List[Dict[str, Any]]:
         """Get list of available Ollama models with their details."""
         return self.ollama_client.list_models()
@@ -477,7 +572,7 @@ class PromptProcessor:
         dependency_graph: Dict[str, Set[str]] = {}
         if self.all_wildcards_cache:
             for wc_name, wc_data in self.all_wildcards_cache.items():
-                dependency_graph[wc_name] = self.get_all_used_wildcards_for_single_file(wc_data)
+                dependency_graph[wc_name] = self._get_wildcard_dependencies(wc_name, wc_data)
 
         # --- Find Root Wildcards (directly used by templates) ---
         root_wildcards = set()
@@ -486,16 +581,13 @@ class PromptProcessor:
             os.path.join(config.TEMPLATE_BASE_DIR, 'nsfw')
         ]
         for template_dir in all_template_dirs:
-            if not os.path.exists(template_dir):
-                continue
-            for template_file in os.listdir(template_dir):
-                if template_file.endswith('.txt'):
-                    try:
-                        content = self.template_engine.load_template(template_file, template_dir)
-                        found = re.findall(r'__([a-zA-Z0-9_.\s-]+?)__', content)
-                        root_wildcards.update(found)
-                    except Exception as e:
-                        print(f"Warning: Could not scan template {os.path.join(template_dir, template_file)} for used wildcards: {e}")
+            for template_file in self.template_engine.dir_snapshots.get(template_dir).names(('.txt',)):
+                try:
+                    content = self.template_engine.load_template(template_file, template_dir)
+                    found = re.findall(r'__([a-zA-Z0-9_.\s-]+?)__', content)
+                    root_wildcards.update(found)
+                except Exception as e:
+                    print(f"Warning: Could not scan template {os.path.join(template_dir, template_file)} for used wildcards: {e}")
 
         # --- Transitive Closure: Find all dependencies starting from the roots ---
         all_used = set()
@@ -514,6 +606,15 @@ class PromptProcessor:
         self._used_wildcards_cache = all_used
         return self._used_wildcards_cache
 
+    def _get_wildcard_dependencies(self, wc_name: str, wc_data: Dict) -> Set[str]:
+        """The wildcards a wildcard uses, cached until its data is replaced (e.g. by a reload or an edit)."""
+        cached = self._wildcard_dependencies.get(wc_name)
+        if cached is not None and cached[0] is wc_data:
+            return cached[1]
+        dependencies = self.get_all_used_wildcards_for_single_file(wc_data)
+        self._wildcard_dependencies[wc_name] = (wc_data, dependencies)
+        return dependencies
+
     def check_for_circular_dependencies(self, start_node: str, temp_node_data: Optional[Dict] = None) -> Optional[List[str]]:
         """
         Checks for circular dependencies in wildcards starting from a given node.
@@ -525,37 +626,37 @@ class PromptProcessor:
         
         if self.all_wildcards_cache is None: return None
 
-        # Temporarily update the cache with the live data from the editor for an accurate check
-        original_node_data = self.all_wildcards_cache.get(start_node)
-        if temp_node_data is not None:
-            self.all_wildcards_cache[start_node] = temp_node_data
-
-        try:
-            path = set()
-            visited = set()
-
-            def dfs(node: str) -> Optional[List[str]]:
-                path.add(node)
-                visited.add(node)
-
-                node_data = self.all_wildcards_cache.get(node, {})
-                dependencies = self.get_all_used_wildcards_for_single_file(node_data)
-
-                for dependency in dependencies:
-                    if dependency not in self.all_wildcards_cache: continue
-                    if dependency in path:
-                        cycle_path = list(path) + [dependency]
-                        return cycle_path[cycle_path.index(dependency):]
-                    if dependency not in visited:
-                        result = dfs(dependency)
-                        if result: return result
-                path.remove(node)
-                return None
-            return dfs(start_node)
-        finally:
-            # Restore the cache to its original state
-            if original_node_data is not None: self.all_wildcards_cache[start_node] = original_node_data
-            elif temp_node_data is not None and start_node in self.all_wildcards_cache: del self.all_wildcards_cache[start_node]
+        # Use the live data from the editor for the start node for an accurate check.
+        # The cache is a read-only view of the shared wildcard store, so it is overlaid rather than modified.
+        def get_node_data(node: str) -> Dict:
+            if node == start_node and temp_node_data is not None:
+                return temp_node_data
+            return self.all_wildcards_cache.get(node, {})
+
+        def is_known(node: str) -> bool:
+            return node in self.all_wildcards_cache or (node == start_node and temp_node_data is not None)
+
+        path = set()
+        visited = set()
+
+        def dfs(node: str) -> Optional[List[str]]:
+            path.add(node)
+            visited.add(node)
+
+            node_data = get_node_data(node)
+            dependencies = self.get_all_used_wildcards_for_single_file(node_data)
+
+            for dependency in dependencies:
+                if not is_known(dependency): continue
+                if dependency in path:
+                    cycle_path = list(path) + [dependency]
+                    return cycle_path[cycle_path.index(dependency):]
+                if dependency not in visited:
+                    result = dfs(dependency)
+                    if result: return result
+            path.remove(node)
+            return None
+        return dfs(start_node)
 
     def get_wildcard_dependency_graph(self) -> Dict[str, Dict[str, List[str]]]:
         """
@@ -572,7 +673,7 @@ class PromptProcessor:
 
         for wc_name, wc_data in self.all_wildcards_cache.items():
             # Use the existing robust logic to find all wildcards this file uses
-            used_wildcards = self.get_all_used_wildcards_for_single_file(wc_data)
+            used_wildcards = self._get_wildcard_dependencies(wc_name, wc_data)
             
             for dep in used_wildcards:
                 if dep in graph: # Ensure the dependency is a known wildcard
@@ -654,30 +755,18 @@ class PromptProcessor:
     def archive_wildcard(self, wildcard_file: str) -> None:
         """Archives a wildcard file."""
         self.template_engine.archive_wildcard(wildcard_file, self._get_wildcard_search_order())
-        # Update the mode-agnostic cache
-        basename, _ = os.path.splitext(wildcard_file)
+        # The mode-agnostic cache is a view of the same store, so it is already up to date.
         self._used_wildcards_cache = None
-        if self.all_wildcards_cache is not None:
-            self.all_wildcards_cache.pop(basename, None)
 
     def rename_wildcard(self, old_filename: str, new_filename: str) -> None:
         """Renames a wildcard file on disk and updates internal caches."""
         search_order = self._get_wildcard_search_order()
         
-        # Perform the file system operation
+        # Perform the file system operation. This also updates the template engine's wildcard store,
+        # which the mode-agnostic cache is a view of.
         self.template_engine.rename_wildcard(old_filename, new_filename, search_order)
         
         # Update caches
-        old_basename, _ = os.path.splitext(old_filename)
-        new_basename, _ = os.path.splitext(new_filename)
-
-        # Update template engine's main wildcard cache
-        if old_basename in self.template_engine.wildcards:
-            self.template_engine.wildcards[new_basename] = self.template_engine.wildcards.pop(old_basename)
-
-        # Update the mode-agnostic cache
-        if self.all_wildcards_cache is not None and old_basename in self.all_wildcards_cache:
-            self.all_wildcards_cache[new_basename] = self.all_wildcards_cache.pop(old_basename)
         self._used_wildcards_cache = None
         self.template_engine.wildcard_files_cache = None # Invalidate file list cache
 
@@ -693,13 +782,7 @@ class PromptProcessor:
         ]
 
         for template_dir in all_template_dirs:
-            if not os.path.exists(template_dir):
-                continue
-            
-            for template_file in os.listdir(template_dir):
-                if not template_file.endswith('.txt'):
-                    continue
-                
+            for template_file in self.template_engine.dir_snapshots.get(template_dir).names(('.txt',)):
                 filepath = os.path.join(template_dir, template_file)
                 made_change = False
                 try:
@@ -743,6 +826,95 @@ class PromptProcessor:
             seed=seed
         )
 
+    def generate_live_structured_prompt(self, template_content: str, existing_context: Optional[Dict[str, Any]] = None, force_reroll: Optional[List[str]] = None, force_swap: Optional[Dict[str, str]] = None, seed: Optional[int] = None) -> Tuple[List[PromptSegment], Dict[str, Any]]:
+        """
+        Like generate_single_structured_prompt, for repeated updates while the template is being edited.
+        Only the edited part of the template is regenerated; the result is the same as a full generation.
+        """
+        return self.template_engine.generate_structured_prompt_incremental(
+            template_content,
+            self._live_preview_state,
+            existing_context=existing_context,
+            force_reroll=force_reroll,
+            force_swap=force_swap,
+            seed=seed
+        )
+
+    def generate_raw_prompts(self, template_content: str, count: int, base_seed: Optional[int] = None, processes: int = 1) -> List[str]:
+        """
+        Generates a batch of fresh prompts as cleaned-up strings, e.g. for the CLI queue or dataset building.
+        With `processes` > 1, large batches are generated in a process pool with identical results.
+        """
+        if processes > 1:
+            if base_seed is None:
+                base_seed = random.randint(0, 2**32 - 1)
+            prompts = generate_batch_parallel(self.template_engine, template_content, count, base_seed, processes=processes)
+        else:
+            prompts = self.template_engine.generate_batch(template_content, count, base_seed=base_seed)
+        return [self.cleanup_prompt_string(prompt) for prompt in prompts]
+
+    def create_prompt_deduplicator(self, include_history: bool = True, use_bloom_filter: bool = False,
+                                   expected_prompts: int = 1_000_000, max_attempts_per_prompt: int = DEFAULT_MAX_ATTEMPTS_PER_PROMPT) -> PromptDeduplicator:
+        """
+        Creates a seen-set for batch generation. With `include_history`, every original prompt already in
+        the history (enhanced or skipped) counts as seen. A Bloom filter keeps memory fixed for huge runs.
+        """
+        seen = BloomFilterSeenSet(capacity=expected_prompts) if use_bloom_filter else SeenPromptSet()
+        deduplicator = PromptDeduplicator(seen, max_attempts_per_prompt=max_attempts_per_prompt)
+        if include_history:
+            deduplicator.add_seen(self.history_manager.iter_original_prompts())
+        return deduplicator
+
+    def iter_unique_prompts(self, template_content: str, deduplicator: Optional[PromptDeduplicator] = None, base_seed: Optional[int] = None) -> Iterator[str]:
+        """
+        Lazily yields cleaned-up prompts that haven't been generated (or stored in the history) before.
+        Ends when the deduplicator gives up, i.e. when the template has run out of new combinations.
+        """
+        if deduplicator is None:
+            deduplicator = self.create_prompt_deduplicator()
+        prompts = (self.cleanup_prompt_string(prompt) for prompt in self.template_engine.generate_batch(template_content, None, base_seed=base_seed))
+        return deduplicator.unique(prompts)
+
+    def set_generation_profiling(self, enabled: bool) -> None:
+        """Turns recording of per-wildcard generation costs on or off."""
+        if enabled:
+            self.template_engine.enable_profiling()
+        else:
+            self.template_engine.disable_profiling()
+
+    def is_generation_profiling_enabled(self) -> bool:
+        return self.template_engine.profiler is not None
+
+    def get_generation_profile(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the per-wildcard generation costs recorded since profiling was enabled, costliest first:
+        {name: {'draws', 'rejected_choices', 'filter_seconds', 'include_seconds', 'max_depth'}}.
+        """
+        profiler = self.template_engine.profiler
+        return profiler.snapshot() if profiler is not None else {}
+
+    def reset_generation_profile(self) -> None:
+        profiler = self.template_engine.profiler
+        if profiler is not None:
+            profiler.reset()
+
+    def count_template_combinations(self, template_content: str) -> int:
+        """Returns how many distinct prompts (combinations of choices) a template can produce."""
+        return TemplateEnumerator(self.template_engine).count(template_content)
+
+    def enumerate_prompts(self, template_content: str) -> Iterator[str]:
+        """Lazily yields every prompt a template can produce, cleaned up, for full-coverage runs."""
+        for prompt in TemplateEnumerator(self.template_engine).iterate(template_content):
+            yield self.cleanup_prompt_string(prompt)
+
+    def generate_stratified_prompts(self, template_content: str, count: int, strata: Optional[List[str]] = None, base_seed: Optional[int] = None) -> List[str]:
+        """
+        Generates prompts in which each choice of the `strata` wildcards (by default, all top-level
+        wildcards of the template) appears in proportion to its weight, e.g. for A/B testing.
+        """
+        prompts = TemplateEnumerator(self.template_engine).stratified_sample(template_content, count, strata=strata, base_seed=base_seed)
+        return [self.cleanup_prompt_string(prompt) for prompt in prompts]
+
     def validate_template_order(self, template_content: str) -> Dict[str, str]:
         """
         Validates that any wildcard with a 'requires' clause does not depend on a
@@ -750,9 +922,8 @@ class PromptProcessor:
         Returns a dictionary mapping problematic wildcard names to error messages.
         """
         errors = {}
-        # Use the full regex to find all wildcards, but only extract the name (group 2)
-        wildcard_pattern = re.compile(r'__(!)?([a-zA-Z0-9_.\s-]+?)(?::\d+(?:-\d+)?)?__')
-        wildcards_in_order = [match.group(2) for match in wildcard_pattern.finditer(template_content)]
+        # Reuse the engine's compiled (and cached) token list to find wildcards in order.
+        wildcards_in_order = [token.name for token in compile_template(template_content) if token.kind != TOKEN_LITERAL]
         
         # Create a map of wildcard name to its first appearance index
         wildcard_indices = {}
@@ -1000,10 +1171,8 @@ class PromptProcessor:
                     break
             
             if save_dir:
+                # This also updates the shared store behind the mode-agnostic cache.
                 self.template_engine.save_wildcard_content(filename_to_save, json.dumps(modified_data, indent=2), save_dir)
-                # Update the cache with the modified data
-                if self.all_wildcards_cache:
-                    self.all_wildcards_cache[wc_name] = modified_data
                 return True
             else:
                 print(f"Warning: Could not find original path for wildcard '{wc_name}' during refactor. Skipping save.")
@@ -1982,11 +2151,13 @@ class PromptProcessor:
             return "none"
 
         if wildcard_names:
-            source_wildcards = {name: self.all_wildcards_cache[name] for name in wildcard_names if name in self.all_wildcards_cache}
+            source_names = wildcard_names
         else:
             sample_size = min(count, len(self.all_wildcards_cache))
-            sampled_keys = self.rng.sample(list(self.all_wildcards_cache.keys()), sample_size)
-            source_wildcards = {key: self.all_wildcards_cache[key] for key in sampled_keys}
+            source_names = self.rng.sample(list(self.all_wildcards_cache.keys()), sample_size)
+        # Wildcards are loaded on access, and one whose file fails to parse is skipped.
+        source_wildcards = {name: self.all_wildcards_cache.get(name) for name in source_names}
+        source_wildcards = {name: data for name, data in source_wildcards.items() if data is not None}
 
         parts = []
         for wc_name, wc_data in sorted(source_wildcards.items()):
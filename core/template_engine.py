@@ -1,58 +1,803 @@
 """Template and wildcard handling functionality."""
 
 import os
+import sys
 import json
 import re
 import random
-import copy
+import itertools
+import threading
+from time import perf_counter
+from bisect import bisect_left
+from collections.abc import Mapping
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Any, Tuple, Callable
+from functools import lru_cache
+from typing import Dict, List, Optional, Any, Tuple, Callable, Iterator, Iterable, Union, AbstractSet, FrozenSet
 from .config import config
+from .utils import intern_wildcard_data
+from .wildcard_store import WildcardStore, WildcardView
+from .wildcard_cache import WildcardCache
+from .dir_snapshot import DirectorySnapshotCache
 
-@dataclass
+# Matches __wildcard__, __!wildcard__ (unique roll) and __wildcard:N-M__ (multi-select).
+WILDCARD_PATTERN = re.compile(r'__(!)?([a-zA-Z0-9_.\s-]+?)(?::(\d+)(?:-(\d+))?)?__')
+
+# Token kinds produced by compile_template.
+TOKEN_LITERAL = 'literal'
+TOKEN_WILDCARD = 'wildcard'
+TOKEN_UNIQUE = 'unique'
+TOKEN_MULTI = 'multi'
+
+# Upper bound on cached compiled templates. Choice values are compiled too, so this
+# needs to comfortably hold a large wildcard library plus live-preview edits.
+COMPILED_TEMPLATE_CACHE_SIZE = 65536
+
+# Maximum number of cached valid-choice sets per wildcard, one per distinct relevant context.
+VALID_CHOICE_CACHE_SIZE = 256
+
+# Constants of the SplitMix64 generator, used to derive independent per-prompt seeds.
+_SPLITMIX64_GAMMA = 0x9E3779B97F4A7C15
+_MASK64 = (1 << 64) - 1
+
+@dataclass(frozen=True, slots=True)
 class PromptSegment:
-    """Represents a piece of a generated prompt."""
+    """Represents a piece of a generated prompt. Segments are immutable, so literal ones are pooled."""
     text: str
     wildcard_name: Optional[str] = None
     includes: Optional[Any] = None
     is_from_include: bool = False
 
+@lru_cache(maxsize=COMPILED_TEMPLATE_CACHE_SIZE)
+def _literal_segment(text: str, wildcard_name: Optional[str], is_from_include: bool) -> PromptSegment:
+    """Returns the shared segment for a piece of literal template text."""
+    return PromptSegment(text=text, wildcard_name=wildcard_name, is_from_include=is_from_include)
+
+def join_segments(segments: List[PromptSegment]) -> str:
+    """Flattens generated segments back into the prompt text."""
+    return "".join([segment.text for segment in segments])
+
+@dataclass(frozen=True)
+class TemplateToken:
+    """A single element of a compiled template: literal text or a wildcard reference."""
+    kind: str
+    text: str  # The literal text, or the wildcard tag exactly as written in the template.
+    name: Optional[str] = None
+    count_min: int = 0
+    count_max: Optional[int] = None
+
+@lru_cache(maxsize=COMPILED_TEMPLATE_CACHE_SIZE)
+def compile_template(template_string: str) -> Tuple[TemplateToken, ...]:
+    """
+    Parses a template string into a tuple of tokens.
+    Results are cached by content, so each distinct template or choice value is only parsed once.
+    """
+    if '__' not in template_string:
+        return (TemplateToken(TOKEN_LITERAL, template_string),) if template_string else ()
+
+    tokens: List[TemplateToken] = []
+    last_end = 0
+    for match in WILDCARD_PATTERN.finditer(template_string):
+        if match.start() > last_end:
+            tokens.append(TemplateToken(TOKEN_LITERAL, template_string[last_end:match.start()]))
+
+        force_unique_str, key, count_min_str, count_max_str = match.groups()
+        if count_min_str:
+            # Multi-selection takes precedence over the unique marker.
+            tokens.append(TemplateToken(TOKEN_MULTI, match.group(0), key, int(count_min_str), int(count_max_str) if count_max_str else None))
+        elif force_unique_str == '!':
+            tokens.append(TemplateToken(TOKEN_UNIQUE, match.group(0), key))
+        else:
+            tokens.append(TemplateToken(TOKEN_WILDCARD, match.group(0), key))
+        last_end = match.end()
+
+    if last_end < len(template_string):
+        tokens.append(TemplateToken(TOKEN_LITERAL, template_string[last_end:]))
+    return tuple(tokens)
+
+def _choice_weight(choice: Any) -> Any:
+    """Returns the sampling weight of a choice. Simple string choices weigh 1."""
+    return choice.get('weight', 1) if isinstance(choice, dict) else 1
+
+class TagRegistry:
+    """
+    Gives every tag its own bit the first time it is seen, so a set of tags is a single int.
+    Each engine has its own registry and starts a new one when its wildcards are reloaded,
+    so masks stay as narrow as the tags of the loaded library.
+    """
+    __slots__ = ('_bits', '_lock')
+
+    def __init__(self):
+        self._bits: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def bit(self, tag: str) -> int:
+        """Returns the bit that stands for `tag` in tag masks."""
+        bit = self._bits.get(tag)
+        if bit is None:
+            with self._lock:
+                bit = self._bits.setdefault(tag, 1 << len(self._bits))
+        return bit
+
+    def mask(self, tags: Iterable[str]) -> int:
+        """Returns the mask of a collection of tags."""
+        mask = 0
+        for tag in tags:
+            mask |= self.bit(tag)
+        return mask
+
+    def __len__(self) -> int:
+        return len(self._bits)
+
+# Used by requirements and contexts checked outside of an engine.
+_default_tag_registry = TagRegistry()
+
+def tag_bit(tag: str) -> int:
+    """Returns the bit that stands for `tag` in masks of the default registry."""
+    return _default_tag_registry.bit(tag)
+
+def tags_mask(tags: Iterable[str]) -> int:
+    """Returns the mask of a collection of tags in the default registry."""
+    return _default_tag_registry.mask(tags)
+
+# A compiled rule takes the resolved context and the mask of all tags in it.
+RulePredicate = Callable[[Dict[str, Any], Optional[int]], bool]
+
+def _always(context: Dict[str, Any], tag_mask: Optional[int]) -> bool:
+    return True
+
+def _never(context: Dict[str, Any], tag_mask: Optional[int]) -> bool:
+    return False
+
+def _as_lookup_set(values: List[Any]) -> Any:
+    """Turns a list of condition values into a frozenset for fast membership tests, if hashable."""
+    try:
+        return frozenset(values)
+    except TypeError:
+        return tuple(values)
+
+class ResolvedContext(dict):
+    """
+    The choices resolved during a generation pass, as {wildcard_name: {'value': ..., 'tags': [...]}}.
+    It behaves exactly like a dict, but also keeps a count of every tag across its entries as they
+    are added, overwritten or removed, and the mask of the tags present, so tag rules become bit
+    operations instead of a scan of all entries. The mask is in terms of the TagRegistry that last
+    asked for it. Entries are expected to be replaced rather than mutated in place.
+    """
+    __slots__ = ('_tag_counts', '_tag_mask', '_registry')
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__()
+        self._tag_counts: Dict[str, int] = {}
+        self._tag_mask = 0
+        self._registry: Optional[TagRegistry] = None # Set by the first mask_for call.
+        self.update(*args, **kwargs)
+
+    @property
+    def tags(self) -> AbstractSet[str]:
+        """A live, set-like view of all tags present in the context."""
+        return self._tag_counts.keys()
+
+    @property
+    def tag_mask(self) -> int:
+        """The mask (see tag_bit) of all tags present in the context, in the default registry."""
+        return self.mask_for(_default_tag_registry)
+
+    def mask_for(self, registry: TagRegistry) -> int:
+        """The mask of all tags present in the context, kept up to date for `registry` from now on."""
+        if self._registry is not registry:
+            self._registry = registry
+            self._tag_mask = registry.mask(self._tag_counts)
+        return self._tag_mask
+
+    @staticmethod
+    def _entry_tags(item: Any) -> List[str]:
+        if isinstance(item, dict):
+            return item.get('tags') or []
+        return []
+
+    def _add_tags(self, item: Any) -> None:
+        counts = self._tag_counts
+        for tag in self._entry_tags(item):
+            count = counts.get(tag, 0)
+            counts[tag] = count + 1
+            if not count and self._registry is not None:
+                self._tag_mask |= self._registry.bit(tag)
+
+    def _remove_tags(self, item: Any) -> None:
+        counts = self._tag_counts
+        for tag in self._entry_tags(item):
+            remaining = counts.get(tag, 0) - 1
+            if remaining > 0:
+                counts[tag] = remaining
+            elif counts.pop(tag, None) is not None and self._registry is not None:
+                self._tag_mask &= ~self._registry.bit(tag)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in self:
+            self._remove_tags(dict.__getitem__(self, key))
+        dict.__setitem__(self, key, value)
+        self._add_tags(value)
+
+    def __delitem__(self, key: str) -> None:
+        self._remove_tags(dict.__getitem__(self, key))
+        dict.__delitem__(self, key)
+
+    def pop(self, key: str, *default: Any) -> Any:
+        if key in self:
+            value = dict.pop(self, key)
+            self._remove_tags(value)
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self) -> Tuple[str, Any]:
+        key, value = dict.popitem(self)
+        self._remove_tags(value)
+        return key, value
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other: Any) -> 'ResolvedContext':
+        self.update(other)
+        return self
+
+    def clear(self) -> None:
+        dict.clear(self)
+        self._tag_counts.clear()
+        self._tag_mask = 0
+
+    def copy(self) -> 'ResolvedContext':
+        return ResolvedContext(self)
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Rebuild through __init__ so the tag counts are restored for copies and pickles.
+        return (self.__class__, (dict(self),))
+
+class PreservedChoices(Mapping):
+    """
+    A read-only view of the choice values to keep from a previous context.
+    Rerolled and swapped wildcards are hidden by an overlay instead of copying the context,
+    and values are read from the context entries only when they are looked up.
+    """
+    __slots__ = ('_context', '_hidden')
+
+    def __init__(self, context: Optional[Dict[str, Any]] = None, hidden: Optional[AbstractSet[str]] = None):
+        self._context = context if context is not None else {}
+        self._hidden = hidden if hidden else frozenset()
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._context and key not in self._hidden
+
+    def __getitem__(self, key: str) -> str:
+        if key in self._hidden:
+            raise KeyError(key)
+        return self._context[key]['value']
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key in self._context if key not in self._hidden)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+def _context_tag_mask(context: Dict[str, Any], registry: TagRegistry) -> int:
+    """Returns the mask of all tags from all previously resolved items in the context."""
+    if isinstance(context, ResolvedContext):
+        return context.mask_for(registry) # Maintained incrementally.
+    mask = 0
+    for item in context.values():
+        if isinstance(item, dict) and 'tags' in item:
+            mask |= registry.mask(item['tags'])
+    return mask
+
+def _compile_rules(rules: Any, registry: TagRegistry) -> Tuple[RulePredicate, bool]:
+    """
+    Compiles a 'requires' rule tree into a predicate. Returns (predicate, uses_tags).
+    Supports logical operators 'and', 'or', 'not' for complex, nested conditions.
+    """
+    # Base case: empty rules are always true.
+    if not rules:
+        return _always, False
+    if not isinstance(rules, dict):
+        return _never, False # Malformed rules
+
+    # Handle logical operators for nested conditions
+    if 'and' in rules:
+        # 'and' must be a list of rule dictionaries
+        if not isinstance(rules['and'], list): return _never, False
+        compiled = [_compile_rules(rule, registry) for rule in rules['and']]
+        predicates = tuple(predicate for predicate, _ in compiled)
+
+        def check_and(context, tag_mask):
+            for predicate in predicates:
+                if not predicate(context, tag_mask):
+                    return False
+            return True
+        return check_and, any(uses_tags for _, uses_tags in compiled)
+
+    if 'or' in rules:
+        # 'or' must be a list of rule dictionaries
+        if not isinstance(rules['or'], list): return _never, False
+        compiled = [_compile_rules(rule, registry) for rule in rules['or']]
+        predicates = tuple(predicate for predicate, _ in compiled)
+
+        def check_or(context, tag_mask):
+            for predicate in predicates:
+                if predicate(context, tag_mask):
+                    return True
+            return False
+        return check_or, any(uses_tags for _, uses_tags in compiled)
+
+    if 'not' in rules:
+        # 'not' must be a single rule dictionary
+        if not isinstance(rules['not'], dict): return _never, False
+        predicate, uses_tags = _compile_rules(rules['not'], registry)
+        return (lambda context, tag_mask: not predicate(context, tag_mask)), uses_tags
+
+    # If no logical operators, it's an implicit 'and' of all key-value pairs.
+    return _compile_single_rule_set(rules, registry)
+
+def _compile_single_rule_set(rules: Dict[str, Any], registry: TagRegistry) -> Tuple[RulePredicate, bool]:
+    """Compiles a simple set of rules (an implicit AND) of wildcard value and tag conditions."""
+    predicates = []
+    uses_tags = False
+    for key, condition in rules.items():
+        if key == 'tags':
+            predicates.append(_compile_tag_rules(condition, registry))
+            uses_tags = True
+        else:
+            predicates.append(_compile_value_condition(key, condition))
+
+    if len(predicates) == 1:
+        return predicates[0], uses_tags
+    predicates = tuple(predicates)
+
+    def check_all(context, tag_mask):
+        for predicate in predicates:
+            if not predicate(context, tag_mask):
+                return False
+        return True
+    return check_all, uses_tags
+
+def _compile_value_condition(wildcard_name: str, condition: Any) -> RulePredicate:
+    """Compiles a check that a single wildcard's value in the context matches a given condition."""
+    def context_value(context: Dict[str, Any]) -> Any:
+        item = context.get(wildcard_name)
+        return item.get('value') if item is not None else None
+
+    if isinstance(condition, dict):
+        # Handle complex conditions like {"not": "value"} or {"any": [...]}
+        allowed = None
+        if 'any' in condition:
+            if not isinstance(condition.get('any'), list):
+                return _never
+            allowed = _as_lookup_set(condition['any'])
+
+        forbidden = None
+        forbidden_value = None
+        if 'not' in condition:
+            if isinstance(condition['not'], list):
+                forbidden = _as_lookup_set(condition['not'])
+            else:
+                forbidden_value = condition['not']
+        has_forbidden_value = 'not' in condition and forbidden is None
+
+        def check_complex(context, tag_mask):
+            value = context_value(context)
+            if allowed is not None and value not in allowed:
+                return False
+            if forbidden is not None and value in forbidden:
+                return False
+            if has_forbidden_value and value == forbidden_value:
+                return False
+            return True
+        return check_complex
+
+    if isinstance(condition, list):
+        # "wildcard": ["value1", "value2"] means value must be one of them.
+        allowed_values = _as_lookup_set(condition)
+        return lambda context, tag_mask: context_value(context) in allowed_values
+
+    # "wildcard": "value" means an exact match is required.
+    return lambda context, tag_mask: context_value(context) == condition
+
+def _compile_tag_rules(tag_rules: Any, registry: TagRegistry) -> RulePredicate:
+    """
+    Compiles tag-based rules checked against the set of all tags in the context.
+    Supports 'any', 'all', and 'not' conditions.
+    """
+    if not isinstance(tag_rules, dict):
+        return _never # Malformed tag rules
+
+    try:
+        # 'any': at least one of the specified tags must be present.
+        any_mask = None
+        if 'any' in tag_rules:
+            if not isinstance(tag_rules['any'], list): return _never
+            any_mask = registry.mask(tag_rules['any'])
+
+        # 'all': all of the specified tags must be present.
+        all_mask = None
+        if 'all' in tag_rules:
+            if not isinstance(tag_rules['all'], list): return _never
+            all_mask = registry.mask(tag_rules['all'])
+
+        # 'not': none of the specified tags should be present. Also supports a single tag string.
+        not_mask = None
+        if isinstance(tag_rules.get('not'), list):
+            not_mask = registry.mask(tag_rules['not'])
+        elif isinstance(tag_rules.get('not'), str):
+            not_mask = registry.bit(tag_rules['not'])
+    except TypeError:
+        return _never # Unhashable tags can never match.
+
+    def check_tags(context, tag_mask):
+        if any_mask is not None and not tag_mask & any_mask:
+            return False
+        if all_mask is not None and tag_mask & all_mask != all_mask:
+            return False
+        if not_mask is not None and tag_mask & not_mask:
+            return False
+        return True
+    return check_tags
+
+def _analyze_rules(rules: Any) -> Tuple[FrozenSet[str], FrozenSet[str], FrozenSet[str]]:
+    """
+    Finds what a rule tree depends on. Returns (referenced_keys, referenced_tags, required_keys),
+    where `required_keys` are wildcards that must already be in the context for the rules to pass.
+    Mirrors the operator precedence of _compile_rules.
+    """
+    if not rules or not isinstance(rules, dict):
+        return frozenset(), frozenset(), frozenset()
+
+    for operator in ('and', 'or'):
+        if operator in rules:
+            subrules = rules[operator]
+            if not isinstance(subrules, list):
+                return frozenset(), frozenset(), frozenset()
+            analyzed = [_analyze_rules(rule) for rule in subrules]
+            keys = frozenset().union(*(a[0] for a in analyzed))
+            tags = frozenset().union(*(a[1] for a in analyzed))
+            if operator == 'and':
+                required = frozenset().union(*(a[2] for a in analyzed))
+            else:
+                # Every alternative must need a key for the whole 'or' to need it.
+                required = frozenset.intersection(*(a[2] for a in analyzed)) if analyzed else frozenset()
+            return keys, tags, required
+
+    if 'not' in rules:
+        if not isinstance(rules['not'], dict):
+            return frozenset(), frozenset(), frozenset()
+        keys, tags, _ = _analyze_rules(rules['not'])
+        return keys, tags, frozenset() # A negated condition can pass when a key is missing.
+
+    keys, tags, required = set(), set(), set()
+    for key, condition in rules.items():
+        if key == 'tags':
+            if isinstance(condition, dict):
+                for tag_list in (condition.get('any'), condition.get('all'), condition.get('not')):
+                    if isinstance(tag_list, list):
+                        tags.update(tag for tag in tag_list if isinstance(tag, str))
+                    elif isinstance(tag_list, str):
+                        tags.add(tag_list)
+            continue
+
+        keys.add(key)
+        # A missing wildcard has the value None, which only passes conditions that allow None.
+        if isinstance(condition, dict):
+            allowed = condition.get('any')
+            if 'any' in condition and isinstance(allowed, list) and None not in allowed:
+                required.add(key)
+        elif isinstance(condition, list):
+            if None not in condition:
+                required.add(key)
+        elif condition is not None:
+            required.add(key)
+    return frozenset(keys), frozenset(tags), frozenset(required)
+
+class CompiledRequirement:
+    """A choice's 'requires' clause, compiled once into a predicate over the resolved context."""
+    __slots__ = ('predicate', 'uses_tags', 'referenced_keys', 'referenced_tags', 'required_keys', 'registry')
+
+    def __init__(self, rules: Any, registry: Optional[TagRegistry] = None):
+        self.registry = registry if registry is not None else _default_tag_registry
+        self.predicate, self.uses_tags = _compile_rules(rules, self.registry)
+        self.referenced_keys, self.referenced_tags, self.required_keys = _analyze_rules(rules)
+
+    def matches(self, context: Dict[str, Any], tag_mask: Optional[int] = None) -> bool:
+        """Checks the requirement. `tag_mask` is computed from the context if needed and not given."""
+        if self.uses_tags and tag_mask is None:
+            tag_mask = _context_tag_mask(context, self.registry)
+        return self.predicate(context, tag_mask)
+
+class _ValidChoices:
+    """The conditional choices of a wildcard that pass their requirements in a given context."""
+    __slots__ = ('pairs', 'weight', 'in_file_order')
+
+    def __init__(self, pairs: List[Tuple[Any, Any]]):
+        self.pairs = pairs # (choice, weight) in file order
+        self.weight: Any = 0
+        for _, weight in pairs:
+            self.weight += weight
+        self.in_file_order: Optional[List[Any]] = None # All valid choices, built on demand.
+
+class _SamplingIndex:
+    """
+    Precomputed weighted-draw tables for a single wildcard.
+    Choices without a 'requires' clause are always valid, so their cumulative weights are
+    built once and drawn with a binary search. Conditional choices are kept in a separate
+    (usually small) list with their compiled requirements. Those that can only pass when a certain
+    wildcard is already resolved are bucketed under it, so they are skipped while it is missing.
+    The valid conditional choices are cached per signature of the context values and tags that
+    the requirements actually reference. Tokenized include templates are memoized here as well.
+    """
+    __slots__ = ('source', 'choices', 'unconditional', 'cumulative_weights', 'unconditional_weight', 'conditional',
+                 'requirements', 'uses_tags', 'unguarded', 'guarded', 'signature_keys', 'signature_tags', 'signature_tag_mask', 'valid_cache',
+                 'include_tokens', 'default_include_tokens', 'registry')
+
+    def __init__(self, wildcard_data: Dict[str, Any], registry: TagRegistry):
+        self.source = wildcard_data # Used to detect when the wildcard data has been replaced.
+        self.registry = registry # The engine's tag registry when the index was built.
+        self.choices: List[Any] = wildcard_data.get('choices') or []
+        self.unconditional: List[Any] = []
+        self.cumulative_weights: List[Any] = []
+        self.unconditional_weight: Any = 0
+        self.conditional: List[Tuple[Any, Any, CompiledRequirement]] = [] # (choice, weight, requirement) in file order
+        self.requirements: Dict[int, CompiledRequirement] = {} # Keyed by id() of the conditional choice object
+        self.uses_tags = False
+        self.unguarded: List[int] = [] # Positions in `conditional` that must always be checked
+        self.guarded: Dict[str, List[int]] = {} # {required wildcard: positions in `conditional`}
+        self.valid_cache: Dict[Tuple[Any, ...], _ValidChoices] = {}
+        self.include_tokens: Dict[int, Tuple[TemplateToken, ...]] = {} # Keyed by id() of choices with their own 'includes'
+        self.default_include_tokens: Optional[Tuple[TemplateToken, ...]] = None # The wildcard-level 'includes'
+
+        signature_keys, signature_tags = set(), set()
+        for choice in self.choices:
+            weight = _choice_weight(choice)
+            if isinstance(choice, dict) and choice.get('requires'):
+                requirement = CompiledRequirement(choice['requires'], registry)
+                position = len(self.conditional)
+                self.conditional.append((choice, weight, requirement))
+                self.requirements[id(choice)] = requirement
+                self.uses_tags = self.uses_tags or requirement.uses_tags
+                signature_keys.update(requirement.referenced_keys)
+                signature_tags.update(requirement.referenced_tags)
+                if requirement.required_keys:
+                    self.guarded.setdefault(min(requirement.required_keys), []).append(position)
+                else:
+                    self.unguarded.append(position)
+            else:
+                self.unconditional_weight += weight
+                self.unconditional.append(choice)
+                self.cumulative_weights.append(self.unconditional_weight)
+
+        self.signature_keys: Tuple[str, ...] = tuple(sorted(signature_keys))
+        self.signature_tags: Tuple[str, ...] = tuple(sorted(signature_tags))
+        self.signature_tag_mask = registry.mask(self.signature_tags)
+
+    def get_valid_conditional(self, context: Dict[str, Any]) -> _ValidChoices:
+        """Returns the conditional choices that are valid in the context, using the signature cache."""
+        tag_mask = _context_tag_mask(context, self.registry) if self.uses_tags else None
+
+        signature: Tuple[Any, ...] = tuple(
+            item.get('value') if item is not None else None
+            for item in map(context.get, self.signature_keys)
+        )
+        if tag_mask is not None:
+            signature += (tag_mask & self.signature_tag_mask,)
+
+        try:
+            cached = self.valid_cache.get(signature)
+        except TypeError:
+            signature, cached = None, None # Unhashable context values; don't cache.
+        if cached is not None:
+            return cached
+
+        # Only check choices whose required wildcards are present in the context.
+        if self.guarded:
+            positions = list(self.unguarded)
+            for key, guarded_positions in self.guarded.items():
+                if key in context:
+                    positions.extend(guarded_positions)
+            positions.sort() # Keep file order for reproducible draws.
+        else:
+            positions = self.unguarded
+
+        conditional = self.conditional
+        valid = _ValidChoices([
+            (conditional[i][0], conditional[i][1]) for i in positions
+            if conditional[i][2].predicate(context, tag_mask)
+        ])
+
+        if signature is not None:
+            if len(self.valid_cache) >= VALID_CHOICE_CACHE_SIZE:
+                self.valid_cache.clear()
+            self.valid_cache[signature] = valid
+        return valid
+
+def derive_prompt_seed(base_seed: int, index: int) -> int:
+    """
+    Returns the seed of the `index`-th prompt of a batch started from `base_seed`.
+    This is the SplitMix64 stream, so any prompt's seed can be computed directly from its index.
+    """
+    z = (base_seed + (index + 1) * _SPLITMIX64_GAMMA) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+class WildcardProfile:
+    """The generation cost attributed to one wildcard."""
+    __slots__ = ('draws', 'rejected_choices', 'filter_seconds', 'include_seconds', 'max_depth')
+
+    def __init__(self):
+        self.draws = 0 # Times the wildcard was resolved.
+        self.rejected_choices = 0 # Choices skipped because their 'requires' clause failed.
+        self.filter_seconds = 0.0 # Time spent checking 'requires' clauses.
+        self.include_seconds = 0.0 # Time spent expanding 'includes', including nested wildcards.
+        self.max_depth = 0 # Deepest nesting at which the wildcard was resolved (1 = in the template).
+
+    def merge(self, other: 'WildcardProfile') -> None:
+        self.draws += other.draws
+        self.rejected_choices += other.rejected_choices
+        self.filter_seconds += other.filter_seconds
+        self.include_seconds += other.include_seconds
+        self.max_depth = max(self.max_depth, other.max_depth)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class GenerationProfiler:
+    """
+    Aggregates per-wildcard generation costs while enabled on a TemplateEngine.
+    Each generation records into its own profiles, which are merged in here when it finishes.
+    """
+
+    def __init__(self):
+        self._profiles: Dict[str, WildcardProfile] = {}
+        self._lock = threading.Lock()
+        self.generations = 0
+
+    def merge(self, profiles: Dict[str, WildcardProfile]) -> None:
+        """Adds the profiles of one finished generation."""
+        with self._lock:
+            self.generations += 1
+            for key, profile in profiles.items():
+                total = self._profiles.get(key)
+                if total is None:
+                    total = self._profiles[key] = WildcardProfile()
+                total.merge(profile)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Returns {wildcard_name: stats} for every wildcard resolved so far, costliest first."""
+        with self._lock:
+            items = [(key, profile.as_dict()) for key, profile in self._profiles.items()]
+        items.sort(key=lambda item: item[1]['filter_seconds'] + item[1]['include_seconds'], reverse=True)
+        return dict(items)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._profiles.clear()
+            self.generations = 0
+
+class GenerationContext:
+    """
+    The mutable state of a single generation: its seed, its own random generator, the choices
+    resolved so far and the choices to preserve or swap in. Each generation call creates one,
+    so the engine itself is only read while generating and can be shared between threads.
+    """
+    __slots__ = ('seed', 'rng', 'resolved', 'preserved', 'force_swap', 'text_only', 'profiles', 'depth')
+
+    def __init__(self, seed: int, preserved: Optional[Mapping[str, str]] = None,
+                 force_swap: Optional[Dict[str, str]] = None, text_only: bool = False, profile: bool = False):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.resolved = ResolvedContext()
+        self.preserved: Mapping[str, str] = preserved if preserved is not None else {}
+        self.force_swap = force_swap
+        self.text_only = text_only # Generate plain strings instead of PromptSegment objects.
+        # Per-wildcard costs, or None when profiling is off so the generation skips all bookkeeping.
+        self.profiles: Optional[Dict[str, WildcardProfile]] = {} if profile else None
+        self.depth = 0 # Wildcard nesting level; only tracked while profiling.
+
+    def profile_for(self, key: str) -> WildcardProfile:
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = self.profiles[key] = WildcardProfile()
+        return profile
+
+class IncrementalGenerationState:
+    """
+    The previous result of TemplateEngine.generate_structured_prompt_incremental, with a checkpoint
+    (rng state, resolved context, segment count) at every top-level token boundary of its template.
+    """
+    __slots__ = ('inputs', 'tokens', 'rng_states', 'contexts', 'segment_counts', 'segments')
+
+    def __init__(self):
+        self.inputs: Optional[Tuple[Any, ...]] = None # Everything besides the template that the result depends on.
+        self.tokens: Tuple[TemplateToken, ...] = ()
+        self.rng_states: List[Any] = []
+        self.contexts: List[ResolvedContext] = []
+        self.segment_counts: List[int] = []
+        self.segments: List[PromptSegment] = []
+
 class TemplateEngine:
     """Handles template loading and wildcard substitution."""
     
-    def __init__(self):
-        self.wildcards: Dict[str, Dict] = {} # Will now store the full parsed JSON object
+    def __init__(self, use_wildcard_cache: bool = True):
+        from .config import WILDCARD_CACHE_DIR
+        self._wildcards: Dict[str, Dict] = {} # Will now store the full parsed JSON object
+        # Listings of the wildcard and template directories, shared by everything that scans them.
+        self.dir_snapshots = DirectorySnapshotCache()
+        # Every loaded wildcard directory; self._wildcards is usually a view of it.
+        self.wildcard_store = WildcardStore(WildcardCache(WILDCARD_CACHE_DIR) if use_wildcard_cache else None, self.dir_snapshots)
         self.templates: Dict[str, str] = {}
+        self.template_dir: Optional[str] = None # The directory self.templates was listed from.
         self.wildcard_files_cache: Optional[List[str]] = None
         self.wildcard_dirs_for_cache: Optional[List[str]] = None
-        self.current_seed: Optional[int] = None
-        self.rng = random.Random()
+        self.current_seed: Optional[int] = None # The seed of the most recent generation, for display only.
+        self.profiler: Optional[GenerationProfiler] = None # Set by enable_profiling.
+        self._sampling_indexes: Dict[str, _SamplingIndex] = {}
+        self.tag_registry = TagRegistry() # Replaced, with the sampling indexes, on every reload.
+        self._indexed_store_version = -1 # The store's version when use_wildcard_dirs() last switched views.
+        # {wildcard_name: (wildcard_data, {value: choice_obj})}, built lazily per wildcard.
+        self._value_indexes: Dict[str, Tuple[Dict[str, Any], Dict[Any, Any]]] = {}
+        # Bumped whenever wildcard data is changed through the engine, so cached generations can be invalidated.
+        self.wildcards_version = 0
+
+    @property
+    def wildcards(self) -> Dict[str, Dict]:
+        """The loaded wildcard data, keyed by wildcard name."""
+        return self._wildcards
+
+    @wildcards.setter
+    def wildcards(self, value: Dict[str, Dict]) -> None:
+        self._wildcards = value
+        self._invalidate_wildcard_indexes()
+
+    def _invalidate_wildcard_indexes(self, wildcard_name: Optional[str] = None) -> None:
+        """Drops precomputed lookup tables for one wildcard, or for all wildcards if no name is given."""
+        self.wildcards_version += 1
+        if wildcard_name is None:
+            self._sampling_indexes.clear()
+            self._value_indexes.clear()
+            self.tag_registry = TagRegistry() # Drops the bits of tags that are no longer used.
+        else:
+            self._sampling_indexes.pop(wildcard_name, None)
+            self._value_indexes.pop(wildcard_name, None)
+
+    def _rename_wildcard_indexes(self, old_name: str, new_name: str) -> None:
+        """Moves precomputed lookup tables to a wildcard's new name, as the data itself is unchanged."""
+        self.wildcards_version += 1
+        for indexes in (self._sampling_indexes, self._value_indexes):
+            indexes.pop(new_name, None)
+            if old_name in indexes:
+                indexes[new_name] = indexes.pop(old_name)
+
+    def _get_sampling_index(self, key: str) -> Optional[_SamplingIndex]:
+        """Returns the sampling index for a wildcard, building it on first use."""
+        wildcard_data = self.wildcards.get(key)
+        if not wildcard_data or 'choices' not in wildcard_data:
+            return None
 
-    def _load_wildcard_cache(self) -> Dict[str, Any]:
-        """Loads the wildcard cache from disk."""
-        from .config import WILDCARD_CACHE_FILE
-        if not os.path.exists(WILDCARD_CACHE_FILE):
-            return {}
-        try:
-            with open(WILDCARD_CACHE_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (IOError, json.JSONDecodeError):
-            # If cache is corrupted or unreadable, start fresh.
-            return {}
-
-    def _save_wildcard_cache(self, cache_data: Dict[str, Any]):
-        """Saves the wildcard cache to disk."""
-        from .config import WILDCARD_CACHE_FILE
-        try:
-            os.makedirs(os.path.dirname(WILDCARD_CACHE_FILE), exist_ok=True)
-            with open(WILDCARD_CACHE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f) # No indent for smaller file size
-        except IOError as e:
-            print(f"Warning: Could not save wildcard cache: {e}")
+        index = self._sampling_indexes.get(key)
+        if index is None or index.source is not wildcard_data:
+            # Threads generating at the same time may both build it; they build the same index.
+            index = _SamplingIndex(wildcard_data, self.tag_registry)
+            self._sampling_indexes[key] = index
+        return index
 
     def clear_wildcard_cache_file(self) -> bool:
-        """Deletes the wildcard cache file from disk."""
+        """Deletes the wildcard cache from disk and forgets all parsed wildcard data."""
         from .config import WILDCARD_CACHE_FILE
+        self.wildcard_store.clear_parsed()
+        if self.wildcard_store.cache is not None and not self.wildcard_store.cache.clear():
+            return False
+        # Remove the single-file JSON cache of older versions too.
         if os.path.exists(WILDCARD_CACHE_FILE):
             try:
                 os.remove(WILDCARD_CACHE_FILE)
@@ -63,87 +808,98 @@ class TemplateEngine:
                 return False
         return True # It's already clear if it doesn't exist
 
-    def load_wildcards(self, wildcard_dirs: List[str]) -> Dict[str, Dict]:
+    def load_wildcards(self, wildcard_dirs: List[str]) -> WildcardView:
         """Load all wildcard files from a list of directories, with later directories overriding earlier ones."""
         self.wildcards = self.get_all_wildcards_data_from_dirs(wildcard_dirs)
         # The file list cache is now populated by get_all_wildcards_data_from_dirs.
         return self.wildcards
     
-    def get_all_wildcards_data_from_dirs(self, wildcard_dirs: List[str]) -> Dict[str, Dict]:
+    def get_all_wildcards_data_from_dirs(self, wildcard_dirs: List[str]) -> WildcardView:
         """
-        Loads and returns all wildcard data from a list of directories,
-        using a file-based cache to speed up subsequent loads.
+        Rescans a list of directories and returns a view of their wildcard data. Only the file names
+        and modification times are read here; each file is parsed the first time its wildcard is
+        accessed, so a template only ever loads the wildcards it (transitively) uses.
+        Files that are unchanged since the last scan keep their parsed data.
         """
-        disk_cache = self._load_wildcard_cache()
-        wildcards: Dict[str, Dict] = {}
-        
-        # {basename: {ext: '.json', path: '/path/to/file.json', mtime: 12345.67}}
-        found_files: Dict[str, Dict[str, Any]] = {}
-        
-        # 1. Scan all files on disk to get their paths and modification times.
-        for wildcard_dir in wildcard_dirs:
-            if not os.path.exists(wildcard_dir):
-                continue
-            
-            for filename in os.listdir(wildcard_dir):
-                basename, ext = os.path.splitext(filename)
-                if ext in ['.txt', '.json']:
-                    path = os.path.join(wildcard_dir, filename)
-                    try:
-                        mtime = os.path.getmtime(path)
-                        
-                        # Prioritize .json over .txt. Later dirs override earlier ones.
-                        if basename not in found_files or \
-                           (ext == '.json' and found_files[basename]['ext'] == '.txt') or \
-                           (ext == found_files[basename]['ext']): # Add filename for caching
-                            found_files[basename] = {'ext': ext, 'path': path, 'mtime': mtime, 'filename': filename}
-                    except FileNotFoundError:
-                        continue # File might have been deleted during the scan
+        self.wildcard_store.refresh(wildcard_dirs)
+        view = self.wildcard_store.view(wildcard_dirs)
 
         # Populate the file list cache here since we already have the file list.
-        file_list = sorted([data['filename'] for data in found_files.values()], key=str.lower)
-        self.wildcard_files_cache = file_list
+        self.wildcard_files_cache = view.filenames()
         self.wildcard_dirs_for_cache = wildcard_dirs
+        return view
 
-        # 2. Process files, using cache where possible.
-        current_cache = {}
-        for basename, file_info in found_files.items():
-            path = file_info['path']
-            mtime = file_info['mtime']
-            
-            # Check if a valid, up-to-date entry exists in the cache.
-            if path in disk_cache and disk_cache[path].get('mtime') == mtime:
-                wildcards[basename] = disk_cache[path]['data']
-                current_cache[path] = disk_cache[path] # Keep the valid entry
+    def use_wildcard_dirs(self, wildcard_dirs: List[str]) -> WildcardView:
+        """
+        Switches to the wildcards of another list of directories without rescanning or re-parsing
+        anything that is already loaded, e.g. when switching workflows.
+        """
+        view = self.wildcard_store.view(wildcard_dirs)
+        if view is not self._wildcards or self.wildcard_store.version != self._indexed_store_version:
+            # Another library, or files were added, removed or replaced: drop the lookup tables and
+            # start a new tag registry, so both only cover the wildcards now in use.
+            self._invalidate_wildcard_indexes()
+        self._indexed_store_version = self.wildcard_store.version
+        self._wildcards = view
+        self.wildcards_version += 1
+        self.wildcard_files_cache = view.filenames()
+        self.wildcard_dirs_for_cache = wildcard_dirs
+        return view
+    
+    def apply_wildcard_file_changes(self, changes: Iterable[Tuple[str, str]]) -> List[str]:
+        """
+        Applies changes made to wildcard files outside the engine, given as (directory, filename)
+        pairs. Only the changed wildcards are read again, on their next access, and only their
+        lookup tables are dropped. Returns the names of the wildcards that changed.
+        Like loading, this must not run while another thread is generating.
+        """
+        changed: List[str] = []
+        for wildcard_dir, filename in changes:
+            name = self.wildcard_store.refresh_file(wildcard_dir, filename)
+            if name is not None and name not in changed:
+                changed.append(name)
+                self._invalidate_wildcard_indexes(name)
+        if changed and isinstance(self._wildcards, WildcardView):
+            self.wildcard_files_cache = self._wildcards.filenames()
+        return changed
+
+    def apply_template_file_changes(self, template_dir: str, filenames: Iterable[str]) -> List[str]:
+        """
+        Re-reads templates that changed outside the engine, if they are in the listed template directory.
+        Returns the templates that were added, modified or removed.
+        """
+        if template_dir != self.template_dir:
+            return []
+        changed: List[str] = []
+        for filename in filenames:
+            if not filename.endswith('.txt'):
                 continue
-
-            # If not in cache or outdated, load from disk.
             try:
-                if file_info['ext'] == '.json':
-                    with open(path, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                else: # .txt
-                    with open(path, 'r', encoding='utf-8') as f:
-                        lines = [line.strip() for line in f if line.strip()]
-                        data = {"description": f"Legacy wildcard from {os.path.basename(path)}.", "choices": lines}
-                
-                wildcards[basename] = data
-                current_cache[path] = {'mtime': mtime, 'data': data} # Update cache
+                with open(os.path.join(template_dir, filename), 'r', encoding='utf-8') as f:
+                    content: Optional[str] = f.read()
+            except FileNotFoundError:
+                content = None
             except Exception as e:
-                print(f"Error loading or parsing wildcard file {path}: {e}")
+                print(f"Warning: Could not reload template {filename}: {e}")
+                continue
+            if self.templates.get(filename) == content:
+                continue # Already up to date, e.g. saved through the engine.
+            if content is None:
+                self.templates.pop(filename, None)
+            else:
+                self.templates[filename] = content
+            changed.append(filename)
+        return changed
 
-        # 3. Save the updated cache back to disk.
-        self._save_wildcard_cache(current_cache)
-        
-        return wildcards
-    
     def list_templates(self, template_dir: str) -> List[str]:
         """Get a sorted list of available template files and cache their content."""
-        if not os.path.exists(template_dir):
+        self.template_dir = template_dir
+        snapshot = self.dir_snapshots.get(template_dir)
+        if not snapshot.exists:
             self.templates.clear()
             return []
             
-        template_files = sorted([f for f in os.listdir(template_dir) if f.endswith('.txt')], key=str.lower)
+        template_files = sorted(snapshot.names(('.txt',)), key=str.lower)
         
         # Clear old cache and load new content
         self.templates.clear()
@@ -182,12 +938,8 @@ class TemplateEngine:
         canonical_files: Dict[str, Dict[str, str]] = {}
 
         for wildcard_dir in wildcard_dirs:
-            if not os.path.exists(wildcard_dir):
-                continue
-            for filename in os.listdir(wildcard_dir):
+            for filename in self.dir_snapshots.get(wildcard_dir).names(('.txt', '.json')):
                 basename, ext = os.path.splitext(filename)
-                if ext not in ['.txt', '.json']:
-                    continue
 
                 # If we haven't seen this basename, or if the new file is a .json and the old was a .txt,
                 # or if it's the same extension (from a later dir), then update.
@@ -223,7 +975,11 @@ class TemplateEngine:
         try:
             with open(filepath, 'w', encoding='utf-8') as f:
                 json.dump(json.loads(content), f, indent=2) # Prettify the JSON
-            self.wildcards[wildcard_file[:-5]] = json.loads(content)
+            data = intern_wildcard_data(json.loads(content))
+            self.wildcard_store.put(wildcard_dir, wildcard_file, data)
+            if not isinstance(self._wildcards, WildcardView):
+                self._wildcards[sys.intern(wildcard_file[:-5])] = data
+            self._invalidate_wildcard_indexes(wildcard_file[:-5])
             # Invalidate file list cache on save
             self.wildcard_files_cache = None
         except Exception as e:
@@ -239,11 +995,15 @@ class TemplateEngine:
                 f.write(content)
             # Update cache
             self.templates[template_file] = content
+            self.dir_snapshots.invalidate(template_dir)
         except Exception as e:
             raise Exception(f"Error saving template {template_file}: {e}")
 
     def _archive_file(self, filename: str, search_dirs: List[str], file_type_name: str, post_archive_callback: Optional[Callable] = None) -> None:
-        """Generic method to move a file to an 'archive' subdirectory within its source directory."""
+        """
+        Generic method to move a file to an 'archive' subdirectory within its source directory.
+        The callback receives the directory the file was archived from.
+        """
         source_path = None
         source_dir = None
         for directory in search_dirs:
@@ -262,23 +1022,27 @@ class TemplateEngine:
         try:
             os.makedirs(archive_dir, exist_ok=True)
             os.rename(source_path, dest_path)
+            self.dir_snapshots.invalidate(source_dir)
             if post_archive_callback:
-                post_archive_callback()
+                post_archive_callback(source_dir)
         except OSError as e:
             raise Exception(f"Error archiving {file_type_name} {filename}: {e}")
 
     def archive_template(self, template_file: str, template_dir: str) -> None:
         """Move a template file to an 'archive' subdirectory."""
-        def on_success():
+        def on_success(source_dir: str):
             self.templates.pop(template_file, None)
 
         self._archive_file(template_file, [template_dir], "template", post_archive_callback=on_success)
 
     def archive_wildcard(self, wildcard_file: str, wildcard_dirs: List[str]) -> None:
         """Move a wildcard file to an 'archive' subdirectory, checking directories in order."""
-        def on_success():
+        def on_success(source_dir: str):
             key, _ = os.path.splitext(wildcard_file)
-            self.wildcards.pop(key, None)
+            self.wildcard_store.remove(source_dir, key)
+            if not isinstance(self._wildcards, WildcardView):
+                self._wildcards.pop(key, None)
+            self._invalidate_wildcard_indexes(key)
             # Invalidate file list cache on archive
             self.wildcard_files_cache = None
         
@@ -308,6 +1072,14 @@ class TemplateEngine:
         except OSError as e:
             raise Exception(f"Error renaming file from '{old_path}' to '{new_path}': {e}")
 
+        # Keep the in-memory data and its lookup tables under the new name.
+        old_key, _ = os.path.splitext(old_filename)
+        new_key, _ = os.path.splitext(new_filename)
+        self.wildcard_store.rename(source_dir, old_key, new_filename)
+        if not isinstance(self._wildcards, WildcardView) and old_key in self._wildcards:
+            self._wildcards[new_key] = self._wildcards.pop(old_key)
+        self._rename_wildcard_indexes(old_key, new_key)
+
     def get_wildcard_options(self, wildcard_name: str) -> List[str]:
         """Get all sorted options for a given wildcard."""
         wildcard_data = self.wildcards.get(wildcard_name, {})
@@ -322,12 +1094,28 @@ class TemplateEngine:
         if not wildcard_data or 'choices' not in wildcard_data:
             return None
 
-        for choice in wildcard_data['choices']:
-            if isinstance(choice, str) and choice == value:
-                return choice
-            elif isinstance(choice, dict) and choice.get('value') == value:
-                return choice
-        return None
+        entry = self._value_indexes.get(wildcard_name)
+        if entry is None or entry[0] is not wildcard_data:
+            entry = (wildcard_data, self._build_value_index(wildcard_data['choices']))
+            self._value_indexes[wildcard_name] = entry
+
+        try:
+            return entry[1].get(value)
+        except TypeError:
+            return None # Unhashable values can never match a choice.
+
+    def _build_value_index(self, choices: List[Any]) -> Dict[Any, Any]:
+        """Maps each choice value to its choice object. The first choice wins for duplicate values."""
+        value_index: Dict[Any, Any] = {}
+        for choice in choices:
+            if isinstance(choice, str):
+                value_index.setdefault(choice, choice)
+            elif isinstance(choice, dict):
+                try:
+                    value_index.setdefault(choice.get('value'), choice)
+                except TypeError:
+                    continue # Malformed, unhashable value.
+        return value_index
 
     def _process_includes(self, choice_obj: Any, wildcard_data: Optional[Dict]) -> str:
         """
@@ -362,167 +1150,100 @@ class TemplateEngine:
         
         return ""
 
-    def _check_requirements(self, choice: Any, context: Optional[Dict[str, Any]]) -> bool:
-        """Checks if a given choice object meets the requirements of the current context."""
-        if not isinstance(choice, dict):
-            return True  # Simple string choices have no requirements.
-        
-        rules = choice.get('requires')
-        if not rules:
-            return True  # No 'requires' key means no requirements.
-        
-        # Pass the context to the rule checker. An empty context is valid.
-        return self._check_rules(rules, context or {})
-    def _get_wildcard_choice_object(self, key: str, context: Dict[str, Any] = None) -> Optional[Any]:
+    def _get_include_tokens(self, key: str, choice_obj: Any) -> Tuple[TemplateToken, ...]:
+        """
+        Returns the compiled include template of a chosen choice. Includes are static per choice,
+        so the expansion is done once and memoized on the wildcard's sampling index.
+        """
+        index = self._get_sampling_index(key)
+        if index is None:
+            return compile_template(self._process_includes(choice_obj, self.wildcards.get(key)))
+
+        if not isinstance(choice_obj, dict) or 'includes' not in choice_obj:
+            # The choice falls back to the wildcard-level includes, shared by all such choices.
+            if index.default_include_tokens is None:
+                index.default_include_tokens = compile_template(self._process_includes(None, index.source))
+            return index.default_include_tokens
+
+        tokens = index.include_tokens.get(id(choice_obj))
+        if tokens is None:
+            tokens = compile_template(self._process_includes(choice_obj, index.source))
+            index.include_tokens[id(choice_obj)] = tokens
+        return tokens
+
+    def _check_requirements(self, key: str, choice: Any, context: Optional[Dict[str, Any]]) -> bool:
+        """Checks if a given choice object of a wildcard meets the requirements of the current context."""
+        if not isinstance(choice, dict) or not choice.get('requires'):
+            return True  # Simple strings and choices without a 'requires' key have no requirements.
+
+        index = self._get_sampling_index(key)
+        requirement = index.requirements.get(id(choice)) if index is not None else None
+        if requirement is None:
+            requirement = CompiledRequirement(choice['requires'], self.tag_registry) # Not part of the loaded data.
+
+        # An empty context is valid.
+        return requirement.matches(context or {})
+
+    def _filter_valid_choices(self, index: _SamplingIndex, context: Optional[Dict[str, Any]]) -> List[Any]:
+        """Returns the choices of a wildcard that are valid in the context, in file order."""
+        if not index.conditional:
+            return index.choices # Every choice is valid.
+
+        valid = index.get_valid_conditional(context or {})
+        if valid.in_file_order is None:
+            valid_ids = {id(choice) for choice, _ in valid.pairs}
+            requirements = index.requirements
+            valid.in_file_order = [c for c in index.choices if id(c) not in requirements or id(c) in valid_ids]
+        return valid.in_file_order
+
+    def _get_wildcard_choice_object(self, key: str, context: Dict[str, Any], rng: random.Random, profile: Optional[WildcardProfile] = None) -> Optional[Any]:
         """Gets a random choice for a wildcard key, considering context."""
-        wildcard_data = self.wildcards.get(key)
-
-        if not wildcard_data or 'choices' not in wildcard_data:
-            return None
-
-        choices = wildcard_data['choices']
-        if not choices:
-            return None
-
-        # Filter choices based on requirements
-        valid_choices = [c for c in choices if self._check_requirements(c, context)]
-        if not valid_choices:
+        index = self._get_sampling_index(key)
+        if index is None or not index.choices:
             return None
 
-        # Calculate total weight
-        total_weight = 0
-        for choice in valid_choices:
-            if isinstance(choice, dict):
-                total_weight += choice.get('weight', 1)
+        # Only conditional choices need to be checked against the context.
+        if index.conditional:
+            if profile is None:
+                valid = index.get_valid_conditional(context or {})
             else:
-                total_weight += 1
+                start = perf_counter()
+                valid = index.get_valid_conditional(context or {})
+                profile.filter_seconds += perf_counter() - start
+                profile.rejected_choices += len(index.conditional) - len(valid.pairs)
+            valid_conditional, conditional_weight = valid.pairs, valid.weight
+        else:
+            valid_conditional, conditional_weight = [], 0
+        if not index.unconditional and not valid_conditional:
+            return None
 
         # Generate random number
-        r = self.rng.uniform(0, total_weight)
+        r = rng.uniform(0, index.unconditional_weight + conditional_weight)
+
+        # Select from the always-valid choices with a binary search over their cumulative weights.
+        if index.unconditional and (r <= index.unconditional_weight or not valid_conditional):
+            position = bisect_left(index.cumulative_weights, r)
+            return index.unconditional[min(position, len(index.unconditional) - 1)]
 
-        # Select choice based on weight
+        # Otherwise, walk the (small) list of conditional choices that passed.
+        r -= index.unconditional_weight
         current_weight = 0
-        for choice in valid_choices:
-            if isinstance(choice, dict):
-                current_weight += choice.get('weight', 1)
-            else:
-                current_weight += 1
+        for choice, weight in valid_conditional:
+            current_weight += weight
             if r <= current_weight:
                 return choice
 
-        return valid_choices[-1]  # Fallback
+        return valid_conditional[-1][0]  # Fallback
 
-    def _check_rules(self, rules: Dict[str, Any], context: Dict[str, Any]) -> bool:
-        """
-        Recursively checks if a set of rules is satisfied by the current context.
-        Supports logical operators 'and', 'or', 'not' for complex, nested conditions.
-        """
-        # Base case: empty rules are always true.
-        if not rules:
-            return True
-
-        # Handle logical operators for nested conditions
-        if 'and' in rules:
-            # 'and' must be a list of rule dictionaries
-            if not isinstance(rules['and'], list): return False
-            return all(self._check_rules(rule, context) for rule in rules['and'])
-        
-        if 'or' in rules:
-            # 'or' must be a list of rule dictionaries
-            if not isinstance(rules['or'], list): return False
-            return any(self._check_rules(rule, context) for rule in rules['or'])
-
-        if 'not' in rules:
-            # 'not' must be a single rule dictionary
-            if not isinstance(rules['not'], dict): return False
-            return not self._check_rules(rules['not'], context)
-
-        # If no logical operators, it's an implicit 'and' of all key-value pairs.
-        return self._check_single_rule_set(rules, context)
-
-    def _check_single_rule_set(self, rules: Dict[str, Any], context: Dict[str, Any]) -> bool:
-        """Checks a simple set of rules (an implicit AND) against the context."""
-        for key, condition in rules.items():
-            if key == 'tags':
-                # Delegate tag checking to its own robust method
-                if not self._check_tag_rules(condition, context):
-                    return False
-            else:
-                # It's a wildcard value check
-                if not self._check_value_condition(key, condition, context):
-                    return False
-        return True
-
-    def _check_value_condition(self, wildcard_name: str, condition: Any, context: Dict[str, Any]) -> bool:
-        """Checks if a single wildcard's value in the context matches a given condition."""
-        context_value = context.get(wildcard_name, {}).get('value')
-
-        if isinstance(condition, dict):
-            # Handle complex conditions like {"not": "value"} or {"any": [...]}
-            if 'any' in condition:
-                if not isinstance(condition.get('any'), list) or context_value not in condition['any']:
-                    return False
-            if 'not' in condition:
-                not_condition = condition['not']
-                if isinstance(not_condition, list):
-                    if context_value in not_condition:
-                        return False
-                elif context_value == not_condition:
-                    return False
-        elif isinstance(condition, list):
-            # "wildcard": ["value1", "value2"] means value must be one of them.
-            if context_value not in condition:
-                return False
-        else:
-            # "wildcard": "value" means an exact match is required.
-            if context_value != condition:
-                return False
-            
-        return True
-
-    def _check_tag_rules(self, tag_rules: Dict[str, Any], context: Dict[str, Any]) -> bool:
-        """
-        Checks tag-based rules against the context.
-        Supports 'any', 'all', and 'not' conditions.
-        """
-        if not isinstance(tag_rules, dict):
-            return False # Malformed tag rules
-
-        # Collect all tags from all previously resolved items in the context
-        all_context_tags = set()
-        for item in context.values():
-            if isinstance(item, dict) and 'tags' in item:
-                all_context_tags.update(item['tags'])
-
-        # Check 'any' condition: at least one of the specified tags must be present.
-        if 'any' in tag_rules:
-            required_tags = tag_rules['any']
-            if not isinstance(required_tags, list) or not any(tag in all_context_tags for tag in required_tags):
-                return False
-            
-        # Check 'all' condition: all of the specified tags must be present.
-        if 'all' in tag_rules:
-            required_tags = tag_rules['all']
-            if not isinstance(required_tags, list) or not all(tag in all_context_tags for tag in required_tags):
-                return False
-            
-        # Check 'not' condition: none of the specified tags should be present.
-        if 'not' in tag_rules:
-            forbidden_tags = tag_rules['not']
-            if isinstance(forbidden_tags, list):
-                if any(tag in all_context_tags for tag in forbidden_tags):
-                    return False
-            elif isinstance(forbidden_tags, str): # Support for a single tag string
-                 if forbidden_tags in all_context_tags:
-                    return False
-
-        return True
-
-    def _find_or_generate_choice(self, key: str, existing_choices_map: Dict[str, str], resolved_context: Dict[str, Any], force_swap: Optional[Dict[str, str]] = None, force_unique: bool = False) -> Tuple[Optional[Any], Optional[str]]:
+    def _find_or_generate_choice(self, key: str, generation: GenerationContext, force_unique: bool = False) -> Tuple[Optional[Any], Optional[str]]:
         """
         Finds an existing choice or generates a new one for a given wildcard key.
         Returns a tuple of (choice_object, choice_text).
         """
+        force_swap = generation.force_swap
+        resolved_context = generation.resolved
+        existing_choices_map = generation.preserved
+        profile = generation.profile_for(key) if generation.profiles is not None else None
         # Priority 0: A forced swap from the UI takes precedence over everything.
         if force_swap and key in force_swap:
             choice_text = force_swap[key]
@@ -544,43 +1265,44 @@ class TemplateEngine:
             
             # If a choice object was found, we must validate its 'requires' clause
             # against the current context, as dependencies may have changed.
-            if choice_obj:
-                is_still_valid = True
-                if isinstance(choice_obj, dict) and 'requires' in choice_obj:
-                    if not self._check_rules(choice_obj['requires'], resolved_context):
-                        is_still_valid = False
-                
-                if is_still_valid:
-                    return choice_obj, choice_text
+            if choice_obj and self._check_requirements(key, choice_obj, resolved_context):
+                return choice_obj, choice_text
+            if choice_obj and profile is not None:
+                profile.rejected_choices += 1 # Not when the value was simply removed from the file.
             # If the choice is no longer valid, fall through to generate a new one.
         
         # Priority 3: Generate a new choice.
-        choice_obj = self._get_wildcard_choice_object(key, resolved_context)
+        choice_obj = self._get_wildcard_choice_object(key, resolved_context, generation.rng, profile)
         if choice_obj:
             choice_text = choice_obj['value'] if isinstance(choice_obj, dict) else choice_obj
             return choice_obj, choice_text
 
         return None, None
 
-    def _get_multiple_wildcard_choices(self, key: str, count_min: int, count_max: Optional[int], context: Dict[str, Any]) -> str:
+    def _get_multiple_wildcard_choices(self, key: str, count_min: int, count_max: Optional[int], context: Dict[str, Any], rng: random.Random, profile: Optional[WildcardProfile] = None) -> str:
         """Gets multiple unique choices for a wildcard key, considering context."""
-        wildcard_data = self.wildcards.get(key)
-        if not wildcard_data or 'choices' not in wildcard_data:
+        index = self._get_sampling_index(key)
+        if index is None:
             return f"__ERROR:Wildcard '{key}' not found__"
 
-        choices = wildcard_data.get('choices', [])
-        if not choices:
+        if not index.choices:
             return ""
 
         # Filter choices based on requirements
-        valid_choices = [c for c in choices if self._check_requirements(c, context)]
+        if profile is None:
+            valid_choices = self._filter_valid_choices(index, context)
+        else:
+            start = perf_counter()
+            valid_choices = self._filter_valid_choices(index, context)
+            profile.filter_seconds += perf_counter() - start
+            profile.rejected_choices += len(index.choices) - len(valid_choices)
         if not valid_choices:
             return ""
 
         # Determine how many items to select
         num_to_select = count_min
         if count_max is not None and count_max > count_min:
-            num_to_select = self.rng.randint(count_min, count_max)
+            num_to_select = rng.randint(count_min, count_max)
         
         # Ensure we don't try to select more items than are available
         num_to_select = min(num_to_select, len(valid_choices))
@@ -588,7 +1310,7 @@ class TemplateEngine:
             return ""
 
         # Select unique choices
-        selected_choices_obj = self.rng.sample(valid_choices, num_to_select)
+        selected_choices_obj = rng.sample(valid_choices, num_to_select)
         
         # Extract the string value from each choice
         selected_values = [str(c.get('value') if isinstance(c, dict) else c) for c in selected_choices_obj]
@@ -596,59 +1318,82 @@ class TemplateEngine:
         # Join them into a single string
         return ", ".join(selected_values)
 
-    def _recursive_generate(self, template_string: str, parent_wildcard_name: Optional[str], resolved_context: Dict[str, Any], existing_choices_map: Dict[str, str], force_swap: Optional[Dict[str, str]], is_from_include: bool) -> List[PromptSegment]:
+    def _recursive_generate(self, template_string: str, parent_wildcard_name: Optional[str], is_from_include: bool, generation: GenerationContext) -> List[PromptSegment]:
         """Recursively generates segments, correctly attributing text to its parent wildcard."""
         segments: List[PromptSegment] = []
-        remaining_template = template_string
-
-        # Updated regex to handle __wildcard:N-M__ and __!wildcard__ syntax
-        wildcard_pattern = re.compile(r'__(!)?([a-zA-Z0-9_.\s-]+?)(?::(\d+)(?:-(\d+))?)?__')
-
-        while '__' in remaining_template:
-            match = wildcard_pattern.search(remaining_template)
-            if not match:
-                break
-
-            # Add any static text that came before the wildcard
-            prefix = remaining_template[:match.start()]
-            if prefix:
-                segments.append(PromptSegment(text=prefix, wildcard_name=parent_wildcard_name, is_from_include=is_from_include))
+        self._generate_from_tokens(compile_template(template_string), parent_wildcard_name, is_from_include, generation, segments)
+        return segments
 
-            force_unique_str, key, count_min_str, count_max_str = match.groups()
-            is_force_unique = force_unique_str == '!'
+    def _generate_from_tokens(self, tokens: Tuple[TemplateToken, ...], parent_wildcard_name: Optional[str], is_from_include: bool, generation: GenerationContext, segments: List[Any]) -> None:
+        """
+        Walks a compiled token list, appending the generated segments to `segments`.
+        With `generation.text_only`, plain strings are appended instead of PromptSegment objects.
+        """
+        resolved_context = generation.resolved
+        text_only = generation.text_only
+        profiling = generation.profiles is not None
+        for token in tokens:
+            kind = token.kind
+            if kind == TOKEN_LITERAL:
+                segments.append(token.text if text_only else _literal_segment(token.text, parent_wildcard_name, is_from_include))
+                continue
 
-            if count_min_str:
+            key = token.name
+            if kind == TOKEN_MULTI:
                 # --- Multi-selection logic ---
-                count_min = int(count_min_str)
-                count_max = int(count_max_str) if count_max_str else None
-                
-                multi_choice_text = self._get_multiple_wildcard_choices(key, count_min, count_max, resolved_context)
-                
+                if profiling:
+                    profile = generation.profile_for(key)
+                    profile.draws += 1
+                    profile.max_depth = max(profile.max_depth, generation.depth + 1)
+                    multi_choice_text = self._get_multiple_wildcard_choices(key, token.count_min, token.count_max, resolved_context, generation.rng, profile)
+                else:
+                    multi_choice_text = self._get_multiple_wildcard_choices(key, token.count_min, token.count_max, resolved_context, generation.rng)
+
                 # Multi-selections are treated as a single generated text block.
                 # They don't update the context for re-use and don't process sub-wildcards within their results.
                 if multi_choice_text:
-                    segments.append(PromptSegment(text=multi_choice_text, wildcard_name=key, is_from_include=True))
+                    segments.append(multi_choice_text if text_only else PromptSegment(text=multi_choice_text, wildcard_name=key, is_from_include=True))
+                continue
+
+            # --- Single selection logic ---
+            choice_obj, choice_text = self._find_or_generate_choice(key, generation, force_unique=(kind == TOKEN_UNIQUE))
+
+            if choice_obj:
+                tags = choice_obj.get('tags', []) if isinstance(choice_obj, dict) else []
+                resolved_context[key] = {'value': choice_text, 'tags': tags}
+
+                # Recursively process the choice's value and its includes
+                if not profiling:
+                    self._generate_from_tokens(compile_template(choice_text), key, True, generation, segments)
+                    self._generate_from_tokens(self._get_include_tokens(key, choice_obj), key, True, generation, segments)
+                    continue
+
+                profile = generation.profile_for(key)
+                profile.draws += 1
+                generation.depth += 1
+                profile.max_depth = max(profile.max_depth, generation.depth)
+                self._generate_from_tokens(compile_template(choice_text), key, True, generation, segments)
+                start = perf_counter()
+                self._generate_from_tokens(self._get_include_tokens(key, choice_obj), key, True, generation, segments)
+                profile.include_seconds += perf_counter() - start
+                generation.depth -= 1
             else:
-                # --- Single selection logic (existing behavior) ---
-                choice_obj, choice_text = self._find_or_generate_choice(key, existing_choices_map, resolved_context, force_swap, force_unique=is_force_unique)
-
-                if choice_obj:
-                    tags = choice_obj.get('tags', []) if isinstance(choice_obj, dict) else []
-                    resolved_context[key] = {'value': choice_text, 'tags': tags}
-                    
-                    # Recursively process the choice's value and its includes
-                    segments.extend(self._recursive_generate(choice_text, key, resolved_context, existing_choices_map, force_swap, True))
-                    include_text = self._process_includes(choice_obj, self.wildcards.get(key))
-                    segments.extend(self._recursive_generate(include_text, key, resolved_context, existing_choices_map, force_swap, True))
-                else:
-                    segments.append(PromptSegment(text=match.group(0), wildcard_name=key, is_from_include=is_from_include))
+                segments.append(token.text if text_only else _literal_segment(token.text, key, is_from_include))
 
-            remaining_template = remaining_template[match.end():]
+    def enable_profiling(self) -> GenerationProfiler:
+        """Starts recording per-wildcard generation costs, and returns the profiler that collects them."""
+        if self.profiler is None:
+            self.profiler = GenerationProfiler()
+        return self.profiler
 
-        if remaining_template:
-            segments.append(PromptSegment(text=remaining_template, wildcard_name=parent_wildcard_name, is_from_include=is_from_include))
+    def disable_profiling(self) -> None:
+        self.profiler = None
 
-        return segments
+    def _finish_generation(self, generation: GenerationContext) -> None:
+        """Hands the costs recorded by a generation to the profiler, if profiling is on."""
+        profiler = self.profiler
+        if generation.profiles is not None and profiler is not None:
+            profiler.merge(generation.profiles)
 
     def generate_structured_prompt(self, template: str, wildcards: Optional[Dict[str, Dict]] = None, 
                              existing_context: Optional[Dict[str, Any]] = None, 
@@ -664,28 +1409,129 @@ class TemplateEngine:
             seed = random.randint(0, 2**32 - 1)
             
         self.current_seed = seed
-        self.rng.seed(self.current_seed)
 
         # --- Context and Map Initialization ---
-        # The context_to_preserve starts as a deepcopy of the existing one to avoid modifying the original.
-        resolved_context: Dict[str, Any] = copy.deepcopy(existing_context) if existing_context else {}
-
-        # Handle rerolls and swaps by removing the keys from the context we're about to use.
-        if force_reroll:
-            for key in force_reroll:
-                resolved_context.pop(key, None)
+        # Rerolls and swaps are hidden by an overlay on the existing context, which is only read, never copied.
+        hidden_keys = set(force_reroll or ())
         if force_swap:
-            for key in force_swap:
-                resolved_context.pop(key, None)
-        
-        # The existing_choices_map is now built from the context. This map is used by
-        # _find_or_generate_choice to know which values to preserve.
-        existing_choices_map = {k: v['value'] for k, v in resolved_context.items()}
+            hidden_keys.update(force_swap)
+
+        # This view is used by _find_or_generate_choice to know which values to preserve.
+        existing_choices_map = PreservedChoices(existing_context, hidden_keys)
 
         # The context for the new run starts empty and gets populated by the recursive generation.
-        newly_resolved_context: Dict[str, Any] = {}
-        segments = self._recursive_generate(template, None, newly_resolved_context, existing_choices_map, force_swap, False)
-        return segments, newly_resolved_context
+        generation = GenerationContext(seed, existing_choices_map, force_swap, profile=self.profiler is not None)
+        segments = self._recursive_generate(template, None, False, generation)
+        self._finish_generation(generation)
+        return segments, generation.resolved
+
+    def generate_structured_prompt_incremental(self, template: str, state: IncrementalGenerationState,
+                                               existing_context: Optional[Dict[str, Any]] = None,
+                                               force_reroll: Optional[List[str]] = None,
+                                               force_swap: Optional[Dict[str, str]] = None,
+                                               seed: Optional[int] = None) -> Tuple[List[PromptSegment], Dict[str, Any]]:
+        """
+        Same result as generate_structured_prompt, but reuses the previous generation stored in `state`.
+        If the seed, the preserved choices, the swaps and the wildcard data are unchanged, the tokens before
+        the edited span are restored from a checkpoint, and the tokens after it are spliced back in as soon
+        as the rng and the context are in sync again. Editing literal text then costs O(edit).
+        """
+        if seed is None:
+            seed = random.randint(0, 2**32 - 1)
+        self.current_seed = seed
+
+        hidden_keys = set(force_reroll or ())
+        if force_swap:
+            hidden_keys.update(force_swap)
+        existing_choices_map = PreservedChoices(existing_context, hidden_keys)
+        generation = GenerationContext(seed, existing_choices_map, force_swap, profile=self.profiler is not None)
+        rng = generation.rng
+
+        inputs = (seed, dict(force_swap) if force_swap else None, dict(existing_choices_map), self.wildcards_version)
+        tokens = compile_template(template)
+        old_tokens = state.tokens
+
+        # Find the edited span as the tokens between the common prefix and the common suffix.
+        prefix = suffix = 0
+        if state.inputs == inputs:
+            limit = min(len(tokens), len(old_tokens))
+            while prefix < limit and tokens[prefix] == old_tokens[prefix]:
+                prefix += 1
+            while suffix < limit - prefix and tokens[-1 - suffix] == old_tokens[-1 - suffix]:
+                suffix += 1
+            rng.setstate(state.rng_states[prefix])
+            generation.resolved = state.contexts[prefix].copy()
+            segments = state.segments[:state.segment_counts[prefix]]
+            rng_states = state.rng_states[:prefix + 1]
+            contexts = state.contexts[:prefix + 1]
+            segment_counts = state.segment_counts[:prefix + 1]
+        else:
+            segments = []
+            rng_states = [rng.getstate()]
+            contexts = [ResolvedContext()]
+            segment_counts = [0]
+
+        offset = len(old_tokens) - len(tokens)
+        position = prefix
+        while position < len(tokens):
+            if position >= len(tokens) - suffix:
+                old_position = position + offset
+                old_context = state.contexts[old_position]
+                # The context must match in insertion order too, as the checkpoints are reused as they are.
+                if rng.getstate() == state.rng_states[old_position] and list(generation.resolved.items()) == list(old_context.items()):
+                    # Back in sync: the rest of the previous generation is still valid.
+                    shift = len(segments) - state.segment_counts[old_position]
+                    segments.extend(state.segments[state.segment_counts[old_position]:])
+                    rng_states.extend(state.rng_states[old_position + 1:])
+                    contexts.extend(state.contexts[old_position + 1:])
+                    segment_counts.extend(count + shift for count in state.segment_counts[old_position + 1:])
+                    rng.setstate(rng_states[-1])
+                    generation.resolved = contexts[-1].copy()
+                    break
+
+            token = tokens[position]
+            self._generate_from_tokens(tokens[position:position + 1], None, False, generation, segments)
+            if token.kind == TOKEN_LITERAL:
+                # Literals don't touch the rng or the context; share the previous checkpoint.
+                rng_states.append(rng_states[-1])
+                contexts.append(contexts[-1])
+            else:
+                rng_states.append(rng.getstate())
+                contexts.append(generation.resolved.copy())
+            segment_counts.append(len(segments))
+            position += 1
+
+        state.inputs = inputs
+        state.tokens = tokens
+        state.rng_states = rng_states
+        state.contexts = contexts
+        state.segment_counts = segment_counts
+        state.segments = segments
+        self._finish_generation(generation)
+        return list(segments), generation.resolved
+
+    def generate_batch(self, template: str, count: Optional[int], base_seed: Optional[int] = None,
+                       as_segments: bool = False, start_index: int = 0) -> Iterator[Union[str, List[PromptSegment]]]:
+        """
+        Lazily generates `count` fresh prompts from a template, or an endless stream if `count` is None.
+        Prompt `i` is generated with the seed `derive_prompt_seed(base_seed, i)`, so it is identical to
+        `generate_structured_prompt(template, seed=derive_prompt_seed(base_seed, i))`, and a batch can be
+        resumed or split up with `start_index`. Yields flat strings, or segment lists with `as_segments`.
+        """
+        if base_seed is None:
+            base_seed = random.randint(0, 2**32 - 1)
+
+        tokens = compile_template(template)
+        indices = itertools.count(start_index) if count is None else range(start_index, start_index + count)
+        for index in indices:
+            seed = derive_prompt_seed(base_seed, index)
+            self.current_seed = seed
+
+            output: List[Any] = []
+            generation = GenerationContext(seed, text_only=not as_segments, profile=self.profiler is not None)
+            self._generate_from_tokens(tokens, None, False, generation, output)
+            self._finish_generation(generation)
+            yield output if as_segments else "".join(output)
 
     def cleanup_prompt_string(self, prompt: str) -> str:
         """Cleans up a generated prompt string to fix common grammatical issues."""
@@ -0,0 +1,419 @@
+"""Exhaustive and stratified enumeration of the prompts a template can produce."""
+
+import math
+import random
+import sys
+from itertools import permutations, islice
+from typing import Dict, List, Optional, Any, Tuple, Iterator, FrozenSet, Union
+
+from .template_engine import (TemplateEngine, GenerationContext, ResolvedContext, TemplateToken, compile_template, derive_prompt_seed,
+                              TOKEN_LITERAL, TOKEN_WILDCARD, TOKEN_UNIQUE, TOKEN_MULTI)
+
+# Upper bound on the number of memoized counts, so counting huge spaces stays in bounded memory.
+ENUMERATION_MEMO_SIZE = 131072
+
+# Walked after the value and includes of every resolved wildcard. It emits nothing, but keeps the frames of a
+# nested resolution distinct from those of the resolution it ends, so the chain tracks the nesting depth.
+_RESOLUTION_END = (TemplateToken(TOKEN_LITERAL, ""),)
+
+# One way to take the next step of a walk:
+# (text to emit, (wildcard name, context entry) to resolve or None, id of the frame that follows or None).
+Alternative = Tuple[str, Optional[Tuple[str, Dict[str, Any]]], Optional[int]]
+
+def _allocate_quotas(weights: List[float], count: int) -> List[int]:
+    """Splits `count` in proportion to `weights` with the largest remainder method."""
+    total = sum(weights)
+    if count <= 0 or total <= 0:
+        return [0] * len(weights)
+    exact = [count * weight / total for weight in weights]
+    quotas = [int(share) for share in exact]
+    by_remainder = sorted(range(len(weights)), key=lambda i: exact[i] - quotas[i], reverse=True)
+    for i in by_remainder[:count - sum(quotas)]:
+        quotas[i] += 1
+    return quotas
+
+def _multi_sizes(token: TemplateToken, available: int) -> List[int]:
+    """The distinct numbers of items a multi-selection can pick from `available` valid choices."""
+    if token.count_max is not None and token.count_max > token.count_min:
+        requested = range(token.count_min, token.count_max + 1)
+    else:
+        requested = [token.count_min]
+    return sorted({min(count, available) for count in requested})
+
+def _choice_text_and_tags(choice_obj: Any) -> Tuple[str, List[str]]:
+    if isinstance(choice_obj, dict):
+        return choice_obj['value'], choice_obj.get('tags', [])
+    return choice_obj, []
+
+class _EnumerationWalk:
+    """
+    The state of one enumeration over the wildcard data as it is at the start of the call.
+    The work left to do is a chain of frames, each a (tokens, position, next frame) triple interned
+    to a small integer, so frames can be shared, compared and used in memo keys cheaply.
+    Nesting deeper than the recursion limit, as circular wildcards cause, raises RecursionError like generation.
+    """
+
+    def __init__(self, engine: TemplateEngine):
+        self.engine = engine
+        self.frames: List[Tuple[Tuple[TemplateToken, ...], int, Optional[int]]] = []
+        self._depths: List[int] = [] # Number of unfinished resolutions in the chain starting at each frame.
+        self._frame_ids: Dict[Tuple[int, int, Optional[int]], int] = {}
+        self._slices: Dict[Tuple[int, int, int], Tuple[TemplateToken, ...]] = {}
+        self._relevance: Dict[Optional[int], Tuple[Tuple[str, ...], FrozenSet[str], FrozenSet[str]]] = {None: ((), frozenset(), frozenset())}
+        self._writes: Dict[str, Tuple[FrozenSet[str], FrozenSet[str]]] = {}
+        self._reads: Dict[str, Tuple[FrozenSet[str], FrozenSet[str], FrozenSet[str]]] = {}
+        self._nests: Dict[str, bool] = {}
+        self._splits: Dict[int, Any] = {}
+        self._counts: Dict[Tuple[Any, ...], int] = {}
+
+    def frame(self, tokens: Tuple[TemplateToken, ...], position: int, rest: Optional[int]) -> Optional[int]:
+        """Returns the id of the frame walking `tokens` from `position` and then `rest`."""
+        if position >= len(tokens):
+            return rest
+        key = (id(tokens), position, rest)
+        frame_id = self._frame_ids.get(key)
+        if frame_id is None:
+            frame_id = len(self.frames)
+            self.frames.append((tokens, position, rest)) # Also keeps `tokens` alive, so its id stays unique.
+            self._depths.append((0 if rest is None else self._depths[rest]) + (tokens is _RESOLUTION_END))
+            self._frame_ids[key] = frame_id
+        return frame_id
+
+    def alternatives(self, frame_id: int, context: ResolvedContext) -> Iterator[Alternative]:
+        """Yields the possible next steps of the walk, mirroring TemplateEngine._generate_from_tokens."""
+        engine = self.engine
+        tokens, position, rest = self.frames[frame_id]
+        token = tokens[position]
+        after = self.frame(tokens, position + 1, rest)
+
+        if token.kind == TOKEN_LITERAL:
+            yield token.text, None, after
+            return
+
+        key = token.name
+        if token.kind == TOKEN_MULTI:
+            index = engine._get_sampling_index(key)
+            if index is None:
+                yield f"__ERROR:Wildcard '{key}' not found__", None, after
+                return
+            valid = engine._filter_valid_choices(index, context) if index.choices else []
+            # The engine joins rng.sample() output, so every ordering of a selection is a distinct prompt.
+            for size in _multi_sizes(token, len(valid)):
+                for selected in permutations(valid, size):
+                    yield ", ".join(str(c.get('value') if isinstance(c, dict) else c) for c in selected), None, after
+            return
+
+        if token.kind != TOKEN_UNIQUE and key in context:
+            # Reused within this prompt; the engine looks the choice up again by value.
+            candidates = [engine.find_choice_object_by_value(key, context[key]['value'])]
+        else:
+            index = engine._get_sampling_index(key)
+            candidates = engine._filter_valid_choices(index, context) if index is not None and index.choices else []
+            if not candidates:
+                candidates = [None]
+
+        for choice_obj in candidates:
+            if not choice_obj:
+                # Unresolvable wildcards are left in the prompt as they are.
+                yield token.text, None, after
+                continue
+            choice_text, tags = _choice_text_and_tags(choice_obj)
+            end = self.frame(_RESOLUTION_END, 0, after)
+            if self._depths[end] > sys.getrecursionlimit():
+                raise RecursionError(f"Wildcard '{key}' nests too deeply; check it for circular references")
+            nested = self.frame(compile_template(choice_text), 0, self.frame(engine._get_include_tokens(key, choice_obj), 0, end))
+            yield "", (key, {'value': choice_text, 'tags': tags}), nested
+
+    def count(self, frame_id: Optional[int], context: ResolvedContext) -> int:
+        """Counts the completions of a frame, memoized on the parts of the context it can still read."""
+        factor = 1
+        # Literals and multi-selections don't change the context, so they are walked without recursion.
+        while frame_id is not None:
+            tokens, position, rest = self.frames[frame_id]
+            token = tokens[position]
+            if token.kind == TOKEN_MULTI:
+                index = self.engine._get_sampling_index(token.name)
+                if index is not None:
+                    available = len(self.engine._filter_valid_choices(index, context)) if index.choices else 0
+                    factor *= sum(math.perm(available, size) for size in _multi_sizes(token, available))
+            elif token.kind != TOKEN_LITERAL:
+                break
+            frame_id = self.frame(tokens, position + 1, rest)
+        if frame_id is None or factor == 0:
+            return factor
+
+        # Count independent parts of the template separately and multiply.
+        split = self._split(frame_id)
+        if split is not None:
+            head, tail, head_keys, tail_tags = split
+            # A head that overwrites an entry also takes away its tags; only split if none of them matter later.
+            if not tail_tags or all(key not in context or tail_tags.isdisjoint(context[key]['tags']) for key in head_keys):
+                head_count = self.count(head, context)
+                return factor * head_count * self.count(tail, context) if head_count else 0
+
+        memo_key = (frame_id, self._signature(frame_id, context))
+        total = self._counts.get(memo_key)
+        if total is None:
+            total = 0
+            for _, resolution, rest in self.alternatives(frame_id, context):
+                if resolution is None:
+                    total += self.count(rest, context)
+                    continue
+                key, entry = resolution
+                previous = context.get(key)
+                context[key] = entry
+                total += self.count(rest, context)
+                if previous is None:
+                    del context[key]
+                else:
+                    context[key] = previous
+            if len(self._counts) >= ENUMERATION_MEMO_SIZE:
+                # Drop the oldest quarter; recent entries are the likeliest to be hit again.
+                for stale in list(islice(self._counts, ENUMERATION_MEMO_SIZE // 4)):
+                    del self._counts[stale]
+            self._counts[memo_key] = total
+        return factor * total
+
+    def _signature(self, frame_id: int, context: ResolvedContext) -> Tuple[Any, ...]:
+        """
+        The parts of the context that can influence the rest of the walk: which wildcards that may be reused
+        or overwritten are resolved, the values of those a 'requires' clause reads or whose reuse nests more
+        wildcards, and which of the referenced tags are set. Any other reuse adds one path whatever the value.
+        """
+        keys, tags, value_keys = self.relevance(frame_id)
+        values = tuple((context[key]['value'] if key in value_keys else True) if key in context else None for key in keys)
+        if not tags:
+            return values
+        relevant = set(keys)
+        own_tags, other_tags = [], set()
+        for key, entry in context.items():
+            entry_tags = [tag for tag in entry['tags'] if tag in tags]
+            if key in relevant:
+                own_tags.append((key, frozenset(entry_tags)))
+            else:
+                other_tags.update(entry_tags)
+        return values, frozenset(own_tags), frozenset(other_tags)
+
+    def _split(self, frame_id: int) -> Any:
+        """
+        Finds the shortest run of tokens at the start of a frame whose resolutions can't be read by the rest.
+        Returns (head frame, tail frame, keys the head may write, tags the tail may read), or None.
+        """
+        if frame_id in self._splits:
+            return self._splits[frame_id]
+
+        split = None
+        tokens, position, rest = self.frames[frame_id]
+        head_keys, head_tags = set(), set()
+        for end in range(position + 1, len(tokens) + 1):
+            token = tokens[end - 1]
+            if token.kind != TOKEN_LITERAL:
+                token_keys, token_tags = self._writes_of(token.name)
+                head_keys |= token_keys
+                head_tags |= token_tags
+            tail = self.frame(tokens, end, rest)
+            if tail is None:
+                break
+            tail_keys, tail_tags, _ = self.relevance(tail)
+            if head_keys.isdisjoint(tail_keys) and head_tags.isdisjoint(tail_tags):
+                slice_key = (id(tokens), position, end)
+                if slice_key not in self._slices:
+                    self._slices[slice_key] = tokens[position:end]
+                split = (self.frame(self._slices[slice_key], 0, None), tail, frozenset(head_keys), tail_tags)
+                break
+
+        self._splits[frame_id] = split
+        return split
+
+    def relevance(self, frame_id: Optional[int]) -> Tuple[Tuple[str, ...], FrozenSet[str], FrozenSet[str]]:
+        """
+        The sorted context keys and the tags that the rest of the walk from a frame may read,
+        and the subset of those keys whose values, not just their presence, can change the count.
+        """
+        cached = self._relevance.get(frame_id)
+        if cached is None:
+            tokens, position, rest = self.frames[frame_id]
+            rest_keys, rest_tags, rest_value_keys = self.relevance(rest)
+            keys, tags, value_keys = set(rest_keys), set(rest_tags), set(rest_value_keys)
+            for token in tokens[position:]:
+                if token.kind != TOKEN_LITERAL:
+                    token_keys, token_tags, token_value_keys = self._reads_of(token.name)
+                    keys |= token_keys
+                    tags |= token_tags
+                    value_keys |= token_value_keys
+            cached = (tuple(sorted(keys)), frozenset(tags), frozenset(value_keys))
+            self._relevance[frame_id] = cached
+        return cached
+
+    def _reachable(self, name: str) -> Tuple[set, List[Any]]:
+        """The sampling indexes of a wildcard and of every wildcard its choices and includes may nest."""
+        engine = self.engine
+        reachable, pending, indexes = {name}, [name], []
+        while pending:
+            current = pending.pop()
+            index = engine._get_sampling_index(current)
+            if index is None:
+                continue
+            indexes.append(index)
+            for choice in index.choices:
+                choice_text = choice.get('value') if isinstance(choice, dict) else choice
+                nested = compile_template(choice_text) if isinstance(choice_text, str) else ()
+                for token in nested + engine._get_include_tokens(current, choice):
+                    if token.kind != TOKEN_LITERAL and token.name not in reachable:
+                        reachable.add(token.name)
+                        pending.append(token.name)
+        return reachable, indexes
+
+    def _reads_of(self, name: str) -> Tuple[FrozenSet[str], FrozenSet[str], FrozenSet[str]]:
+        """
+        The context keys and tags that resolving wildcard `name`, including everything it nests, may read,
+        and the keys among them whose values are read: by a 'requires' clause, or by a reuse that nests.
+        """
+        cached = self._reads.get(name)
+        if cached is None:
+            reachable, indexes = self._reachable(name)
+            keys, tags = set(reachable), set()
+            value_keys = {key for key in reachable if self._nests_wildcards(key)}
+            for index in indexes:
+                keys.update(index.signature_keys)
+                value_keys.update(index.signature_keys)
+                if index.uses_tags:
+                    tags.update(index.signature_tags)
+            cached = (frozenset(keys), frozenset(tags), frozenset(value_keys))
+            self._reads[name] = cached
+        return cached
+
+    def _nests_wildcards(self, name: str) -> bool:
+        """Whether any choice of wildcard `name` has wildcards in its value or includes."""
+        nests = self._nests.get(name)
+        if nests is None:
+            nests = False
+            index = self.engine._get_sampling_index(name)
+            for choice in index.choices if index is not None else ():
+                choice_text = choice.get('value') if isinstance(choice, dict) else choice
+                nested = compile_template(choice_text) if isinstance(choice_text, str) else ()
+                if any(token.kind != TOKEN_LITERAL for token in nested + self.engine._get_include_tokens(name, choice)):
+                    nests = True
+                    break
+            self._nests[name] = nests
+        return nests
+
+    def _writes_of(self, name: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        """The context keys and tags that resolving wildcard `name`, including everything it nests, may set."""
+        cached = self._writes.get(name)
+        if cached is None:
+            reachable, indexes = self._reachable(name)
+            tags = set()
+            for index in indexes:
+                for choice in index.choices:
+                    if isinstance(choice, dict):
+                        tags.update(choice.get('tags', []))
+            cached = (frozenset(reachable), frozenset(tags))
+            self._writes[name] = cached
+        return cached
+
+class TemplateEnumerator:
+    """
+    Walks the whole space of prompts a template can produce with an engine's wildcards.
+    A prompt is one combination of decisions: a choice for every wildcard that gets resolved and an
+    ordered selection for every multi-selection, as the engine joins its picks in the order drawn.
+    Weights don't matter here, but 'requires', reuse of resolved wildcards and '__!name__' rerolls
+    behave exactly as in generation.
+    """
+
+    def __init__(self, engine: TemplateEngine):
+        self.engine = engine
+
+    def count(self, template: str) -> int:
+        """
+        Returns the exact number of distinct decision combinations the template can produce.
+        Parts of the template that can't influence each other are counted separately, and each part is
+        memoized on just the context entries and tags it can read, so spaces in the billions count quickly.
+        """
+        walk = _EnumerationWalk(self.engine)
+        return walk.count(walk.frame(compile_template(template), 0, None), ResolvedContext())
+
+    def iterate(self, template: str, with_choices: bool = False) -> Iterator[Union[str, Tuple[str, Dict[str, str]]]]:
+        """
+        Lazily yields every prompt of the template, depth-first in file order of the choices.
+        Memory is bounded by the nesting depth of the template, not by the size of the space.
+        Raises RecursionError, as generation does, if circular wildcards nest without end.
+        With `with_choices`, yields (prompt, {wildcard: value}) pairs instead of plain prompts.
+        """
+        walk = _EnumerationWalk(self.engine)
+        context = ResolvedContext()
+        pieces: List[str] = []
+        undo_log: List[Tuple[str, Any]] = [] # (wildcard name, previous context entry or None)
+
+        start = walk.frame(compile_template(template), 0, None)
+        if start is None:
+            yield ("", {}) if with_choices else ""
+            return
+        stack = [(walk.alternatives(start, context), 0, 0)]
+
+        while stack:
+            alternatives, piece_mark, undo_mark = stack[-1]
+            # Undo whatever the previously taken alternative of this step did.
+            del pieces[piece_mark:]
+            while len(undo_log) > undo_mark:
+                key, previous = undo_log.pop()
+                if previous is None:
+                    del context[key]
+                else:
+                    context[key] = previous
+
+            alternative = next(alternatives, None)
+            if alternative is None:
+                stack.pop()
+                continue
+
+            text, resolution, rest = alternative
+            if text:
+                pieces.append(text)
+            if resolution is not None:
+                key, entry = resolution
+                undo_log.append((key, context.get(key)))
+                context[key] = entry
+
+            if rest is None:
+                prompt = "".join(pieces)
+                yield (prompt, {key: entry['value'] for key, entry in context.items()}) if with_choices else prompt
+            else:
+                stack.append((walk.alternatives(rest, context), len(pieces), len(undo_log)))
+
+    def stratified_sample(self, template: str, count: int, strata: Optional[List[str]] = None,
+                          base_seed: Optional[int] = None) -> Iterator[str]:
+        """
+        Yields `count` prompts in which every choice of each wildcard in `strata` appears in proportion
+        to its weight, instead of only in expectation. Each stratum's choices are dealt out with exact
+        quotas and shuffled independently (Latin hypercube style); everything else is drawn randomly.
+        A dealt choice is kept only if its 'requires' clause allows it, as with preserved choices.
+        Defaults to stratifying every wildcard that appears at the top level of the template. '__!name__'
+        rerolls always draw afresh, so they are left out of the defaults and stay random in any case.
+        """
+        engine = self.engine
+        if base_seed is None:
+            base_seed = random.randint(0, 2**32 - 1)
+        tokens = compile_template(template)
+        if strata is None:
+            strata = list(dict.fromkeys(token.name for token in tokens if token.kind == TOKEN_WILDCARD))
+
+        shuffler = random.Random(base_seed)
+        dealt: Dict[str, List[str]] = {}
+        for name in strata:
+            index = engine._get_sampling_index(name)
+            if index is None or not index.choices:
+                continue
+            values: List[str] = []
+            weights = [float(choice.get('weight', 1)) if isinstance(choice, dict) else 1.0 for choice in index.choices]
+            for choice, quota in zip(index.choices, _allocate_quotas(weights, count)):
+                values.extend([_choice_text_and_tags(choice)[0]] * quota)
+            shuffler.shuffle(values)
+            dealt[name] = values
+
+        for i in range(count):
+            preserved = {name: values[i] for name, values in dealt.items()}
+            generation = GenerationContext(derive_prompt_seed(base_seed, i), preserved, text_only=True)
+            output: List[str] = []
+            engine._generate_from_tokens(tokens, None, False, generation, output)
+            yield "".join(output)
@@ -4,6 +4,7 @@ Core utility functions shared across the application's backend logic.
 
 from typing import List, Dict, Any, Optional
 import json
+import sys
 
 def _clean_string(s: Any, replace_underscores: bool = True) -> str:
     """Helper to clean a string value by stripping whitespace and optionally replacing underscores."""
@@ -122,4 +123,48 @@ def sanitize_wildcard_choices(choices: List[Any]) -> List[Any]:
             # Keep other malformed items (e.g., numbers) as-is
             cleaned_choices.append(choice)
             
-    return cleaned_choices
\ No newline at end of file
+    return cleaned_choices
+
+
+def _intern_rules(rules: Any) -> Any:
+    """Returns a copy of a 'requires' rule tree with its keys and string values interned."""
+    if isinstance(rules, dict):
+        return {sys.intern(key) if isinstance(key, str) else key: _intern_rules(value) for key, value in rules.items()}
+    if isinstance(rules, list):
+        return [_intern_rules(value) for value in rules]
+    if isinstance(rules, str):
+        return sys.intern(rules)
+    return rules
+
+def _intern_includes(includes: Any) -> Any:
+    if isinstance(includes, list):
+        return [sys.intern(name) if isinstance(name, str) else name for name in includes]
+    if isinstance(includes, str):
+        return sys.intern(includes)
+    return includes
+
+def intern_wildcard_data(data: Any) -> Any:
+    """
+    Interns the names, tags, values and 'requires' contents of loaded wildcard data in place,
+    so equal strings across all wildcard files share one object. Returns the data.
+    """
+    if not isinstance(data, dict):
+        return data
+    if 'includes' in data:
+        data['includes'] = _intern_includes(data['includes'])
+    choices = data.get('choices')
+    if not isinstance(choices, list):
+        return data
+    for i, choice in enumerate(choices):
+        if isinstance(choice, str):
+            choices[i] = sys.intern(choice)
+        elif isinstance(choice, dict):
+            if isinstance(choice.get('value'), str):
+                choice['value'] = sys.intern(choice['value'])
+            if isinstance(choice.get('tags'), list):
+                choice['tags'] = [sys.intern(tag) if isinstance(tag, str) else tag for tag in choice['tags']]
+            if 'includes' in choice:
+                choice['includes'] = _intern_includes(choice['includes'])
+            if 'requires' in choice:
+                choice['requires'] = _intern_rules(choice['requires'])
+    return data
@@ -0,0 +1,120 @@
+"""On-disk cache of parsed wildcard files, with one small binary entry per file."""
+
+import os
+import sys
+import marshal
+import struct
+import hashlib
+import tempfile
+from typing import Dict, Any, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .wildcard_store import WildcardFile
+
+# Bump whenever the entry layout or the parsed form of wildcard files changes.
+CACHE_FORMAT_VERSION = 2
+
+# marshal's format is only guaranteed to be stable within one Python version.
+_CACHE_VERSION = (CACHE_FORMAT_VERSION, marshal.version, tuple(sys.version_info[:2]))
+_ENTRY_EXT = '.bin'
+# Entries start with the length of their header, so it can be checked without unmarshalling the data.
+_HEADER_LENGTH = struct.Struct('<I')
+
+def content_digest(content: bytes) -> bytes:
+    """The hash of a wildcard file's contents, used to recognize files that were only touched."""
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+class WildcardCache:
+    """
+    Keeps the parsed data of each wildcard file in its own entry, named after a hash of the
+    file's path and stamped with its modification time, size and content hash. A hit skips reading
+    and parsing the file; only entries of changed files are ever rewritten, each atomically.
+    Entries from another cache format or Python version, or that fail to load, count as misses
+    and are rebuilt.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.enabled = True # Turned off after a failed write, so a read-only location isn't retried for every file.
+
+    def _entry_path(self, source_path: str) -> str:
+        digest = hashlib.blake2b(os.path.abspath(source_path).encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, digest + _ENTRY_EXT)
+
+    def get(self, file_info: 'WildcardFile') -> Optional[Dict[str, Any]]:
+        """Returns the cached data of a file, or None if there is no up-to-date entry."""
+        try:
+            # Read at once: marshal.load() on a file object is several times slower than loads().
+            with open(self._entry_path(file_info.path), 'rb') as f:
+                entry = memoryview(f.read())
+            data_start = _HEADER_LENGTH.size + _HEADER_LENGTH.unpack_from(entry)[0]
+            version, path, mtime, size, digest = marshal.loads(entry[_HEADER_LENGTH.size:data_start])
+            if version != _CACHE_VERSION or path != file_info.path or size != file_info.size:
+                return None
+            if mtime != file_info.mtime:
+                # Only touched (e.g. by a sync tool or a checkout) if the contents are the same;
+                # then the entry is kept and just its header is updated.
+                with open(file_info.path, 'rb') as f:
+                    if content_digest(f.read()) != digest:
+                        return None
+                self._write(file_info, digest, entry[data_start:])
+            data = marshal.loads(entry[data_start:])
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, TypeError, struct.error):
+            return None # Unreadable or corrupted; the file is parsed again and the entry rewritten.
+        return data if isinstance(data, dict) else None
+
+    def put(self, file_info: 'WildcardFile', digest: bytes, data: Dict[str, Any]) -> None:
+        """Writes the entry of a freshly parsed file, given the content_digest() of its contents."""
+        try:
+            self._write(file_info, digest, marshal.dumps(data))
+        except ValueError:
+            return # Data that marshal can't store (never the case for parsed JSON); just don't cache it.
+
+    def _write(self, file_info: 'WildcardFile', digest: bytes, marshalled_data: bytes) -> None:
+        """
+        Writes an entry to a temporary file and moves it into place, so a crash or a concurrent
+        reader never sees a partial entry.
+        """
+        if not self.enabled:
+            return
+        header = marshal.dumps((_CACHE_VERSION, file_info.path, file_info.mtime, file_info.size, digest))
+        temp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER_LENGTH.pack(len(header)))
+                f.write(header)
+                f.write(marshalled_data)
+            os.replace(temp_path, self._entry_path(file_info.path))
+        except OSError as e:
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            self.enabled = False
+            print(f"Warning: Could not write wildcard cache, caching is disabled for this session: {e}")
+
+    def discard(self, source_path: str) -> None:
+        """Removes the entry of a file that was moved, renamed or deleted."""
+        try:
+            os.remove(self._entry_path(source_path))
+        except OSError:
+            pass
+
+    def clear(self) -> bool:
+        """Removes every entry. Returns False if some could not be removed."""
+        if not os.path.isdir(self.cache_dir):
+            return True
+        success = True
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith((_ENTRY_EXT, '.tmp')):
+                try:
+                    os.remove(os.path.join(self.cache_dir, filename))
+                except OSError as e:
+                    print(f"Warning: Could not delete wildcard cache entry {filename}: {e}")
+                    success = False
+        return success
@@ -0,0 +1,428 @@
+"""
+Lazily loaded wildcard data, shared between workflows. The wildcard directories are only indexed
+up front (names, paths and modification times); each file is read and parsed the first time its
+wildcard is accessed, through any view.
+"""
+
+import os
+import sys
+import json
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict, List, Optional, Any, Iterator, Set, Tuple
+
+from .utils import intern_wildcard_data
+from .wildcard_cache import WildcardCache, content_digest
+from .dir_snapshot import DirectorySnapshot, DirectorySnapshotCache
+
+WILDCARD_EXTENSIONS = ('.txt', '.json')
+
+# Threads reading files during a preload. Reads dominate, especially on network storage.
+PRELOAD_THREADS = min(32, (os.cpu_count() or 1) + 4)
+# With preload(processes=N), files at least this large are parsed in worker processes, where
+# parsing runs in parallel; smaller files aren't worth sending there and back.
+PROCESS_PARSE_MIN_BYTES = 256 * 1024
+
+class WildcardFile:
+    """The file on disk that provides a wildcard."""
+    __slots__ = ('path', 'filename', 'ext', 'mtime', 'size')
+
+    def __init__(self, path: str, filename: str, ext: str, mtime: float, size: int):
+        self.path = path
+        self.filename = filename
+        self.ext = ext
+        self.mtime = mtime
+        self.size = size
+
+def scan_wildcard_dir(snapshot: DirectorySnapshot) -> Dict[str, WildcardFile]:
+    """
+    Indexes the wildcard files of one directory's snapshot without reading them.
+    Returns {basename: WildcardFile}, preferring a .json file over a .txt file of the same name.
+    """
+    found_files: Dict[str, WildcardFile] = {}
+    for filename in snapshot.names(WILDCARD_EXTENSIONS):
+        basename, ext = os.path.splitext(filename)
+        existing = found_files.get(basename)
+        if existing is None or (ext == '.json' and existing.ext == '.txt'):
+            file_stat = snapshot.files[filename]
+            found_files[sys.intern(basename)] = WildcardFile(file_stat.path, filename, ext, file_stat.mtime, file_stat.size)
+    return found_files
+
+def read_wildcard_file(path: str) -> Dict[str, Any]:
+    """Reads and parses one wildcard file. Legacy .txt files become a wildcard with one choice per line."""
+    with open(path, 'rb') as f:
+        return parse_wildcard_content(path, f.read())
+
+def parse_wildcard_content(path: str, content: bytes) -> Dict[str, Any]:
+    """Parses the raw contents of the wildcard file at `path`, as read_wildcard_file() does."""
+    # Same newline handling as a file opened in text mode.
+    text = content.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    if path.endswith('.json'):
+        return json.loads(text)
+    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    return {"description": f"Legacy wildcard from {os.path.basename(path)}.", "choices": lines}
+
+def _parse_in_worker(path: str, content: bytes) -> Dict[str, Any]:
+    """Runs in a worker process of preload(). Strings are interned by the parent, where they are used."""
+    return parse_wildcard_content(path, content)
+
+class WildcardStore:
+    """
+    The wildcard files of every directory, keyed by (directory, basename) and parsed at most once.
+    Workflows read it through views that layer their directories, so data shared between the
+    SFW and NSFW workflows is held once and switching workflows doesn't re-read anything.
+    Files may be loaded from several generating threads at once; what loading records is guarded
+    by a lock. Rescans and put/remove/rename run on the thread that owns the engine.
+    """
+
+    def __init__(self, cache: Optional[WildcardCache] = None, snapshots: Optional[DirectorySnapshotCache] = None):
+        self.cache = cache # Parsed files persisted across sessions, if given.
+        self.snapshots = snapshots if snapshots is not None else DirectorySnapshotCache()
+        # {directory: {basename: WildcardFile}}, from the last scan of each directory. The inner dicts
+        # are replaced rather than changed in place, so they can be read while another thread updates them.
+        self._dirs: Dict[str, Dict[str, WildcardFile]] = {}
+        # {(directory, basename): wildcard_data} for the files parsed so far.
+        self._data: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # The files that failed to parse. They stay listed, so they can be opened and fixed,
+        # but provide no wildcard until they change.
+        self._failed: Set[Tuple[str, str]] = set()
+        self._views: Dict[Tuple[str, ...], 'WildcardView'] = {}
+        self._lock = threading.Lock() # Guards _data, _failed and version against concurrent loads.
+        # Bumped whenever files are added, removed or replaced, so views re-resolve their names.
+        self.version = 0
+
+    def refresh(self, wildcard_dirs: List[str]) -> None:
+        """
+        Rescans directories. Parsed data is kept for every file whose path, modification time and
+        size are unchanged; changed files are parsed again on their next access.
+        """
+        for wildcard_dir in wildcard_dirs:
+            old_files = self._dirs.get(wildcard_dir)
+            new_files = scan_wildcard_dir(self.snapshots.refresh(wildcard_dir))
+            changed = old_files is None or old_files.keys() != new_files.keys()
+            for basename, old_file in (old_files or {}).items():
+                new_file = new_files.get(basename)
+                if new_file is None or new_file.path != old_file.path or new_file.mtime != old_file.mtime or new_file.size != old_file.size:
+                    self._data.pop((wildcard_dir, basename), None)
+                    self._failed.discard((wildcard_dir, basename))
+                    changed = True
+                    if (new_file is None or new_file.path != old_file.path) and self.cache is not None:
+                        self.cache.discard(old_file.path) # Deleted, or replaced by a file of another type.
+            self._dirs[wildcard_dir] = new_files
+            if changed:
+                self.version += 1
+
+    def refresh_file(self, wildcard_dir: str, filename: str) -> Optional[str]:
+        """
+        Rescans the files of one wildcard in a directory that was already scanned, after a change
+        to `filename`. Returns the wildcard's name if its file or contents changed, otherwise None
+        (e.g. for a change that was already recorded by put()).
+        """
+        basename, ext = os.path.splitext(filename)
+        files = self._dirs.get(wildcard_dir)
+        if files is None or ext not in WILDCARD_EXTENSIONS:
+            return None
+        new_file = None
+        for candidate_ext in ('.json', '.txt'):
+            path = os.path.join(wildcard_dir, basename + candidate_ext)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            new_file = WildcardFile(path, basename + candidate_ext, candidate_ext, stat.st_mtime, stat.st_size)
+            break
+
+        old_file = files.get(basename)
+        if old_file is None and new_file is None:
+            return None
+        if old_file is not None and new_file is not None and (old_file.path, old_file.mtime, old_file.size) == (new_file.path, new_file.mtime, new_file.size):
+            return None
+        self._data.pop((wildcard_dir, basename), None)
+        if (wildcard_dir, basename) in self._failed:
+            self._failed.discard((wildcard_dir, basename))
+            self.version += 1 # It may provide its wildcard again.
+        if old_file is not None and (new_file is None or new_file.path != old_file.path) and self.cache is not None:
+            self.cache.discard(old_file.path) # Deleted, or replaced by a file of another type.
+        files = dict(files)
+        if new_file is None:
+            files.pop(basename, None)
+        else:
+            files[sys.intern(basename)] = new_file
+        self._dirs[wildcard_dir] = files
+        if old_file is None or new_file is None or old_file.path != new_file.path:
+            self.version += 1 # The set of files changed, not just a file's contents.
+        return basename
+
+    def view(self, wildcard_dirs: List[str]) -> 'WildcardView':
+        """
+        Returns the (shared) view of a list of directories, later directories overriding earlier ones.
+        Directories that were never scanned are scanned first.
+        """
+        unscanned = [wildcard_dir for wildcard_dir in wildcard_dirs if wildcard_dir not in self._dirs]
+        if unscanned:
+            self.refresh(unscanned)
+        key = tuple(wildcard_dirs)
+        view = self._views.get(key)
+        if view is None:
+            view = self._views[key] = WildcardView(self, key)
+        return view
+
+    def resolve(self, wildcard_dirs: Tuple[str, ...]) -> Dict[str, Tuple[str, str]]:
+        """
+        Returns {basename: (directory, basename)} for the files visible through a list of directories.
+        A .json file wins over a .txt file, and later directories override earlier ones.
+        Files that failed to parse are included; see is_failed().
+        """
+        resolved: Dict[str, Tuple[str, str]] = {}
+        extensions: Dict[str, str] = {}
+        for wildcard_dir in wildcard_dirs:
+            for basename, file_info in self._dirs.get(wildcard_dir, {}).items():
+                ext = extensions.get(basename)
+                if ext is None or (file_info.ext == '.json' and ext == '.txt') or file_info.ext == ext:
+                    resolved[basename] = (wildcard_dir, basename)
+                    extensions[basename] = file_info.ext
+        return resolved
+
+    def file_info(self, key: Tuple[str, str]) -> Optional[WildcardFile]:
+        return self._dirs.get(key[0], {}).get(key[1])
+
+    def load(self, key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+        """
+        Returns the data of a file, parsing it (or reading it from the cache) on first access.
+        Returns None for a file that fails to parse, without trying again until it changes.
+        """
+        data = self._data.get(key)
+        if data is not None:
+            return data
+        file_info = self.file_info(key)
+        if file_info is None or key in self._failed:
+            return None
+
+        try:
+            data, content = self._read(file_info)
+            if data is None:
+                data = intern_wildcard_data(parse_wildcard_content(file_info.path, content))
+        except Exception as e:
+            return self._store(key, file_info, None, None, e)
+        return self._store(key, file_info, data, content)
+
+    def _read(self, file_info: WildcardFile) -> Tuple[Optional[Dict[str, Any]], Optional[bytes]]:
+        """Returns (cached_data, None) on a cache hit, otherwise (None, the file's contents)."""
+        # Cached data is stored interned, and marshal interns those strings again when reading them.
+        data = self.cache.get(file_info) if self.cache is not None else None
+        if data is not None:
+            return data, None
+        with open(file_info.path, 'rb') as f:
+            return None, f.read()
+
+    def _store(self, key: Tuple[str, str], file_info: WildcardFile, data: Optional[Dict[str, Any]],
+               content: Optional[bytes], error: Optional[Exception] = None) -> Optional[Dict[str, Any]]:
+        """Records the outcome of loading a file: its data, caching it if it was parsed, or its error."""
+        if error is not None:
+            print(f"Error loading or parsing wildcard file {file_info.path}: {error}")
+            with self._lock:
+                self._failed.add(key)
+                self.version += 1
+            return None
+        if content is not None and self.cache is not None:
+            self.cache.put(file_info, content_digest(content), data)
+        # Concurrent first accesses may both parse the file; all of them get the data recorded first.
+        with self._lock:
+            return self._data.setdefault(key, data)
+
+    def preload(self, wildcard_dirs: Tuple[str, ...], processes: int = 0) -> None:
+        """
+        Loads every file visible through a list of directories that isn't loaded yet. Files are read
+        in a thread pool and parsed as they arrive; with `processes`, large files are parsed in that
+        many worker processes instead. Results are recorded in a fixed order, and overrides are
+        resolved from the directory index, so the outcome is the same as loading the files one by one.
+        """
+        pending = sorted((key, self.file_info(key)) for key in self.resolve(wildcard_dirs).values() if key not in self._data and key not in self._failed)
+        if len(pending) < 2:
+            for key, _ in pending:
+                self.load(key)
+            return
+
+        def read(file_info: WildcardFile) -> Tuple[Optional[Dict[str, Any]], Optional[bytes], Optional[Exception]]:
+            try:
+                return self._read(file_info) + (None,)
+            except Exception as e:
+                return None, None, e
+
+        # Parsing holds the GIL, so it is done here rather than in the reading threads.
+        process_pool = None
+        in_processes = []
+        try:
+            with ThreadPoolExecutor(max_workers=min(PRELOAD_THREADS, len(pending)), thread_name_prefix="WildcardPreload") as pool:
+                for (key, file_info), (data, content, error) in zip(pending, pool.map(read, [file_info for _, file_info in pending])):
+                    if error is None and data is None:
+                        if processes > 0 and len(content) >= PROCESS_PARSE_MIN_BYTES:
+                            if process_pool is None:
+                                process_pool = ProcessPoolExecutor(max_workers=processes)
+                            in_processes.append((key, file_info, content, process_pool.submit(_parse_in_worker, file_info.path, content)))
+                            continue
+                        try:
+                            data = intern_wildcard_data(parse_wildcard_content(file_info.path, content))
+                        except Exception as e:
+                            error = e
+                    if key not in self._data: # Unless loaded by another thread in the meantime.
+                        self._store(key, file_info, data, content, error)
+
+            for key, file_info, content, future in in_processes:
+                try:
+                    data, error = intern_wildcard_data(future.result()), None
+                except Exception as e:
+                    data, error = None, e
+                if key not in self._data:
+                    self._store(key, file_info, data, content, error)
+        finally:
+            if process_pool is not None:
+                process_pool.shutdown()
+
+    def clear_parsed(self) -> None:
+        """Forgets all parsed data, so every file is read again on its next access."""
+        with self._lock:
+            self._data.clear()
+            self.version += 1
+
+    def is_loaded(self, key: Tuple[str, str]) -> bool:
+        return key in self._data
+
+    def is_failed(self, key: Tuple[str, str]) -> bool:
+        """Whether a file failed to parse (and hasn't changed since)."""
+        return key in self._failed
+
+    def put(self, wildcard_dir: str, filename: str, data: Dict[str, Any]) -> None:
+        """Records a file that was just written, with its already parsed data."""
+        self.snapshots.invalidate(wildcard_dir)
+        if wildcard_dir not in self._dirs:
+            # Index the whole directory; an index of just this file would hide the others from views.
+            self.refresh([wildcard_dir])
+        basename, ext = os.path.splitext(filename)
+        path = os.path.join(wildcard_dir, filename)
+        files = dict(self._dirs.get(wildcard_dir, {}))
+        existing = files.get(basename)
+        if existing is None or existing.path != path or (wildcard_dir, basename) in self._failed:
+            self._failed.discard((wildcard_dir, basename))
+            self.version += 1
+        stat = os.stat(path)
+        file_info = files[sys.intern(basename)] = WildcardFile(path, filename, ext, stat.st_mtime, stat.st_size)
+        self._dirs[wildcard_dir] = files
+        self._data[(wildcard_dir, basename)] = data
+        if self.cache is not None:
+            with open(path, 'rb') as f:
+                self.cache.put(file_info, content_digest(f.read()), data)
+
+    def remove(self, wildcard_dir: str, basename: str) -> None:
+        """Forgets a file that was moved out of its directory."""
+        self.snapshots.invalidate(wildcard_dir)
+        files = dict(self._dirs.get(wildcard_dir, {}))
+        file_info = files.pop(basename, None)
+        if file_info is not None:
+            self._dirs[wildcard_dir] = files
+            self.version += 1
+            if self.cache is not None:
+                self.cache.discard(file_info.path)
+        self._data.pop((wildcard_dir, basename), None)
+        self._failed.discard((wildcard_dir, basename))
+
+    def rename(self, wildcard_dir: str, old_basename: str, new_filename: str) -> None:
+        """Moves a renamed file's entry, and its parsed data, to the new name."""
+        self.snapshots.invalidate(wildcard_dir)
+        files = dict(self._dirs.get(wildcard_dir, {}))
+        old_file = files.pop(old_basename, None)
+        data = self._data.pop((wildcard_dir, old_basename), None)
+        failed = (wildcard_dir, old_basename) in self._failed
+        self._failed.discard((wildcard_dir, old_basename))
+        if old_file is None:
+            return
+        if self.cache is not None:
+            self.cache.discard(old_file.path)
+        new_basename, ext = os.path.splitext(new_filename)
+        new_basename = sys.intern(new_basename)
+        files[new_basename] = WildcardFile(os.path.join(wildcard_dir, new_filename), new_filename, ext, old_file.mtime, old_file.size)
+        self._dirs[wildcard_dir] = files
+        if data is not None:
+            self._data[(wildcard_dir, new_basename)] = data
+        elif failed:
+            self._failed.add((wildcard_dir, new_basename))
+        self.version += 1
+
+class WildcardView(Mapping):
+    """
+    A read-only {wildcard_name: wildcard_data} mapping over a list of directories of a WildcardStore.
+    Names, membership and length come from the directory index alone; files are parsed on first access.
+    A wildcard whose file turns out not to parse is then no longer part of the mapping.
+    """
+
+    def __init__(self, store: WildcardStore, wildcard_dirs: Tuple[str, ...]):
+        self.store = store
+        self.wildcard_dirs = wildcard_dirs
+        # (store version, {name: store key}), replaced as a whole so threads never pair a new
+        # version with old names.
+        self._state: Tuple[int, Dict[str, Tuple[str, str]]] = (-1, {})
+
+    def _names(self) -> Dict[str, Tuple[str, str]]:
+        version, keys = self._state
+        current_version = self.store.version
+        if version != current_version:
+            # Threads may both re-resolve. The version is read first, so a change made meanwhile
+            # makes the next call resolve again.
+            keys = {name: key for name, key in self.store.resolve(self.wildcard_dirs).items() if not self.store.is_failed(key)}
+            self._state = (current_version, keys)
+        return keys
+
+    def get(self, key: str, default: Any = None) -> Any:
+        store_key = self._names().get(key)
+        if store_key is None:
+            return default
+        data = self.store.load(store_key)
+        return default if data is None else data
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._names()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._names()))
+
+    def __len__(self) -> int:
+        return len(self._names())
+
+    # Snapshots rather than live views, skipping files that fail to parse.
+    # Files not loaded yet are loaded together first, in parallel.
+    def items(self) -> List[tuple]:
+        self.preload()
+        return [(key, data) for key in list(self._names()) if (data := self.get(key)) is not None]
+
+    def values(self) -> List[Dict[str, Any]]:
+        return [data for _, data in self.items()]
+
+    def filenames(self) -> List[str]:
+        """The file behind each visible wildcard, including files that failed to parse, sorted case-insensitively."""
+        file_infos = [self.store.file_info(key) for key in self.store.resolve(self.wildcard_dirs).values()]
+        return sorted((file_info.filename for file_info in file_infos if file_info is not None), key=str.lower)
+
+    def preload(self, processes: int = 0) -> None:
+        """Loads every wildcard that isn't loaded yet. See WildcardStore.preload."""
+        if any(not self.store.is_loaded(store_key) for store_key in self._names().values()):
+            self.store.preload(self.wildcard_dirs, processes)
+
+    def is_loaded(self, key: str) -> bool:
+        """Whether a wildcard's file has been parsed."""
+        store_key = self._names().get(key)
+        return store_key is not None and self.store.is_loaded(store_key)
+
+    def loaded_count(self) -> int:
+        return sum(1 for store_key in self._names().values() if self.store.is_loaded(store_key))
+
+    def source_dir(self, key: str) -> Optional[str]:
+        """The directory the wildcard's file is read from."""
+        store_key = self._names().get(key)
+        return store_key[0] if store_key is not None else None
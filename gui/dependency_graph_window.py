@@ -28,11 +28,14 @@ class DependencyGraphWindow(custom_dialogs._CustomDialog):
         self.canvas = None
         self.fig = None
         self.back_button: Optional[ttk.Button] = None
+        self.profile_tree: Optional[ttk.Treeview] = None
+        self.profiling_var = tk.BooleanVar(value=self.processor.is_generation_profiling_enabled())
 
         self._create_widgets()
         self._build_and_draw_graph()
+        self._refresh_profile()
 
-        self.geometry("1000x800")
+        self.geometry("1400x800")
         self._center_window()
         self._center_window()
         self.wait_window(self)
@@ -53,6 +56,8 @@ class DependencyGraphWindow(custom_dialogs._CustomDialog):
         self.back_button = ttk.Button(top_bar, text="< Back to Full Graph", command=self._show_full_graph)
         # The back button is packed/unpacked dynamically
 
+        self._create_profile_panel(main_frame)
+
         # Matplotlib canvas
         self.fig = plt.figure(figsize=(10, 8))
         self.ax = self.fig.add_subplot(1, 1, 1)
@@ -66,6 +71,65 @@ class DependencyGraphWindow(custom_dialogs._CustomDialog):
         # Bind double-click event
         self.canvas.mpl_connect('button_press_event', self._on_canvas_click)
 
+    def _create_profile_panel(self, parent):
+        """A side panel with the per-wildcard generation costs recorded by the template engine."""
+        profile_frame = ttk.LabelFrame(parent, text="Generation Profile", padding=5)
+        profile_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=(0, 10), pady=5)
+
+        controls = ttk.Frame(profile_frame)
+        controls.pack(fill=tk.X, pady=(0, 5))
+        ttk.Checkbutton(controls, text="Record while generating", variable=self.profiling_var, command=self._toggle_profiling).pack(side=tk.LEFT)
+        ttk.Button(controls, text="Reset", command=self._reset_profile).pack(side=tk.RIGHT)
+        ttk.Button(controls, text="Refresh", command=self._refresh_profile).pack(side=tk.RIGHT, padx=5)
+
+        tree_frame = ttk.Frame(profile_frame)
+        tree_frame.pack(fill=tk.BOTH, expand=True)
+        columns = ('wildcard', 'draws', 'rejected', 'filter_ms', 'include_ms', 'depth')
+        self.profile_tree = ttk.Treeview(tree_frame, columns=columns, show='headings')
+        self.profile_tree.heading('wildcard', text='Wildcard')
+        self.profile_tree.heading('draws', text='Draws')
+        self.profile_tree.heading('rejected', text='Rejected')
+        self.profile_tree.heading('filter_ms', text='Requires (ms)')
+        self.profile_tree.heading('include_ms', text='Includes (ms)')
+        self.profile_tree.heading('depth', text='Depth')
+        self.profile_tree.column('wildcard', width=140)
+        for column in columns[1:]:
+            self.profile_tree.column(column, width=75, anchor='center')
+
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.profile_tree.yview)
+        self.profile_tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.profile_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.profile_tree.bind("<Double-1>", self._on_profile_double_click)
+
+        ttk.Label(profile_frame, text="Generate prompts while recording, then refresh.\nDouble-click a row to focus it in the graph.", justify=tk.LEFT).pack(fill=tk.X, pady=(5, 0))
+
+    def _toggle_profiling(self):
+        self.processor.set_generation_profiling(self.profiling_var.get())
+        self._refresh_profile()
+
+    def _reset_profile(self):
+        self.processor.reset_generation_profile()
+        self._refresh_profile()
+
+    def _refresh_profile(self):
+        """Reloads the profile table, costliest wildcards first."""
+        if not self.profile_tree:
+            return
+        self.profile_tree.delete(*self.profile_tree.get_children())
+        for name, stats in self.processor.get_generation_profile().items():
+            self.profile_tree.insert('', tk.END, iid=name, values=(
+                name, stats['draws'], stats['rejected_choices'],
+                f"{stats['filter_seconds'] * 1000:.2f}", f"{stats['include_seconds'] * 1000:.2f}", stats['max_depth']
+            ))
+
+    def _on_profile_double_click(self, event):
+        name = self.profile_tree.identify_row(event.y)
+        if name and name in self.G:
+            self.current_focus_node = name
+            if self.back_button: self.back_button.pack(side=tk.LEFT, anchor='w')
+            self._build_and_draw_graph()
+
     def _show_full_graph(self):
         """Resets the view to the full dependency graph."""
         self.current_focus_node = None
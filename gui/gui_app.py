@@ -17,7 +17,7 @@ from typing import Optional, List, Tuple, Dict, Any, Callable
 from tkinter import ttk
 from PIL import Image, ImageTk
 from core.prompt_processor import PromptProcessor
-from core.template_engine import PromptSegment
+from core.template_engine import PromptSegment, join_segments
 from core.config import config, save_settings, load_settings
 from .enhancement_window import EnhancementResultWindow
 from .brainstorming_window import BrainstormingWindow
@@ -326,6 +326,8 @@ class GUIApp(tk.Tk, SmartWindowMixin):
             try:
                 self.processor.initialize()
                 self.processor.set_callbacks(status_callback=self._update_status_bar_from_event)
+                if config.WATCH_FILES:
+                    self.processor.start_file_watcher(on_pending=self._on_external_file_changes)
                 templates = self.processor.get_available_templates()
                 wildcard_files = self.processor.get_wildcard_files()
                 self.initial_fs_load_queue.put({"success": True, "templates": templates, "wildcard_files": wildcard_files})
@@ -623,6 +625,32 @@ class GUIApp(tk.Tk, SmartWindowMixin):
         else:
             self.template_var.set("Select a template")
 
+    def _on_external_file_changes(self):
+        """Called from the file watcher's thread when wildcards or templates were edited outside the app."""
+        # The changes are applied here, on the main thread, as everything else reads the wildcards from it.
+        self.after(0, self._apply_external_file_changes)
+
+    def _apply_external_file_changes(self):
+        """Applies external file changes and refreshes the affected lists, without touching the current selection."""
+        changed_wildcards, changed_templates = self.processor.apply_file_changes()
+        if not changed_wildcards and not changed_templates:
+            return # Already applied with an earlier batch, or nothing that is in use changed.
+        if changed_wildcards:
+            self._populate_wildcard_lists()
+            if self.wildcard_manager_window and self.wildcard_manager_window.winfo_exists():
+                self.wildcard_manager_window._populate_wildcard_list()
+        if changed_templates:
+            templates = self.processor.get_available_templates()
+            if self.template_var.get() in templates:
+                menu = self.template_dropdown["menu"]
+                menu.delete(0, "end")
+                for template in templates:
+                    menu.add_command(label=template, command=lambda value=template: self.template_var.set(value))
+            else:
+                self._populate_template_dropdown(templates)
+        changed = changed_wildcards + changed_templates
+        self.status_var.set(f"Reloaded {len(changed)} file(s) changed on disk: {', '.join(changed[:5])}{'...' if len(changed) > 5 else ''}")
+
     def _load_templates(self):
         """Loads available templates into the dropdown menu."""
         # Always reset the view to a clean state before loading new templates
@@ -752,8 +780,8 @@ class GUIApp(tk.Tk, SmartWindowMixin):
         settings['workflow'] = new_workflow
         save_settings(settings)
 
-        # Tell the processor to reload its internal wildcard state
-        self.processor.reload_wildcards()
+        # Tell the processor to switch its wildcard view and templates to the new workflow
+        self.processor.switch_workflow()
 
         # Update UI components that depend on the workflow
         self._update_action_bar_variations()
@@ -1096,8 +1124,8 @@ class GUIApp(tk.Tk, SmartWindowMixin):
         # Get the existing context from the last generation result
         existing_context = self.last_generation_result.get('context')
 
-        # Regenerate the prompt, reusing the existing wildcard choices
-        segments, new_context = self.processor.generate_single_structured_prompt(
+        # Regenerate the prompt, reusing the existing wildcard choices and the unchanged parts of the last preview
+        segments, new_context = self.processor.generate_live_structured_prompt(
             live_content,
             existing_context=existing_context,
             force_reroll=force_reroll,
@@ -1256,7 +1284,7 @@ class GUIApp(tk.Tk, SmartWindowMixin):
         """
         if self.current_structured_prompt:
             # Reconstruct the full prompt string from segments
-            raw_prompt = "".join(seg.text for seg in self.current_structured_prompt)
+            raw_prompt = join_segments(self.current_structured_prompt)
         else:
             # Get the prompt directly from the editor pane if no preview has been generated
             raw_prompt = self.template_editor.get_content().strip()
@@ -2116,6 +2144,7 @@ class GUIApp(tk.Tk, SmartWindowMixin):
         if self.last_saved_entry_id_from_preview:
             self.last_saved_entry_id_from_preview = None
         
+        self.processor.stop_file_watcher()
         print("INFO: Application shutdown complete.")
         self.destroy()
 
@@ -1,9 +1,23 @@
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
 import unittest
-from core.template_engine import TemplateEngine
+from itertools import islice
+from core.batch_generation import generate_batch_parallel
+from core.template_enumerator import TemplateEnumerator
+from core.prompt_dedup import PromptDeduplicator, SeenPromptSet, BloomFilterSeenSet
+from core.utils import intern_wildcard_data
+from core.wildcard_store import WildcardStore
+from core.wildcard_cache import WildcardCache
+from core.file_watcher import FileWatcher
+from core.template_engine import TemplateEngine, join_segments, tag_bit, tags_mask, CompiledRequirement, ResolvedContext, PreservedChoices, IncrementalGenerationState, compile_template, derive_prompt_seed, TOKEN_LITERAL, TOKEN_WILDCARD, TOKEN_UNIQUE, TOKEN_MULTI
 
 class TestTemplateEngine(unittest.TestCase):
     def setUp(self):
-        self.engine = TemplateEngine()
+        self.engine = TemplateEngine(use_wildcard_cache=False) # Keep the tests away from the user's cache.
         # Updated to new format and set directly on the engine
         self.engine.wildcards = {
             "color": {"choices": ["red", "blue", "green"]},
@@ -76,4 +90,753 @@ class TestTemplateEngine(unittest.TestCase):
         
         self.assertEqual(segments[1].wildcard_name, "color")
         self.assertEqual(segments[3].wildcard_name, "animal")
-        self.assertIsNone(segments[0].wildcard_name)
\ No newline at end of file
+        self.assertIsNone(segments[0].wildcard_name)
+
+    def test_compile_template_tokens(self):
+        """Test that templates are parsed into literal and wildcard tokens."""
+        tokens = compile_template("A __color__, __!animal__ and __color:1-2__.")
+
+        self.assertEqual([t.kind for t in tokens], [TOKEN_LITERAL, TOKEN_WILDCARD, TOKEN_LITERAL, TOKEN_UNIQUE, TOKEN_LITERAL, TOKEN_MULTI, TOKEN_LITERAL])
+        self.assertEqual("".join(t.text for t in tokens), "A __color__, __!animal__ and __color:1-2__.")
+        self.assertEqual((tokens[5].name, tokens[5].count_min, tokens[5].count_max), ("color", 1, 2))
+        self.assertIs(compile_template("A __color__, __!animal__ and __color:1-2__."), tokens, "Compiled templates should be cached.")
+        self.assertEqual(compile_template(""), ())
+
+    def test_structured_prompt_is_reproducible(self):
+        """Test that the same seed produces the same structured prompt."""
+        template = "A __color__ __animal__ with __!color__ eyes."
+        segments1, context1 = self.engine.generate_structured_prompt(template, seed=42)
+        segments2, context2 = self.engine.generate_structured_prompt(template, seed=42)
+
+        self.assertEqual(segments1, segments2)
+        self.assertEqual(context1, context2)
+        self.assertEqual(segments1[1].wildcard_name, "color")
+        self.assertIsNone(segments1[0].wildcard_name)
+
+    def test_sampling_respects_weights_and_requires(self):
+        """Test that weighted draws honour 'requires' and pick up replaced wildcard data."""
+        self.engine.wildcards["size"] = {"choices": [
+            {"value": "tiny", "weight": 0},
+            {"value": "huge", "weight": 5, "requires": {"animal": "dog"}},
+            "medium",
+        ]}
+        values = {self.engine.generate_structured_prompt("__size__", seed=seed)[0][0].text for seed in range(50)}
+        self.assertEqual(values, {"medium"})
+
+        values = {self.engine.generate_structured_prompt("__animal__ __size__", existing_context={"animal": {"value": "dog", "tags": []}}, seed=seed)[0][2].text for seed in range(50)}
+        self.assertEqual(values, {"medium", "huge"})
+
+        self.engine.wildcards["size"] = {"choices": ["small"]}
+        segments, _ = self.engine.generate_structured_prompt("__size__", seed=1)
+        self.assertEqual(segments[0].text, "small")
+
+    def test_find_choice_object_by_value(self):
+        """Test value lookups against string and object choices, including replaced data."""
+        self.engine.wildcards["mood"] = {"choices": ["calm", {"value": "angry", "tags": ["loud"]}, {"value": "calm", "weight": 3}]}
+
+        self.assertEqual(self.engine.find_choice_object_by_value("mood", "calm"), "calm")
+        self.assertEqual(self.engine.find_choice_object_by_value("mood", "angry"), {"value": "angry", "tags": ["loud"]})
+        self.assertIsNone(self.engine.find_choice_object_by_value("mood", "sad"))
+        self.assertIsNone(self.engine.find_choice_object_by_value("missing", "calm"))
+
+        self.engine.wildcards["mood"] = {"choices": ["sad"]}
+        self.assertEqual(self.engine.find_choice_object_by_value("mood", "sad"), "sad")
+        self.assertIsNone(self.engine.find_choice_object_by_value("mood", "calm"))
+
+    def test_generate_batch_matches_single_generation(self):
+        """Test that batch prompts are reproducible and match single generations with derived seeds."""
+        template = "A __color__ __animal__."
+        batch = list(self.engine.generate_batch(template, 20, base_seed=123))
+
+        self.assertEqual(len(batch), 20)
+        self.assertEqual(batch, list(self.engine.generate_batch(template, 20, base_seed=123)))
+        self.assertEqual(batch[5:], list(self.engine.generate_batch(template, 15, base_seed=123, start_index=5)))
+
+        segments, _ = self.engine.generate_structured_prompt(template, seed=derive_prompt_seed(123, 7))
+        self.assertEqual(batch[7], "".join(s.text for s in segments))
+        segment_batch = list(self.engine.generate_batch(template, 20, base_seed=123, as_segments=True))
+        self.assertEqual(batch, ["".join(s.text for s in segs) for segs in segment_batch])
+
+    def test_generate_batch_parallel_matches_serial(self):
+        """Test that multiprocess generation yields the same prompts in the same order."""
+        template = "A __color__ __animal__."
+        serial = list(self.engine.generate_batch(template, 50, base_seed=9))
+        parallel = list(generate_batch_parallel(self.engine, template, 50, 9, processes=2, chunk_size=7))
+        self.assertEqual(serial, parallel)
+
+    def test_generate_batch_parallel_doesnt_fork_with_other_threads(self):
+        """Test that workers get a fresh interpreter while other threads are running, with the same output."""
+        from unittest import mock
+        from core import batch_generation
+        with mock.patch.object(batch_generation.threading, 'active_count', return_value=1):
+            if 'fork' in multiprocessing.get_all_start_methods():
+                self.assertEqual(batch_generation._get_mp_context().get_start_method(), 'fork')
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        try:
+            self.assertNotEqual(batch_generation._get_mp_context().get_start_method(), 'fork')
+            template = "A __color__ __animal__."
+            parallel = list(generate_batch_parallel(self.engine, template, 20, 4, processes=2, chunk_size=7))
+            self.assertEqual(parallel, list(self.engine.generate_batch(template, 20, base_seed=4)))
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_compiled_requirement_rules(self):
+        """Test compiled 'requires' clauses with logical operators, value and tag conditions."""
+        requirement = CompiledRequirement({"or": [
+            {"color": ["red", "blue"], "tags": {"not": "wet"}},
+            {"and": [{"animal": {"any": ["cat"], "not": "dog"}}, {"tags": {"all": ["furry"]}}]},
+        ]})
+        red = {"color": {"value": "red", "tags": []}}
+        wet_red = {"color": {"value": "red", "tags": ["wet"]}}
+        furry_cat = {"animal": {"value": "cat", "tags": ["furry"]}}
+
+        self.assertTrue(requirement.matches(red))
+        self.assertFalse(requirement.matches(wet_red))
+        self.assertTrue(requirement.matches(furry_cat))
+        self.assertFalse(requirement.matches({}))
+        self.assertFalse(CompiledRequirement({"and": "malformed"}).matches(red))
+        self.assertTrue(CompiledRequirement({}).matches({}))
+
+    def test_resolved_context_tracks_tags(self):
+        """Test that the resolved context keeps its tag index in sync and stays dict-compatible."""
+        context = ResolvedContext({"color": {"value": "red", "tags": ["warm", "bright"]}})
+        context["animal"] = {"value": "cat", "tags": ["warm"]}
+        self.assertEqual(set(context.tags), {"warm", "bright"})
+
+        context["color"] = {"value": "blue", "tags": ["cold"]}
+        self.assertEqual(set(context.tags), {"warm", "cold"})
+        context.pop("animal")
+        self.assertEqual(set(context.tags), {"cold"})
+
+        self.assertEqual(context, {"color": {"value": "blue", "tags": ["cold"]}})
+        _, generated = self.engine.generate_structured_prompt("A __color__ __animal__.", seed=3)
+        self.assertIsInstance(generated, ResolvedContext)
+
+    def test_requirements_on_missing_wildcards_are_skipped(self):
+        """Test that choices needing an unresolved wildcard are never picked, and become valid once it is."""
+        self.engine.wildcards["pet_name"] = {"choices": [
+            "buddy",
+            {"value": "whiskers", "requires": {"animal": "cat"}},
+            {"value": "rex", "requires": {"or": [{"animal": "dog"}, {"color": "red"}]}},
+            {"value": "shadow", "requires": {"animal": {"not": "cat"}}},
+        ]}
+        names = {self.engine.generate_structured_prompt("__pet_name__", seed=seed)[0][0].text for seed in range(100)}
+        self.assertEqual(names, {"buddy", "shadow"})
+
+        cat = {"animal": {"value": "cat", "tags": []}}
+        names = {self.engine.generate_structured_prompt("__animal__ __pet_name__", existing_context=cat, seed=seed)[0][2].text for seed in range(100)}
+        self.assertEqual(names, {"buddy", "whiskers"})
+
+    def test_include_expansion_is_memoized(self):
+        """Test that include templates are expanded once per choice and invalidated with the wildcard."""
+        self.engine.wildcards["race"] = {"includes": ["color"], "choices": [
+            "elf",
+            {"value": "dwarf", "includes": "with a [animal]"},
+        ]}
+        dwarf = self.engine.wildcards["race"]["choices"][1]
+        tokens = self.engine._get_include_tokens("race", dwarf)
+        self.assertIs(tokens, self.engine._get_include_tokens("race", dwarf))
+        self.assertEqual([t.name for t in tokens if t.kind == TOKEN_WILDCARD], ["animal"])
+        self.assertEqual([t.name for t in self.engine._get_include_tokens("race", "elf") if t.kind == TOKEN_WILDCARD], ["color"])
+
+        self.engine.wildcards["race"] = {"choices": [{"value": "dwarf", "includes": ["color"]}]}
+        dwarf = self.engine.wildcards["race"]["choices"][0]
+        self.assertEqual([t.name for t in self.engine._get_include_tokens("race", dwarf) if t.kind == TOKEN_WILDCARD], ["color"])
+
+    def test_existing_context_is_preserved_without_copying(self):
+        """Test that kept, rerolled and swapped choices are resolved from a read-only view of the old context."""
+        _, context = self.engine.generate_structured_prompt("__animal__ __color__", seed=1)
+        snapshot = {key: dict(value) for key, value in context.items()}
+
+        segments, new_context = self.engine.generate_structured_prompt("__animal__ __color__", existing_context=context,
+                                                                       force_swap={"color": "blue"}, seed=2)
+        self.assertEqual(segments[0].text, snapshot["animal"]["value"])
+        self.assertEqual(segments[2].text, "blue")
+        self.assertEqual(dict(context), snapshot)
+        self.assertIsNot(new_context, context)
+
+        preserved = PreservedChoices(context, {"animal"})
+        self.assertNotIn("animal", preserved)
+        self.assertEqual(dict(preserved), {"color": snapshot["color"]["value"]})
+
+    def test_incremental_generation_matches_full_generation(self):
+        """Test that incremental regeneration of an edited template gives the same result as a full one."""
+        state = IncrementalGenerationState()
+        template = "A __color__ __animal__ and a __color:2__ thing."
+        _, context = self.engine.generate_structured_prompt(template, seed=3)
+        for edit in ["A big __color__ __animal__ and a __color:2__ thing.",
+                     "A big __color__ __animal__ and a __color:2__ thing, __!animal__.",
+                     "A big __color__ __animal__ and a __color:2__ thing, __!animal__!"]:
+            expected = self.engine.generate_structured_prompt(edit, existing_context=context, seed=3)
+            self.assertEqual(self.engine.generate_structured_prompt_incremental(edit, state, existing_context=context, seed=3), expected)
+            context = expected[1]
+
+        # Changes to the wildcard data invalidate the stored generation.
+        self.engine.wildcards = {"color": {"choices": ["teal"]}, "animal": {"choices": ["fox"]}}
+        segments, _ = self.engine.generate_structured_prompt_incremental(template, state, seed=3)
+        self.assertEqual("".join(seg.text for seg in segments), "A teal fox and a teal thing.")
+
+    def test_enumerate_template_combinations(self):
+        """Test counting and iterating the full space of a template, and stratified sampling."""
+        self.engine.wildcards = {
+            "color": {"choices": ["red", "blue", {"value": "green", "weight": 2}]},
+            "animal": {"choices": ["cat", {"value": "dog", "requires": {"color": "red"}}]},
+        }
+        enumerator = TemplateEnumerator(self.engine)
+        prompts = list(enumerator.iterate("A __color__ __animal__, __color:1-2__."))
+        self.assertEqual(enumerator.count("A __color__ __animal__, __color:1-2__."), len(prompts))
+        self.assertEqual(len(prompts), 4 * 9) # 3 single picks and 6 ordered pairs.
+        self.assertEqual(len(set(prompts)), len(prompts))
+        self.assertIn("A red dog, blue, green.", prompts)
+        self.assertIn("A red dog, green, blue.", prompts)
+        self.assertNotIn("A blue dog, red.", prompts)
+
+        colors = [prompt.split()[1] for prompt in enumerator.stratified_sample("A __color__ __animal__", 40, base_seed=7)]
+        self.assertEqual((colors.count("red"), colors.count("blue"), colors.count("green")), (10, 10, 20))
+
+    def test_prompt_deduplication(self):
+        """Test that batch prompts are deduplicated against each other and a pre-filled seen-set."""
+        self.engine.wildcards = {"color": {"choices": ["red", "blue", "green"]}}
+        for seen in (SeenPromptSet(), BloomFilterSeenSet(capacity=100)):
+            deduplicator = PromptDeduplicator(seen, max_attempts_per_prompt=50)
+            deduplicator.add_seen(["A red cat."])
+            prompts = list(deduplicator.unique(self.engine.generate_batch("A __color__ cat.", None, base_seed=1)))
+            self.assertEqual(sorted(prompts), ["A blue cat.", "A green cat."])
+            self.assertIn("A red cat.", deduplicator.seen)
+            self.assertEqual(len(deduplicator.seen), 3)
+
+        # The exact set keeps 8-byte hashes in a table that grows as it fills.
+        seen = SeenPromptSet(capacity=4)
+        self.assertTrue(all(seen.add(f"prompt {i}") for i in range(5000)))
+        self.assertFalse(any(seen.add(f"prompt {i}") for i in range(5000)))
+        self.assertNotIn("prompt 5000", seen)
+        self.assertEqual(len(seen), 5000)
+        self.assertLessEqual(seen._slots.itemsize * len(seen._slots), 5000 * 8 * 8 // 3)
+
+    def test_prompt_segments_are_compact_and_shared(self):
+        """Test that segments are slotted and immutable, and literal segments are pooled."""
+        first, _ = self.engine.generate_structured_prompt("A __color__ cat.", seed=1)
+        second, _ = self.engine.generate_structured_prompt("A __color__ cat.", seed=2)
+        self.assertFalse(hasattr(first[0], '__dict__'))
+        self.assertIs(first[0], second[0])
+        self.assertEqual(join_segments(first), "".join(segment.text for segment in first))
+        with self.assertRaises(AttributeError):
+            first[0].text = "B"
+
+    def test_wildcard_data_is_interned_and_tags_are_masks(self):
+        """Test that loaded names and tags are interned, and contexts track tags as a bitmask."""
+        first = intern_wildcard_data({"choices": [{"value": "a", "tags": ["".join(["wa", "rm"])], "requires": {"".join(["co", "lor"]): "red"}}]})
+        second = intern_wildcard_data({"choices": [{"value": "b", "tags": ["".join(["wa", "rm"])], "includes": ["".join(["co", "lor"])]}]})
+        self.assertIs(first["choices"][0]["tags"][0], second["choices"][0]["tags"][0])
+        self.assertIs(next(iter(first["choices"][0]["requires"])), second["choices"][0]["includes"][0])
+
+        context = ResolvedContext(a={"value": "a", "tags": ["warm", "bright"]})
+        self.assertEqual(context.tag_mask, tags_mask(["warm", "bright"]))
+        context["a"] = {"value": "a", "tags": ["cold"]}
+        self.assertEqual(context.tag_mask, tag_bit("cold"))
+
+        # Each engine numbers its own tags, and starts over when its wildcards are reloaded.
+        registry = self.engine.tag_registry
+        self.engine.wildcards["pet"] = {"choices": [{"value": "cat", "requires": {"tags": {"any": ["cold"]}}}, "fish"]}
+        self.assertEqual(self.engine.generate_structured_prompt("__pet__", seed=1)[1]["pet"]["value"], "fish")
+        self.assertEqual(registry.bit("cold"), 1)
+        self.engine.wildcards = dict(self.engine.wildcards)
+        self.assertIsNot(self.engine.tag_registry, registry)
+        self.assertEqual(len(self.engine.tag_registry), 0)
+
+    def test_concurrent_generation_matches_serial_generation(self):
+        """Test that one engine can generate from several threads with the same results as serially."""
+        from concurrent.futures import ThreadPoolExecutor
+        self.engine.wildcards["pet"] = {"choices": [{"value": "__animal__", "includes": ["color"]}, "fish"]}
+        template = "A __color__ __pet__, __animal:2-3__ and __!animal__."
+        serial = [self.engine.generate_structured_prompt(template, seed=seed) for seed in range(200)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            concurrent = list(executor.map(lambda seed: self.engine.generate_structured_prompt(template, seed=seed), range(200)))
+        self.assertEqual([(join_segments(s), dict(c)) for s, c in serial], [(join_segments(s), dict(c)) for s, c in concurrent])
+
+    def test_generation_profiler_records_per_wildcard_costs(self):
+        """Test that an enabled profiler records draws, rejections and depth per wildcard, and a disabled one nothing."""
+        self.engine.wildcards["pet"] = {"choices": [{"value": "__animal__", "includes": ["color"]}]}
+        self.engine.wildcards["animal"] = {"choices": ["cat", {"value": "dog", "requires": {"color": "purple"}}]}
+        self.engine.generate_structured_prompt("A __pet__.", seed=1)
+        self.assertIsNone(self.engine.profiler)
+
+        profiler = self.engine.enable_profiling()
+        for seed in range(10):
+            self.engine.generate_structured_prompt("A __pet__.", seed=seed)
+        profile = profiler.snapshot()
+        self.assertEqual(profiler.generations, 10)
+        self.assertEqual(profile["pet"]["draws"], 10)
+        self.assertEqual(profile["animal"]["rejected_choices"], 10)
+        self.assertEqual((profile["pet"]["max_depth"], profile["animal"]["max_depth"], profile["color"]["max_depth"]), (1, 2, 2))
+        self.assertGreater(profile["pet"]["include_seconds"], 0)
+
+        self.engine.disable_profiling()
+        self.engine.generate_structured_prompt("A __pet__.", seed=1)
+        self.assertEqual(profiler.generations, 10)
+
+        # A preserved choice is a rejection only if it still exists and its 'requires' clause fails.
+        profiler = self.engine.enable_profiling()
+        rejected = []
+        for existing_context in ({}, {"animal": {"value": "unicorn"}}, {"animal": {"value": "dog"}}):
+            profiler.reset()
+            self.engine.generate_structured_prompt("__animal__", existing_context=existing_context, seed=1)
+            rejected.append(profiler.snapshot()["animal"]["rejected_choices"])
+        self.assertEqual(rejected, [1, 1, 2])
+
+    def test_wildcards_are_parsed_on_first_access(self):
+        """Test that loading only indexes the wildcard files and a generation parses just what it uses."""
+        with tempfile.TemporaryDirectory() as wildcard_dir:
+            files = {
+                "pet.json": '{"choices": [{"value": "__animal__", "includes": ["color"]}]}',
+                "animal.txt": "cat\n\n",
+                "color.json": '{"choices": ["red"]}',
+                "color.txt": "blue",
+                "unused.json": '{"choices": ["x"]}',
+                "broken.json": '{"choices": [',
+            }
+            for filename, content in files.items():
+                with open(os.path.join(wildcard_dir, filename), 'w', encoding='utf-8') as f:
+                    f.write(content)
+
+            wildcards = self.engine.load_wildcards([wildcard_dir])
+            self.assertEqual(sorted(wildcards), ["animal", "broken", "color", "pet", "unused"])
+            self.assertEqual(wildcards.loaded_count(), 0)
+
+            segments, _ = self.engine.generate_structured_prompt("A __pet__.", seed=1)
+            self.assertEqual(join_segments(segments), "A cat red .")
+            self.assertFalse(wildcards.is_loaded("unused"))
+            self.assertEqual(wildcards.loaded_count(), 3)
+
+            self.assertIsNone(wildcards.get("broken"))
+            self.assertNotIn("broken", wildcards)
+            self.assertEqual(len(wildcards.items()), 4)
+
+            # The broken file stays listed so it can be fixed, and is read again once it changes.
+            with open(os.path.join(wildcard_dir, "unused.json"), 'w', encoding='utf-8') as f:
+                f.write('{"choices": ["x", "y"]}')
+            self.assertEqual(self.engine.apply_wildcard_file_changes([(wildcard_dir, "unused.json")]), ["unused"])
+            self.assertIn("broken.json", self.engine.wildcard_files_cache)
+            self.assertIsNone(wildcards.get("broken"))
+            with open(os.path.join(wildcard_dir, "broken.json"), 'w', encoding='utf-8') as f:
+                f.write('{"choices": ["fixed", "again"]}')
+            self.assertEqual(self.engine.apply_wildcard_file_changes([(wildcard_dir, "broken.json")]), ["broken"])
+            self.assertEqual(wildcards["broken"]["choices"], ["fixed", "again"])
+
+    def test_workflow_views_share_one_wildcard_store(self):
+        """Test that workflow views layer their directories over one store and share its parsed data."""
+        with tempfile.TemporaryDirectory() as shared_dir:
+            nsfw_dir = os.path.join(shared_dir, "nsfw")
+            os.makedirs(nsfw_dir)
+            for path, content in ((os.path.join(shared_dir, "color.json"), '{"choices": ["red"]}'),
+                                  (os.path.join(nsfw_dir, "color.txt"), "blue"),
+                                  (os.path.join(shared_dir, "animal.json"), '{"choices": ["cat"]}'),
+                                  (os.path.join(nsfw_dir, "animal.json"), '{"choices": ["wolf"]}')):
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+
+            all_wildcards = self.engine.get_all_wildcards_data_from_dirs([shared_dir, nsfw_dir])
+            sfw = self.engine.use_wildcard_dirs([shared_dir])
+            self.assertEqual(join_segments(self.engine.generate_structured_prompt("__color__ __animal__", seed=1)[0]), "red cat")
+
+            nsfw = self.engine.use_wildcard_dirs([shared_dir, nsfw_dir])
+            self.assertIs(self.engine.wildcards, nsfw)
+            self.assertIs(nsfw["color"], sfw["color"]) # A .json file wins over a later .txt file.
+            self.assertIs(nsfw["animal"], all_wildcards["animal"])
+            self.assertEqual(join_segments(self.engine.generate_structured_prompt("__color__ __animal__", seed=1)[0]), "red wolf")
+            self.assertIs(self.engine.use_wildcard_dirs([shared_dir]), sfw)
+            self.assertEqual(self.engine.wildcard_files_cache, ["animal.json", "color.json"])
+
+    def test_switching_workflows_rebuilds_the_tag_registry(self):
+        """Test that the processor's workflow switches and reloads give the engine a fresh tag registry."""
+        from unittest import mock
+        from core.config import config
+        from core.prompt_processor import PromptProcessor
+        with tempfile.TemporaryDirectory() as wildcard_dir, tempfile.TemporaryDirectory() as template_dir:
+            os.makedirs(os.path.join(wildcard_dir, "nsfw"))
+            with open(os.path.join(wildcard_dir, "pet.json"), 'w', encoding='utf-8') as f:
+                f.write('{"choices": [{"value": "cat", "tags": ["soft"]}, {"value": "dog", "requires": {"tags": {"any": ["soft"]}}}]}')
+            with open(os.path.join(wildcard_dir, "nsfw", "pet.json"), 'w', encoding='utf-8') as f:
+                f.write('{"choices": [{"value": "wolf", "requires": {"tags": {"not": ["wild"]}}}]}')
+            with mock.patch.object(config, 'WILDCARD_DIR', wildcard_dir), mock.patch.object(config, 'TEMPLATE_BASE_DIR', template_dir), \
+                    mock.patch.object(config, 'workflow', 'sfw'):
+                processor = PromptProcessor()
+                processor.template_engine = engine = TemplateEngine(use_wildcard_cache=False)
+                processor.reload_wildcards()
+                engine.generate_structured_prompt("__pet__ __pet__", seed=1)
+                sfw_registry = engine.tag_registry
+                self.assertEqual(len(sfw_registry), 1)
+
+                config.workflow = 'nsfw'
+                processor.switch_workflow()
+                self.assertEqual(join_segments(engine.generate_structured_prompt("__pet__", seed=1)[0]), "wolf")
+                self.assertIsNot(engine.tag_registry, sfw_registry)
+                self.assertEqual(len(engine.tag_registry), 1)
+                self.assertEqual(list(engine._sampling_indexes), ["pet"])
+
+                nsfw_registry = engine.tag_registry
+                config.workflow = 'sfw'
+                processor.reload_wildcards()
+                self.assertIsNot(engine.tag_registry, nsfw_registry)
+                self.assertEqual(len(engine.tag_registry), 0)
+
+    def test_workflow_switch_rescans_without_a_watcher(self):
+        """Test that without a file watcher a workflow switch picks up files added on disk, and saves keep directories whole."""
+        from unittest import mock
+        from core.config import config
+        from core.prompt_processor import PromptProcessor
+        with tempfile.TemporaryDirectory() as wildcard_dir, tempfile.TemporaryDirectory() as template_dir:
+            os.makedirs(os.path.join(wildcard_dir, "nsfw"))
+            os.makedirs(os.path.join(template_dir, "sfw"))
+            with open(os.path.join(wildcard_dir, "color.txt"), 'w', encoding='utf-8') as f:
+                f.write("red")
+            with mock.patch.object(config, 'WILDCARD_DIR', wildcard_dir), mock.patch.object(config, 'TEMPLATE_BASE_DIR', template_dir), \
+                    mock.patch.object(config, 'workflow', 'sfw'):
+                processor = PromptProcessor()
+                processor.template_engine = engine = TemplateEngine(use_wildcard_cache=False)
+                processor.reload_wildcards()
+                self.assertEqual(engine.wildcard_files_cache, ["color.txt"])
+
+                # Added while the app was on the other workflow, and keeping the directory's mtime,
+                # as on a filesystem with coarse timestamps.
+                config.workflow = 'nsfw'
+                processor.switch_workflow()
+                stat = os.stat(wildcard_dir)
+                with open(os.path.join(wildcard_dir, "animal.txt"), 'w', encoding='utf-8') as f:
+                    f.write("cat")
+                with open(os.path.join(template_dir, "sfw", "pets.txt"), 'w', encoding='utf-8') as f:
+                    f.write("__animal__")
+                os.utime(wildcard_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                config.workflow = 'sfw'
+                processor.switch_workflow()
+                self.assertEqual(engine.wildcard_files_cache, ["animal.txt", "color.txt"])
+                self.assertEqual(list(engine.templates), ["pets.txt"])
+
+        # Saving into a directory no view has scanned yet indexes all of it, not just the saved file.
+        with tempfile.TemporaryDirectory() as wildcard_dir:
+            for name in ("color", "animal"):
+                with open(os.path.join(wildcard_dir, f"{name}.txt"), 'w', encoding='utf-8') as f:
+                    f.write(name)
+            store = WildcardStore()
+            store.put(wildcard_dir, "color.txt", {"choices": ["color"]})
+            self.assertEqual(sorted(store.view([wildcard_dir])), ["animal", "color"])
+
+    def test_parsed_wildcards_are_reused_from_the_cache(self):
+        """Test that the binary cache skips parsing unchanged files and ignores stale or corrupted entries."""
+        with tempfile.TemporaryDirectory() as wildcard_dir, tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(wildcard_dir, "color.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('{"choices": ["red"]}')
+            cache = WildcardCache(cache_dir)
+            self.assertEqual(WildcardStore(cache).view([wildcard_dir])["color"]["choices"], ["red"])
+
+            # Same size and modification time: the cached data is used and the file isn't parsed.
+            stat = os.stat(path)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('{"choices": ["xyz"]}')
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            self.assertEqual(WildcardStore(cache).view([wildcard_dir])["color"]["choices"], ["red"])
+
+            # A modified file is parsed again.
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertEqual(WildcardStore(cache).view([wildcard_dir])["color"]["choices"], ["xyz"])
+
+            # A corrupted entry counts as a miss and is rewritten.
+            entry_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            with open(entry_path, 'wb') as f:
+                f.write(b'\x00garbage')
+            self.assertEqual(WildcardStore(cache).view([wildcard_dir])["color"]["choices"], ["xyz"])
+            store = WildcardStore()
+            store.refresh([wildcard_dir])
+            self.assertEqual(cache.get(store.file_info((wildcard_dir, "color"))), {"choices": ["xyz"]})
+
+            self.assertTrue(cache.clear())
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_cache_entries_are_only_rewritten_when_needed(self):
+        """Test that cache hits write nothing and a touched but unchanged file only gets its entry's header updated."""
+        with tempfile.TemporaryDirectory() as wildcard_dir, tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(wildcard_dir, "color.txt")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write("red\r\nblue\n")
+            cache = WildcardCache(cache_dir)
+            self.assertEqual(WildcardStore(cache).view([wildcard_dir])["color"]["choices"], ["red", "blue"])
+            entry_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            written = os.stat(entry_path).st_mtime_ns
+
+            os.utime(entry_path, ns=(written - 10**9, written - 10**9))
+            WildcardStore(cache).view([wildcard_dir])["color"]
+            self.assertEqual(os.stat(entry_path).st_mtime_ns, written - 10**9)
+
+            # A touch keeps the entry; after it the header carries the new mtime, so an edit that
+            # keeps that mtime and the size isn't noticed, which proves the file wasn't parsed.
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertEqual(WildcardStore(cache).view([wildcard_dir])["color"]["choices"], ["red", "blue"])
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write("RED\r\nBLUE\n")
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertEqual(WildcardStore(cache).view([wildcard_dir])["color"]["choices"], ["red", "blue"])
+            self.assertEqual(os.listdir(cache_dir), [os.path.basename(entry_path)]) # No temporary files are left behind.
+
+            # Deleting a file removes its entry, whether the deletion is seen by a rescan or a watcher.
+            store = WildcardStore(cache)
+            store.view([wildcard_dir])["color"]
+            other_path = os.path.join(wildcard_dir, "animal.txt")
+            with open(other_path, 'w', encoding='utf-8') as f:
+                f.write("cat")
+            store.refresh_file(wildcard_dir, "animal.txt")
+            store.view([wildcard_dir])["animal"]
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            os.remove(path)
+            self.assertEqual(store.refresh_file(wildcard_dir, "color.txt"), "color")
+            os.remove(other_path)
+            store.refresh([wildcard_dir])
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_file_watcher_reloads_only_changed_wildcards(self):
+        """Test that both watcher backends report external edits and only the edited wildcard is read again."""
+        for use_inotify in (False, True):
+            with tempfile.TemporaryDirectory() as wildcard_dir:
+                for name, value in (("color", "red"), ("animal", "cat")):
+                    with open(os.path.join(wildcard_dir, f"{name}.json"), 'w', encoding='utf-8') as f:
+                        f.write(f'{{"choices": ["{value}"]}}')
+                engine = TemplateEngine(use_wildcard_cache=False)
+                wildcards = engine.load_wildcards([wildcard_dir])
+                self.assertEqual(join_segments(engine.generate_structured_prompt("__color__ __animal__", seed=1)[0]), "red cat")
+
+                # Changes are applied on this thread, not the watcher's.
+                reported = queue.Queue()
+                watcher = FileWatcher([wildcard_dir], reported.put, poll_interval=0.05, use_inotify=use_inotify)
+                apply_reported = lambda: engine.apply_wildcard_file_changes(
+                    (change.directory, change.filename) for change in reported.get(timeout=5))
+                watcher.start()
+                try:
+                    with open(os.path.join(wildcard_dir, "color.json"), 'w', encoding='utf-8') as f:
+                        f.write('{"choices": ["green"]}')
+                    self.assertEqual(apply_reported(), ["color"])
+                    self.assertTrue(wildcards.is_loaded("animal"))
+                    self.assertFalse(wildcards.is_loaded("color"))
+                    self.assertEqual(join_segments(engine.generate_structured_prompt("__color__ __animal__", seed=1)[0]), "green cat")
+
+                    os.remove(os.path.join(wildcard_dir, "animal.json"))
+                    self.assertEqual(apply_reported(), ["animal"])
+                    self.assertNotIn("animal", wildcards)
+                    self.assertEqual(engine.wildcard_files_cache, ["color.json"])
+                finally:
+                    watcher.stop()
+
+    def test_file_watcher_watches_directories_created_later(self):
+        """Test that both backends report files in watched directories that are created after the watcher started."""
+        from core.file_watcher import _load_inotify
+        for use_inotify in (False, True):
+            with tempfile.TemporaryDirectory() as base_dir:
+                wildcard_dir = os.path.join(base_dir, "wildcards")
+                os.makedirs(wildcard_dir)
+                directories = [wildcard_dir, os.path.join(wildcard_dir, "nsfw"), os.path.join(base_dir, "templates")]
+                reported = queue.Queue()
+                watcher = FileWatcher(directories, reported.put, poll_interval=0.05, use_inotify=use_inotify)
+                # Missing directories don't make inotify fall back to polling.
+                self.assertEqual(watcher.start(), 'inotify' if use_inotify and _load_inotify() is not None else 'polling')
+                try:
+                    for directory in directories[1:]:
+                        os.makedirs(directory)
+                        with open(os.path.join(directory, "color.txt"), 'w', encoding='utf-8') as f:
+                            f.write("red")
+                    expected = {(directory, "color.txt") for directory in directories[1:]}
+                    seen = set()
+                    while not expected <= seen:
+                        seen.update((change.directory, change.filename) for change in reported.get(timeout=5))
+
+                    # Files written once the new directories are watched are reported as usual.
+                    with open(os.path.join(directories[1], "animal.txt"), 'w', encoding='utf-8') as f:
+                        f.write("cat")
+                    while (directories[1], "animal.txt") not in seen:
+                        seen.update((change.directory, change.filename) for change in reported.get(timeout=5))
+                finally:
+                    watcher.stop()
+
+    def test_file_watcher_reports_changes_that_never_settle(self):
+        """Test that inotify reports a batch after MAX_SETTLE_SECONDS even while events keep arriving."""
+        import threading
+        from unittest import mock
+        from core import file_watcher
+        with tempfile.TemporaryDirectory() as wildcard_dir, mock.patch.object(file_watcher, 'MAX_SETTLE_SECONDS', 0.5):
+            reported = queue.Queue()
+            watcher = FileWatcher([wildcard_dir], reported.put)
+            if watcher.start() != 'inotify':
+                watcher.stop()
+                self.skipTest("inotify is not available")
+            stop = threading.Event()
+
+            def keep_writing():
+                while not stop.wait(0.05): # Well within SETTLE_SECONDS.
+                    with open(os.path.join(wildcard_dir, "color.txt"), 'w', encoding='utf-8') as f:
+                        f.write("red")
+
+            writer = threading.Thread(target=keep_writing)
+            writer.start()
+            try:
+                changes = reported.get(timeout=3)
+                self.assertTrue(writer.is_alive())
+                self.assertEqual([change.filename for change in changes], ["color.txt"])
+            finally:
+                stop.set()
+                writer.join()
+                watcher.stop()
+
+    def test_wildcard_store_can_be_read_while_files_are_refreshed(self):
+        """Test that listing wildcards while another thread applies file changes never sees a half-updated directory."""
+        import threading
+        with tempfile.TemporaryDirectory() as wildcard_dir:
+            for i in range(200):
+                with open(os.path.join(wildcard_dir, f"wc{i}.txt"), 'w', encoding='utf-8') as f:
+                    f.write("a")
+            store = WildcardStore()
+            view = store.view([wildcard_dir])
+            stop = threading.Event()
+
+            def refresh():
+                i = 0
+                while not stop.is_set():
+                    path = os.path.join(wildcard_dir, f"extra{i % 50}.txt")
+                    if os.path.exists(path):
+                        os.remove(path)
+                    else:
+                        with open(path, 'w', encoding='utf-8') as f:
+                            f.write("b")
+                    store.refresh_file(wildcard_dir, os.path.basename(path))
+                    i += 1
+
+            refresher = threading.Thread(target=refresh)
+            refresher.start()
+            try:
+                for _ in range(3000):
+                    self.assertGreaterEqual(len(store.resolve((wildcard_dir,))), 200)
+                    self.assertGreaterEqual(len(view.filenames()), 200)
+            finally:
+                stop.set()
+                refresher.join()
+
+    def test_concurrent_first_loads_share_one_result(self):
+        """Test that threads loading the same wildcards at once all get the one recorded object, and agree on failures."""
+        from concurrent.futures import ThreadPoolExecutor
+        with tempfile.TemporaryDirectory() as wildcard_dir:
+            for i in range(40):
+                with open(os.path.join(wildcard_dir, f"wc{i}.json"), 'w', encoding='utf-8') as f:
+                    f.write('{"choices": ["a"]}' if i % 10 else '{"choices": [')
+            store = WildcardStore()
+            view = store.view([wildcard_dir])
+            names = sorted(view)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(lambda _: [view.get(name) for name in names], range(8)))
+            for loaded in results[1:]:
+                self.assertTrue(all(a is b for a, b in zip(loaded, results[0])))
+            self.assertEqual(sum(data is None for data in results[0]), 4)
+            self.assertEqual(len(view), 36)
+
+    def test_preloading_matches_loading_one_by_one(self):
+        """Test that a parallel preload gives the same data and overrides as lazy loading, errors included."""
+        with tempfile.TemporaryDirectory() as shared_dir:
+            nsfw_dir = os.path.join(shared_dir, "nsfw")
+            os.makedirs(nsfw_dir)
+            files = {
+                os.path.join(shared_dir, "color.txt"): "red\nblue",
+                os.path.join(shared_dir, "color.json"): '{"choices": ["green"]}',
+                os.path.join(nsfw_dir, "color.txt"): "black",
+                os.path.join(shared_dir, "animal.json"): '{"choices": ["cat"]}',
+                os.path.join(nsfw_dir, "animal.json"): '{"choices": ["wolf"]}',
+                os.path.join(nsfw_dir, "broken.json"): '{"choices": [',
+                # Large enough to be parsed in a worker process.
+                os.path.join(shared_dir, "big.txt"): "\n".join(f"choice {i}" for i in range(40000)),
+            }
+            for path, content in files.items():
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+
+            lazy = WildcardStore().view([shared_dir, nsfw_dir])
+            expected = {key: lazy.get(key) for key in sorted(lazy)}
+            for processes in (0, 1):
+                preloaded = WildcardStore().view([shared_dir, nsfw_dir])
+                preloaded.preload(processes=processes)
+                self.assertEqual(preloaded.loaded_count(), 3)
+                self.assertEqual(dict(preloaded.items()), {key: data for key, data in expected.items() if data is not None})
+                self.assertEqual(preloaded["color"]["choices"], ["green"])
+                self.assertEqual(preloaded["animal"]["choices"], ["wolf"])
+                self.assertNotIn("broken", preloaded)
+
+    def test_directory_snapshots_are_shared_and_refreshed_on_change(self):
+        """Test that directory listings are scanned once, reused while unchanged and rescanned after a change."""
+        with tempfile.TemporaryDirectory() as template_dir:
+            for filename in ("b.txt", "A.txt", "notes.md"):
+                with open(os.path.join(template_dir, filename), 'w', encoding='utf-8') as f:
+                    f.write(f"__{filename[0]}__")
+            os.makedirs(os.path.join(template_dir, "archive.txt"))
+
+            # A directory changed within the timestamp granularity may still change unnoticed, so it is rescanned.
+            self.assertEqual(self.engine.list_templates(template_dir), ["A.txt", "b.txt"])
+            self.assertIsNot(self.engine.dir_snapshots.get(template_dir), self.engine.dir_snapshots.get(template_dir))
+
+            settled_ns = os.stat(template_dir).st_mtime_ns - 10 * 10**9
+            os.utime(template_dir, ns=(settled_ns, settled_ns))
+            snapshot = self.engine.dir_snapshots.get(template_dir)
+            self.assertIs(self.engine.dir_snapshots.get(template_dir), snapshot)
+            self.assertEqual(snapshot.files["b.txt"].size, 5)
+
+            with open(os.path.join(template_dir, "c.txt"), 'w', encoding='utf-8') as f:
+                f.write("__c__")
+            self.assertEqual(self.engine.list_templates(template_dir), ["A.txt", "b.txt", "c.txt"])
+            self.assertIsNot(self.engine.dir_snapshots.get(template_dir), snapshot)
+
+            self.engine.archive_template("c.txt", template_dir)
+            self.assertEqual(sorted(self.engine.dir_snapshots.get(template_dir).names(('.txt',))), ["A.txt", "b.txt"])
+            self.assertEqual(self.engine.list_wildcard_files([template_dir, os.path.join(template_dir, "missing")]), ["A.txt", "b.txt"])
+
+    def test_engine_multi_selections_are_enumerated(self):
+        """Test that every prompt the engine produces for a multi-selection is in the enumerated space."""
+        self.engine.wildcards = {
+            "color": {"choices": ["red", "blue", "green", {"value": "black", "requires": {"animal": "cat"}}]},
+            "animal": {"choices": ["cat", "dog"]},
+        }
+        template = "__animal__: __color:2-3__ and __color:1-2__"
+        enumerated = set(TemplateEnumerator(self.engine).iterate(template))
+        self.assertEqual(TemplateEnumerator(self.engine).count(template), len(enumerated))
+        for seed in range(300):
+            segments, _ = self.engine.generate_structured_prompt(template, seed=seed)
+            self.assertIn(join_segments(segments), enumerated)
+
+    def test_count_repeated_wildcards_with_large_choice_lists(self):
+        """Test that reusing wildcards doesn't make counting walk every prompt, and nested reuses still count exactly."""
+        self.engine.wildcards = {name: {"choices": [f"{name}{i}" for i in range(30)]} for name in "abcde"}
+        enumerator = TemplateEnumerator(self.engine)
+        start = time.perf_counter()
+        self.assertEqual(enumerator.count("__a__ __b__ __c__ __d__ __e__, __a__ __b__ __c__ __d__ __e__"), 30 ** 5)
+        self.assertLess(time.perf_counter() - start, 5)
+
+        self.engine.wildcards["a"] = {"choices": ["x __b__", "y"]}
+        template = "__a__ __b__ __a__"
+        self.assertEqual(enumerator.count(template), len(set(enumerator.iterate(template))))
+
+    def test_enumerating_circular_wildcards_raises(self):
+        """Test that iterating or counting a template over circular wildcards raises instead of hanging."""
+        for wildcards in ({"a": {"choices": ["x", "y __a__"]}}, {"a": {"choices": ["y __b__"]}, "b": {"choices": ["__a__"]}}):
+            self.engine.wildcards = wildcards
+            enumerator = TemplateEnumerator(self.engine)
+            with self.assertRaises(RecursionError):
+                list(islice(enumerator.iterate("__a__"), 5))
+            with self.assertRaises(RecursionError):
+                enumerator.count("__a__")
+
+    def test_stratified_sample_leaves_rerolls_random(self):
+        """Test that rerolls are not stratified by default, and plain uses of a wildcard are dealt exactly."""
+        self.engine.wildcards = {"c": {"choices": ["r", "g", "b", "y"]}}
+        enumerator = TemplateEnumerator(self.engine)
+        for seed in range(5):
+            plain = list(enumerator.stratified_sample("__c__ __!c__", 8, base_seed=seed))
+            firsts = [prompt.split()[0] for prompt in plain]
+            self.assertEqual(sorted(firsts), sorted(["r", "g", "b", "y"] * 2))
+        # With nothing to stratify, rerolls are drawn exactly as in a plain batch.
+        self.assertEqual(list(enumerator.stratified_sample("__!c__", 8, base_seed=1)), list(self.engine.generate_batch("__!c__", 8, base_seed=1)))